@@ -54,6 +54,7 @@ from r2.lib import cssfilter
 from r2.lib import tracking
 from r2.lib.media import force_thumbnail, thumbnail_url
 from r2.lib.comment_tree import add_comment, delete_comment
+from r2.lib.comment_tree import update_comment_votes
 
 from simplejson import dumps
 
@@ -775,6 +776,10 @@ class ApiController(RedditController):
                 if g.write_query_queue:
                     queries.new_vote(v)
 
+            #move the comment in its link's precomputed comment orders
+            elif isinstance(thing, Comment):
+                update_comment_votes(thing)
+
             # flag search indexer that something has changed
             tc.changed(thing)
 
@@ -39,6 +39,7 @@ from pylons import c, request
 
 import random as rand
 import re
+from itertools import islice
 import time as time_module
 from urllib import quote_plus
 
@@ -81,7 +82,7 @@ class FrontController(RedditController):
                 links._limit = 25
                 links = [x._fullname for x in links]
         else:
-            links = links[:25]
+            links = list(islice(links, 25))
         if links:
             name = links[rand.randint(0, min(24, len(links)-1))]
             link = Link._by_fullname(name, data = True)
@@ -138,7 +138,8 @@ class ListingController(RedditController):
             builder_cls = SearchBuilder
         elif isinstance(self.query_obj, iters):
             builder_cls = IDBuilder
-        elif isinstance(self.query_obj, queries.CachedResults):
+        elif isinstance(self.query_obj, (queries.CachedResults,
+                                         queries.MergedCachedResults)):
             builder_cls = IDBuilder
 
         b = builder_cls(self.query_obj,
@@ -400,6 +401,8 @@ class RandomrisingController(ListingController):
             if isinstance(links, Query):
                 links._limit = 200
                 links = [x._fullname for x in links]
+            else:
+                links = list(links)
         
         random.shuffle(links)
 
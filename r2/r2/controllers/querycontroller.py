@@ -6,10 +6,19 @@ import cPickle as pickle
 from urllib import unquote
 
 class QueryController(RedditController):
-    @validate(query = nop('query'))
-    def POST_doquery(self, query):
+    def POST_doquery(self):
+        """Updates each CachedResults posted as a 'query' parameter and
+        responds with 'ok' and the idens of the ones that were updated,
+        one per line."""
         if g.enable_doquery:
-            cr = pickle.loads(query)
-            cr.update()
+            done = []
+            for query in request.POST.getall('query'):
+                cr = pickle.loads(query)
+                try:
+                    cr.update()
+                    done.append(cr.iden)
+                except Exception, e:
+                    g.log.error('doquery %s failed: %r' % (cr.iden, e))
+            return '\n'.join(['ok'] + done)
         else:
             abort(403, 'forbidden')
@@ -27,7 +27,11 @@ from pylons.i18n.translation import LanguageError
 from r2.lib.base import BaseController, proxyurl
 from r2.lib import pages, utils, filters
 from r2.lib.utils import http_utils
-from r2.lib.cache import LocalCache
+from r2.lib.cache import make_local_cache
+from r2.lib.db.thing import begin_write_behind, end_write_behind
+from r2.lib.db.thing import abort_write_behind
+from r2.lib.db.thing import begin_identity_map, end_identity_map
+from r2.lib.db.thing import not_found_cache
 import random as rand
 from r2.models.account import valid_cookie, FakeAccount
 from r2.models.subreddit import Subreddit
@@ -442,7 +446,13 @@ class RedditController(BaseController):
         c.cookies[g.login_cookie] = Cookie(value='')
 
     def pre(self):
-        g.cache.caches = (LocalCache(),) + g.cache.caches[1:]
+        local_cache = make_local_cache(getattr(g, 'local_cache_items', 0),
+                                       getattr(g, 'local_cache_bytes', 0))
+        g.cache.caches = (local_cache,) + g.cache.caches[1:]
+        begin_identity_map()
+
+        if g.write_behind:
+            begin_write_behind()
 
         #check if user-agent needs a dose of rate-limiting
         if not c.error_page:
@@ -553,6 +563,17 @@ class RedditController(BaseController):
                 c.response_wrappers = []
 
     def post(self):
+        #write out anything committed during the request
+        end_write_behind()
+
+        hits, misses = end_identity_map()
+        g.log.debug('identity map: %d hits, %d misses' % (hits, misses))
+        if not_found_cache.time:
+            #totals for the process, not just this request
+            g.log.debug('not found cache totals: %(hits)d hits, '
+                        '%(misses)d misses, %(stores)d stored'
+                        % not_found_cache.stats())
+
         response = c.response
         content = response.content
         if isinstance(content, (list, tuple)):
@@ -591,6 +612,11 @@ class RedditController(BaseController):
                              response,
                              g.page_cache_time)
 
+    def post_error(self):
+        #don't write out anything a failed request committed
+        abort_write_behind()
+        end_identity_map()
+
     def check_modified(self, thing, action):
         if c.user_is_loggedin:
             return
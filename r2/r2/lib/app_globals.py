@@ -23,7 +23,8 @@ from __future__ import with_statement
 from pylons import config
 import pytz, os, logging, sys, socket
 from datetime import timedelta
-from r2.lib.cache import LocalCache, Memcache, CacheChain
+from r2.lib.cache import Memcache, CacheChain, AsyncWriter, make_local_cache
+from r2.lib.contrib.memcache import Serializer
 from r2.lib.db.stats import QueryStats
 from r2.lib.translation import _get_languages
 from r2.lib.lock import make_lock_factory
@@ -43,8 +44,22 @@ class Globals(object):
                  'max_comments',
                  'num_side_reddits',
                  'num_query_queue_workers',
+                 'query_queue_batch_size',
+                 'query_queue_debounce',
+                 'query_queue_lease',
                  'max_sr_images',
                  'karma_to_post',
+                 'db_fetch_chunk_size',
+                 'db_fetch_threads',
+                 'counter_flush_interval',
+                 'local_cache_items',
+                 'local_cache_bytes',
+                 'script_cache_items',
+                 'script_cache_bytes',
+                 'memcache_pool_size',
+                 'memcache_pickle_protocol',
+                 'memcache_compress_len',
+                 'not_found_cache_time',
                  ]
     
     bool_props = ['debug', 'translator', 
@@ -52,13 +67,25 @@ class Globals(object):
                   'uncompressedJS',
                   'enable_doquery',
                   'use_query_cache',
+                  'pack_query_cache',
                   'write_query_queue',
+                  'query_queue_notify',
+                  'write_behind',
+                  'aggregate_counters',
+                  'comment_tree_deltas',
+                  'memcache_pipeline',
+                  'memcache_binary',
+                  'memcache_size_stats',
+                  'cache_async_writes',
                   'css_killswitch']
 
     tuple_props = ['memcaches',
                    'rec_cache',
                    'permacaches',
                    'rendercaches',
+                   'old_memcaches',
+                   'old_permacaches',
+                   'old_rendercaches',
                    'admins',
                    'sponsors',
                    'monitored_servers',
@@ -112,10 +139,34 @@ class Globals(object):
                 setattr(self, k, v)
 
         # initialize caches
-        mc = Memcache(self.memcaches)
-        self.cache = CacheChain((LocalCache(), mc))
-        self.permacache = Memcache(self.permacaches)
-        self.rendercache = Memcache(self.rendercaches)
+        # one serializer for every memcache, so its sizes() covers them all
+        self.cache_serializer = Serializer(
+            protocol = getattr(self, 'memcache_pickle_protocol', None) or 2,
+            compress_len = getattr(self, 'memcache_compress_len', None) or 0,
+            track_sizes = bool(self.memcache_size_stats))
+
+        def make_memcache(name):
+            # while moving to new servers or hashing, old_<name> and
+            # memcache_old_hashing say where keys used to be
+            old_servers = [s for s in getattr(self, 'old_' + name, ()) if s]
+            return Memcache(getattr(self, name),
+                            pipeline = bool(self.memcache_pipeline),
+                            binary = bool(self.memcache_binary),
+                            pool_size = getattr(self, 'memcache_pool_size', 0),
+                            serializer = self.cache_serializer,
+                            hashing = getattr(self, 'memcache_hashing', None)
+                                      or 'modulo',
+                            old_servers = old_servers or None,
+                            old_hashing = getattr(self, 'memcache_old_hashing',
+                                                  None) or None)
+
+        mc = make_memcache('memcaches')
+        self.cache_writer = AsyncWriter() if self.cache_async_writes else None
+        local_cache = make_local_cache(getattr(self, 'local_cache_items', 0),
+                                       getattr(self, 'local_cache_bytes', 0))
+        self.cache = CacheChain((local_cache, mc), writer = self.cache_writer)
+        self.permacache = make_memcache('permacaches')
+        self.rendercache = make_memcache('rendercaches')
         self.make_lock = make_lock_factory(mc)
 
         self.rec_cache = Memcache(self.rec_cache)
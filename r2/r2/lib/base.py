@@ -88,11 +88,17 @@ class BaseController(WSGIController):
                     meth + '_' + action
 
         c.response = Response()
-        res = WSGIController.__call__(self, environ, start_response)
+        try:
+            res = WSGIController.__call__(self, environ, start_response)
+        except:
+            #__after__ doesn't run when the action raises
+            self.post_error()
+            raise
         return res
             
     def pre(self): pass
     def post(self): pass
+    def post_error(self): pass
 
 
     @classmethod
@@ -0,0 +1,151 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+# 
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+# 
+# The Original Code is Reddit.
+# 
+# The Original Developer is the Initial Developer.  The Initial Developer of the
+# Original Code is CondeNet, Inc.
+# 
+# All portions of the code written by CondeNet are Copyright (c) 2006-2008
+# CondeNet, Inc. All Rights Reserved.
+################################################################################
+"""
+Benchmarks for the caches, for trying out their settings. Not
+imported by anything; run them with paster, e.g.:
+
+    paster run production.ini r2/lib/bench_cache.py -c "bench_placement()"
+"""
+import time
+
+from r2.lib.contrib.memcache import Client, _Placement, _Host
+
+def key_movement(old_servers, new_servers, hashing, num_keys = 100000):
+    """The fraction of num_keys keys that change servers when a client's
+    servers go from old_servers to new_servers."""
+    old = _Placement([(_Host(s), 1) for s in old_servers], hashing)
+    new = _Placement([(_Host(s), 1) for s in new_servers], hashing)
+    moved = 0
+    for i in xrange(num_keys):
+        key = 'key%d' % i
+        a = old.candidates(key).next()
+        b = new.candidates(key).next()
+        if (a.ip, a.port) != (b.ip, b.port):
+            moved += 1
+    return float(moved) / num_keys
+
+def bench_placement():
+    """Prints the fraction of keys each hashing moves when a server is
+    added to or removed from clusters of a few sizes, next to the least
+    that has to move."""
+    print "%7s %8s %8s %8s %8s %8s" % ('servers', 'hashing', 'add', 'ideal',
+                                       'remove', 'ideal')
+    for n in (2, 4, 8, 16):
+        servers = ['10.0.0.%d:11211' % i for i in xrange(n + 1)]
+        for hashing in ('modulo', 'ketama'):
+            t = time.time()
+            add = key_movement(servers[:n], servers, hashing)
+            remove = key_movement(servers[:n], servers[:n - 1], hashing)
+            print "%7d %8s %8.3f %8.3f %8.3f %8.3f (%.1fs)" % (
+                n, hashing, add, 1. / (n + 1), remove, 1. / n,
+                time.time() - t)
+
+def bench_get_multi(servers = ("127.0.0.1:11211",), seconds = 2):
+    """Prints get_multi throughput in keys/s against servers for 100, 500
+    and 1000 key batches of small pickled values, for the text, pipelined
+    text and binary protocols."""
+    modes = [('text', {}), ('pipelined', dict(pipeline=True)),
+             ('binary', dict(binary=True))]
+    sizes = (100, 500, 1000)
+    print "%10s %12s %12s %12s" % (('', ) + tuple('%d keys' % n for n in sizes))
+    for name, kw in modes:
+        mc = Client(servers, pool_size=1, **kw)
+        rates = []
+        for n in sizes:
+            keys = ['bench_%d' % i for i in xrange(n)]
+            mc.set_multi(dict((k, dict(id=i, name=k)) for i, k in enumerate(keys)))
+            count = 0
+            start = time.time()
+            while time.time() - start < seconds:
+                if len(mc.get_multi(keys)) != n:
+                    raise ValueError("missing keys, is memcached running?")
+                count += 1
+            rates.append(count * n / (time.time() - start))
+        print "%10s %12d %12d %12d" % ((name, ) + tuple(rates))
+
+def bench_thing_pickles(n = 1000, rounds = 5):
+    """
+    Compares n cached Links in the format things were cached in before
+    they had slots and a slim pickled state (a protocol 1 pickle of
+    their whole state, SafeSetAttr and all) with the current one from
+    g.cache_serializer: the pickle sizes, and the best time of rounds
+    Link._byID calls for all of them from memcache.
+
+    Example:
+        paster run production.ini r2/lib/bench_cache.py -c "bench_thing_pickles()"
+    """
+    import copy_reg
+    import cPickle as pickle
+    from pylons import g
+    from r2.models import Link
+    from r2.lib.utils import make_script_cache
+    from r2.lib.contrib.memcache import Client
+    from r2.lib.db.thing import thing_prefix, SafeSetAttr
+
+    ids = [l._id for l in Link._query(limit = n, data = False)]
+    links = Link._byID(ids, data = True, return_dict = False)
+    if not links:
+        print "no links to cache"
+        return
+
+    class Legacy(object):
+        def __init__(self, thing):
+            self.thing = thing
+
+        def __reduce__(self):
+            t = self.thing
+            state = t.__getstate__()
+            state.update(_dirties = t._dirties, _created = t._created,
+                         __safe__ = False, safe_set_attr = SafeSetAttr(self))
+            return (copy_reg._reconstructor, (t.__class__, object, None),
+                    state)
+
+    ser = g.cache_serializer
+    formats = []
+    data = [pickle.dumps(Legacy(l), 1) for l in links]
+    formats.append(('before', data, dict((l._id, (Client._FLAG_PICKLE, len(d), d))
+                                         for l, d in zip(links, data))))
+    data = [pickle.dumps(l, ser.protocol) for l in links]
+    formats.append(('after', data, dict((l._id, ser.dumps(l))
+                                        for l in links)))
+
+    mc = g.cache.caches[-1]
+    prefix = thing_prefix(Link.__name__)
+    caches = g.cache.caches
+    try:
+        for name, data, stored in formats:
+            mc.set_stored_multi(stored, prefix)
+            best = None
+            for i in xrange(rounds):
+                g.cache.caches = (make_script_cache(),) + tuple(caches[1:])
+                start = time.time()
+                Link._byID(ids, data = True)
+                elapsed = time.time() - start
+                best = min(best or elapsed, elapsed)
+
+            size = sum(len(d) for d in data)
+            stored_size = sum(s[1] for s in stored.itervalues())
+            print ("%6s: %d links, %d bytes pickled (%d each), %d stored, "
+                   "_byID %.1fms" % (name, len(data), size, size / len(data),
+                                     stored_size, best * 1000))
+    finally:
+        g.cache.caches = caches
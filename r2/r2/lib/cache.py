@@ -19,7 +19,12 @@
 # All portions of the code written by CondeNet are Copyright (c) 2006-2008
 # CondeNet, Inc. All Rights Reserved.
 ################################################################################
-from threading import local
+from __future__ import with_statement
+from threading import local, Thread, Lock, Event
+from time import sleep, time as now
+from Queue import Queue, Full
+import cPickle as pickle
+from md5 import md5
 
 from utils import lstrips
 from contrib import memcache
@@ -49,6 +54,11 @@ class CacheUtils(object):
 
         return dict((key_map[k], r[k]) for k in r.keys())
 
+    def backfill_multi(self, keys, prefix='', time=0):
+        """set_multi for values that were just read from somewhere
+        else, which a CacheChain may write asynchronously."""
+        self.set_multi(keys, prefix, time = time)
+
 class Memcache(CacheUtils, memcache.Client):
     simple_get_multi = memcache.Client.get_multi
 
@@ -60,6 +70,13 @@ class Memcache(CacheUtils, memcache.Client):
         memcache.Client.set_multi(self, new_keys, key_prefix = prefix,
                                   time = time)
 
+    def set_stored_multi(self, stored, prefix='', time=0, cmd='set'):
+        new_keys = {}
+        for k,v in stored.iteritems():
+            new_keys[str(k)] = v
+        memcache.Client.set_stored_multi(self, new_keys, key_prefix = prefix,
+                                         time = time, cmd = cmd)
+
     def get(self, key, default=None):
         r = memcache.Client.get(self, key)
         if r is None: return default
@@ -128,9 +145,205 @@ class LocalCache(dict, CacheUtils):
     def flush_all(self):
         self.clear()
 
+class LRUCache(CacheUtils):
+    """A LocalCache that holds at most max_items values, and if max_bytes
+    is set about that many bytes of them (measured by pickling each
+    value, so it costs a little on every set), evicting the least
+    recently used. Every operation is O(1). A limit of 0 is no limit."""
+    def __init__(self, max_items = 100*1000, max_bytes = 0):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.flush_all()
+
+    #the entries are [prev, next, key, val, size] in a circular list
+    #around root, least recently used first
+    def _unlink(self, node):
+        prev, next = node[0], node[1]
+        prev[1] = next
+        next[0] = prev
+
+    def _append(self, node):
+        root = self.root
+        last = root[0]
+        node[0] = last
+        node[1] = root
+        last[1] = node
+        root[0] = node
+
+    def _touch(self, node):
+        self._unlink(node)
+        self._append(node)
+
+    def _evict(self):
+        while self.map and ((self.max_items and len(self.map) > self.max_items)
+                            or (self.max_bytes and self.size > self.max_bytes)):
+            node = self.root[1]
+            self._unlink(node)
+            del self.map[node[2]]
+            self.size -= node[4]
+            self.evictions += 1
+
+    def _sizeof(self, val):
+        if not self.max_bytes:
+            return 0
+        try:
+            return len(pickle.dumps(val, 2))
+        except (pickle.PicklingError, TypeError):
+            return 0
+
+    def _check_key(self, key):
+        if not isinstance(key, str):
+            raise TypeError('Key must be a string.')
+
+    def __len__(self):
+        return len(self.map)
+
+    def __contains__(self, key):
+        return key in self.map
+
+    def has_key(self, key):
+        return key in self.map
+
+    def get(self, key, default=None):
+        node = self.map.get(key)
+        if node is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self._touch(node)
+        if node[3] is None: return default
+        return node[3]
+
+    def simple_get_multi(self, keys):
+        out = {}
+        for k in keys:
+            node = self.map.get(k)
+            if node is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._touch(node)
+                out[k] = node[3]
+        return out
+
+    def set(self, key, val, time = 0):
+        self._check_key(key)
+        size = self._sizeof(val)
+        node = self.map.get(key)
+        if node is None:
+            node = [None, None, key, val, size]
+            self.map[key] = node
+            self._append(node)
+        else:
+            self.size -= node[4]
+            node[3] = val
+            node[4] = size
+            self._touch(node)
+        self.size += size
+        self._evict()
+
+    def set_multi(self, keys, prefix='', time=0):
+        for k,v in keys.iteritems():
+            self.set(prefix+str(k), v)
+
+    def add(self, key, val):
+        self._check_key(key)
+        if key not in self.map:
+            self.set(key, val)
+
+    def delete(self, key):
+        node = self.map.pop(key, None)
+        if node is not None:
+            self._unlink(node)
+            self.size -= node[4]
+
+    def delete_multi(self, keys):
+        for key in keys:
+            self.delete(key)
+
+    def incr(self, key, amt=1):
+        node = self.map.get(key)
+        if node is not None:
+            node[3] += amt
+
+    def decr(self, key, amt=1):
+        self.incr(key, -amt)
+
+    def flush_all(self):
+        self.map = {}
+        self.root = root = []
+        root[:] = [root, root, None, None, 0]
+        self.size = 0
+        self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        return dict(items = len(self.map), bytes = self.size,
+                    hits = self.hits, misses = self.misses,
+                    evictions = self.evictions)
+
+class SelfEmptyingCache(LRUCache):
+    """Deprecated, use make_script_cache in r2.lib.utils. Kept for
+    scripts that still build one: it's an LRUCache of max_size items
+    now, evicting the oldest rather than emptying itself when full."""
+    def __init__(self, max_size = 100*1000):
+        LRUCache.__init__(self, max_size)
+
+def make_local_cache(max_items = 0, max_bytes = 0):
+    """The first layer of a CacheChain: an LRUCache if there is a limit,
+    otherwise an unbounded LocalCache."""
+    if max_items or max_bytes:
+        return LRUCache(max_items, max_bytes)
+    return LocalCache()
+
+class AsyncWriter(object):
+    """Runs cache write-backs on a background thread so the read path
+    doesn't wait on them. It's only a cache, so writes are dropped
+    rather than blocking when max_queued are already waiting."""
+    def __init__(self, max_queued = 1000):
+        self.queue = Queue(max_queued)
+        self.lock = Lock()
+        self.thread = None
+        self.written = self.failed = self.dropped = 0
+
+    def _start(self):
+        with self.lock:
+            if not self.thread:
+                self.thread = Thread(target = self.run)
+                self.thread.setDaemon(True)
+                self.thread.start()
+
+    def add(self, fn, *a, **kw):
+        if not self.thread:
+            self._start()
+        try:
+            self.queue.put_nowait((fn, a, kw))
+        except Full:
+            self.dropped += 1
+
+    def run(self):
+        while True:
+            fn, a, kw = self.queue.get()
+            try:
+                fn(*a, **kw)
+                self.written += 1
+            except Exception:
+                self.failed += 1
+            self.queue.task_done()
+
+    def flush(self):
+        """Blocks until every queued write has been sent."""
+        self.queue.join()
+
+    def stats(self):
+        return dict(queued = self.queue.qsize(), written = self.written,
+                    failed = self.failed, dropped = self.dropped)
+
 class CacheChain(CacheUtils, local):
-    def __init__(self, caches):
+    def __init__(self, caches, writer = None):
+        """writer is an AsyncWriter to send write-backs to memcache
+        layers with, None to write them synchronously."""
         self.caches = caches
+        self.writer = writer
 
     def make_set_fn(fn_name):
         def fn(self, *a, **kw):
@@ -147,15 +360,38 @@ class CacheChain(CacheUtils, local):
     delete_multi = make_set_fn('delete_multi')
     flush_all = make_set_fn('flush_all')
 
+    def _write_back(self, caches, keys, prefix='', time=0):
+        """Set keys in caches. In-process layers are set right away,
+        memcache layers through the writer if there is one, with the
+        values pickled now so later changes to them aren't cached.
+        Memcache layers are sent an add rather than a set, so a value
+        read before a commit can't replace the one it stored."""
+        stored = None
+        for d in caches:
+            if isinstance(d, Memcache):
+                if stored is None:
+                    stored = dict((k, d._val_to_store_info(v, 0,
+                                                           prefix + str(k)))
+                                  for k, v in keys.iteritems())
+                if self.writer:
+                    self.writer.add(d.set_stored_multi, stored, prefix,
+                                    time = time, cmd = 'add')
+                else:
+                    d.set_stored_multi(stored, prefix, time = time,
+                                       cmd = 'add')
+            else:
+                d.set_multi(keys, prefix, time = time)
+
+    def backfill_multi(self, keys, prefix='', time=0):
+        self._write_back(self.caches, keys, prefix, time)
+
     def get(self, key, default=None):
-        for c in self.caches:
+        for i, c in enumerate(self.caches):
             val = c.get(key, default)
             if val is not None:
                 #update other caches
-                for d in self.caches:
-                    if c == d:
-                        break;
-                    d.set(key, val)
+                if i:
+                    self._write_back(self.caches[:i], {key: val})
                 return val
         #didn't find anything
         return default
@@ -163,33 +399,194 @@ class CacheChain(CacheUtils, local):
     def simple_get_multi(self, keys):
         out = {}
         need = set(keys)
-        for c in self.caches:
+        for i, c in enumerate(self.caches):
             if len(out) == len(keys):
                 break
             r = c.simple_get_multi(need)
             #update other caches
             if r:
-                for d in self.caches:
-                    if c == d:
-                        break;
-                    d.set_multi(r)
+                if i:
+                    self._write_back(self.caches[:i], r)
                 r.update(out)
                 out = r
                 need = need - set(r.keys())
         return out
 
+class _Flight(object):
+    def __init__(self):
+        self.done = Event()
+        self.values = None
+
+class SingleFlight(object):
+    """Makes sure only one caller fills a missing cache key at a
+    time. Threads in this process wait on the one computing it. Other
+    processes find its lease ('lease_' + key, added in memcache like
+    MemcacheLock does) and are served the stale copy ('stale_' + key,
+    which outlives the value by stale_time) while it's refreshed, or
+    poll for the new value for up to lease_wait seconds if there isn't
+    one. Threads wait up to wait seconds for each other. Anyone left
+    waiting too long computes the value themselves."""
+    def __init__(self, lease_time = 30, wait = 5, stale_time = None,
+                 poll = .1, lease_wait = 1):
+        self.lease_time = lease_time
+        self.wait = wait
+        self.lease_wait = lease_wait
+        #None keeps the stale copy for as long again as the value
+        self.stale_time = stale_time
+        self.poll = poll
+        self.lock = Lock()
+        self.flights = {}
+        self.computed = self.waited = self.stale = 0
+
+    def shared_cache(self, cache):
+        #leases and stale copies only work in a cache every process sees
+        if isinstance(cache, CacheChain):
+            return cache.caches[-1]
+        return cache
+
+    def side_key(self, kind, key):
+        """The lease_ or stale_ key for a key, hashed if the prefix
+        would make it longer than memcache allows."""
+        side = kind + key
+        if len(side) > memcache.SERVER_MAX_KEY_LENGTH:
+            side = kind + md5(key).hexdigest()
+        return side
+
+    def _side_keys(self, kind, prefix, keys):
+        #side key -> key
+        return dict((self.side_key(kind, prefix + k), k) for k in keys)
+
+    def _get_side(self, shared, kind, prefix, keys):
+        side = self._side_keys(kind, prefix, keys)
+        found = shared.get_multi(side.keys())
+        return dict((side[k], v) for k, v in found.iteritems())
+
+    def _land(self, flights, values):
+        """hands values to the threads waiting on flights"""
+        with self.lock:
+            for k, f in flights.iteritems():
+                f.values = values
+                f.done.set()
+                if self.flights.get(k) is f:
+                    del self.flights[k]
+
+    def _compute(self, cache, shared, keys, miss_fn, prefix, time, stale):
+        values = miss_fn(keys)
+        self.computed += len(keys)
+        cache.set_multi(values, prefix, time = time)
+        if stale and time:
+            side = self._side_keys('stale_', prefix, values.keys())
+            shared.set_multi(dict((k, values[v]) for k, v in side.iteritems()),
+                             time = time + (self.stale_time or time))
+        return values
+
+    def fill_multi(self, cache, keys, miss_fn, prefix = '', time = 0,
+                   stale = True):
+        """Fills the str keys that weren't in cache using miss_fn,
+        which returns a dict of the keys it could find values for.
+        Returns the values, however they were found."""
+        shared = self.shared_cache(cache)
+        leases = isinstance(shared, Memcache)
+        mine, theirs = {}, {}
+        with self.lock:
+            for k in keys:
+                f = self.flights.get(prefix + k)
+                if f:
+                    theirs[k] = f
+                else:
+                    mine[k] = self.flights[prefix + k] = _Flight()
+
+        out = {}
+        try:
+            if leases:
+                leased = [k for k in mine
+                          if shared.add(self.side_key('lease_', prefix + k),
+                                        1, time = self.lease_time)]
+            else:
+                leased = mine.keys()
+            if leased:
+                try:
+                    values = self._compute(cache, shared, leased, miss_fn,
+                                           prefix, time, stale)
+                finally:
+                    if leases:
+                        shared.delete_multi(self._side_keys('lease_', prefix,
+                                                            leased).keys())
+                #None marks the ones miss_fn didn't find
+                out.update((k, values.get(k)) for k in leased)
+                self._land(dict((prefix + k, mine.pop(k)) for k in leased),
+                           values)
+
+            #someone else is computing the rest
+            rest = mine.keys() + theirs.keys()
+            if rest and stale and time:
+                found = self._get_side(shared, 'stale_', prefix, rest)
+                self.stale += len(found)
+                out.update(found)
+
+            deadline = now() + self.wait
+            for k, f in theirs.iteritems():
+                if k not in out:
+                    f.done.wait(max(deadline - now(), 0))
+                    self.waited += 1
+                    if f.values is not None:
+                        if k in f.values:
+                            out[k] = f.values[k]
+                        #found to be missing
+                        else:
+                            out[k] = None
+
+            #another process has the lease and there's no stale copy.
+            #it's probably nearly done, but not worth waiting long for.
+            polling = [k for k in mine if k not in out]
+            deadline = now() + self.lease_wait
+            while polling and now() < deadline:
+                sleep(self.poll)
+                out.update(cache.get_multi(polling, prefix))
+                held = self._get_side(shared, 'lease_', prefix, polling)
+                #lease gone without a value: compute it below
+                polling = [k for k in polling if k not in out and k in held]
+                self.waited += 1
+
+            left = [k for k in keys if k not in out]
+            if left:
+                out.update(self._compute(cache, shared, left, miss_fn,
+                                         prefix, time, stale))
+            self._land(dict((prefix + k, f) for k, f in mine.iteritems()),
+                       out)
+        finally:
+            #anyone still waiting on a flight that failed computes it
+            self._land(dict((prefix + k, f) for k, f in mine.iteritems()
+                            if not f.done.isSet()), None)
+
+        return dict((k, v) for k, v in out.iteritems() if v is not None)
+
+    def stats(self):
+        return dict(computed = self.computed, waited = self.waited,
+                    stale = self.stale)
+
+flights = SingleFlight()
+
 #smart get multi
-def sgm(cache, keys, miss_fn, prefix='', time=0):
+def sgm(cache, keys, miss_fn, prefix='', time=0, single_flight=False):
+    """single_flight fills the missing keys through flights, so that
+    only one caller at a time computes each of them."""
     keys = set(keys)
     s_keys = dict((str(k), k) for k in keys)
     r = cache.get_multi(s_keys.keys(), prefix)
     if miss_fn and len(r.keys()) < len(keys):
         need = set(s_keys.keys()) - set(r.keys())
-        #TODO i can't send a generator
-        nr = miss_fn([s_keys[i] for i in need])
-        nr = dict((str(k), v) for k,v in nr.iteritems())
-        r.update(nr)
-        cache.set_multi(nr, prefix, time = time)
+        def str_miss_fn(need):
+            #TODO i can't send a generator
+            nr = miss_fn([s_keys[i] for i in need])
+            return dict((str(k), v) for k,v in nr.iteritems())
+        if single_flight:
+            r.update(flights.fill_multi(cache, need, str_miss_fn, prefix,
+                                        time = time))
+        else:
+            nr = str_miss_fn(need)
+            r.update(nr)
+            cache.backfill_multi(nr, prefix, time = time)
 
     return dict((s_keys[k], v) for k,v in r.iteritems())
 
@@ -221,19 +618,3 @@ def test_cache(cache):
     cache.incr_multi(('5', '6'), 1)
     assert(cache.get('5'), 5)    
     assert(cache.get('6'), 2)
-
-# a cache that occasionally dumps itself to be used for long-running
-# processes
-class SelfEmptyingCache(LocalCache):
-    def __init__(self,max_size=100*1000):
-        self.max_size = max_size
-
-    def maybe_reset(self):
-        if len(self) > self.max_size:
-            self.clear()
-
-    def set(self,key,val,time = 0):
-        self.maybe_reset()
-        return LocalCache.set(self,key,val,time)
-    def add(self,key,val):
-        return self.set(key,val)
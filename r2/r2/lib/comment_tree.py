@@ -25,12 +25,47 @@ from pylons import g
 
 from r2.models import *
 
+from r2.lib.db import sorts
+from r2.lib.db.sorts import epoch_seconds
+from r2.lib.lock import TimeoutExpired
+from bisect import bisect_left
+from threading import Thread, Lock
+import time, atexit
+
+#the most deltas appended to a link's tree before it's rewritten whole
+max_deltas = 100
+
+#seconds between applying the queued comment votes to the trees
+vote_interval = 10
+
+#the sorts the tree keeps child orders for, as functions of (ups,
+#downs, date in epoch seconds). the date sorts use comment_tree's own
+#order, which is by id.
+tree_sorts = dict(_hot = sorts.epoch_hot,
+                  _score = lambda ups, downs, date: sorts.score(ups, downs),
+                  _controversy = lambda ups, downs, date:
+                      sorts.controversy(ups, downs))
+
 def comments_key(link_id):
     return 'comments_' + str(link_id)
 
+def delta_key(link_id):
+    return 'comments_delta_' + str(link_id)
+
 def lock_key(link_id):
     return 'comment_lock_' + str(link_id)
 
+def comment_votes(comment):
+    """What the tree keeps about a comment to sort it."""
+    return (comment._ups, comment._downs, epoch_seconds(comment._date))
+
+def sort_key(col, votes, rev = True):
+    """The key a comment with votes sorts by in the col order, ascending
+    keys first, matching CommentBuilder.sort_key."""
+    ups, downs, date = votes
+    sign = -1 if rev else 1
+    return (sign * tree_sorts[col](ups, downs, date), sign * date)
+
 def add_comment(comment):
     with g.make_lock(lock_key(comment.link_id)):
         add_comment_nolock(comment)
@@ -39,14 +74,103 @@ def add_comment_nolock(comment):
     cm_id = comment._id
     p_id = comment.parent_id if hasattr(comment, 'parent_id') else None
     link_id = comment.link_id
+    votes = comment_votes(comment)
+
+    r, num_deltas = _link_comments(link_id)
+    if cm_id in r[4]:
+        return
+
+    add_to_tree(r, cm_id, p_id, votes)
+
+    save_tree(link_id, r, num_deltas,
+              '%d,%s;' % (cm_id, p_id or '') + vote_delta(cm_id, votes))
+
+class VoteUpdates(object):
+    """Collects comments' new votes and moves them to their new places
+    among their siblings in the tree's sort orders every interval
+    seconds, from a background thread. Each link's tree is locked, read
+    and saved once per interval however many of its comments were
+    voted on, and never from the request doing the voting."""
+    def __init__(self, interval):
+        self.interval = interval
+        self.lock = Lock()
+        #link id -> {comment id: votes}
+        self.pending = {}
+        self.thread = None
+
+    def add(self, link_id, cm_id, votes):
+        with self.lock:
+            self.pending.setdefault(link_id, {})[cm_id] = votes
+            if not self.thread:
+                self.thread = Thread(target = self._run)
+                self.thread.setDaemon(True)
+                self.thread.start()
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        for link_id, votes in pending.iteritems():
+            try:
+                apply_votes(link_id, votes)
+            except Exception, e:
+                #the orders catch up on the comment's next vote
+                g.log.error('comment tree votes for %d failed: %r'
+                            % (link_id, e))
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self.flush()
+
+vote_updates = VoteUpdates(vote_interval)
+atexit.register(vote_updates.flush)
+
+def update_comment_votes(comment):
+    """Queues a comment's new votes to be applied to its link's tree,
+    see VoteUpdates."""
+    vote_updates.add(comment.link_id, comment._id, comment_votes(comment))
+
+def apply_votes(link_id, votes):
+    """Repositions the comments in votes, a dict of comment id to votes,
+    in the link's tree with one save."""
+    with g.make_lock(lock_key(link_id)):
+        r, num_deltas = _link_comments(link_id)
+        delta = ''
+        for cm_id, v in votes.iteritems():
+            if cm_id in r[4] and r[5]['votes'].get(cm_id) != v:
+                reposition(r, cm_id, v)
+                delta += vote_delta(cm_id, v)
+
+        if delta:
+            save_tree(link_id, r, num_deltas, delta)
+
+def vote_delta(cm_id, votes):
+    return 'v%d,%d,%d,%r;' % ((cm_id,) + votes)
 
-    cids, comment_tree, depth, num_children = link_comments(link_id)
+def save_tree(link_id, r, num_deltas, delta):
+    """Stores a change to a link's tree. Must be called with the link's
+    lock held."""
+    #append the change to the link's deltas rather than rewriting the
+    #whole tree, until there are enough of them to be worth folding
+    #back in
+    if g.comment_tree_deltas and num_deltas < max_deltas:
+        key = delta_key(link_id)
+        if not g.permacache.append(key, delta):
+            g.permacache.set(key, delta)
+    else:
+        g.permacache.set(comments_key(link_id), r)
+        g.permacache.delete(delta_key(link_id))
+
+def add_to_tree(r, cm_id, p_id, votes):
+    """Adds a comment to the tuple returned by link_comments in place."""
+    cids, comment_tree, depth, num_children, parents, orders = r
 
     #add to comment list
-    cids.append(comment._id)
+    cids.append(cm_id)
 
     #add to tree
     comment_tree.setdefault(p_id, []).append(cm_id)
+    parents[cm_id] = p_id
 
     #add to depth
     depth[cm_id] = depth[p_id] + 1 if p_id else 0
@@ -54,79 +178,184 @@ def add_comment_nolock(comment):
     #update children
     num_children[cm_id] = 0
 
-    #dfs to find the list of parents for the new comment
-    def find_parents():
-        stack = [cid for cid in comment_tree[None]]
-        parents = []
-        while stack:
-            cur_cm = stack.pop()
-            if cur_cm == cm_id:
-                return parents
-            elif comment_tree.has_key(cur_cm):
-                #make cur_cm the end of the parents list
-                parents = parents[:depth[cur_cm]] + [cur_cm]
-                for child in comment_tree[cur_cm]:
-                    stack.append(child)
-
-
-    #if this comment had a parent, find the parent's parents
-    if p_id:
-        for p_id in find_parents():
-            num_children[p_id] += 1
-
-    g.permacache.set(comments_key(link_id),
-                     (cids, comment_tree, depth, num_children))
+    #add to the sort orders
+    reposition(r, cm_id, votes)
+
+    #walk up the parents to count the new comment
+    while p_id:
+        num_children[p_id] += 1
+        p_id = parents.get(p_id)
+
+def reposition(r, cm_id, votes):
+    """Sets a comment's votes and puts it in its place among its
+    siblings in each of the tree's sort orders."""
+    sort_data = r[5]
+    all_votes = sort_data['votes']
+    all_votes[cm_id] = votes
+    p_id = r[4][cm_id]
+    for col, orders in sort_data['orders'].iteritems():
+        siblings = orders.setdefault(p_id, [])
+        if cm_id in siblings:
+            siblings.remove(cm_id)
+        keys = SiblingKeys(siblings, col, all_votes)
+        siblings.insert(bisect_left(keys, sort_key(col, votes)), cm_id)
+
+class SiblingKeys(object):
+    """The sort keys of a list of sibling ids in the col order, computed
+    only for the positions bisect reads."""
+    def __init__(self, siblings, col, votes):
+        self.siblings = siblings
+        self.col = col
+        self.votes = votes
+
+    def __len__(self):
+        return len(self.siblings)
+
+    def __getitem__(self, i):
+        return sort_key(self.col, self.votes[self.siblings[i]])
+
+def make_sort_data(comment_tree, votes):
+    """The votes of each comment and, for each of tree_sorts, a dict of
+    parent id to its children's ids in that order."""
+    orders = {}
+    for col in tree_sorts:
+        key = lambda x: sort_key(col, votes[x])
+        orders[col] = dict((p_id, sorted(children, key = key))
+                           for p_id, children in comment_tree.iteritems())
+    return dict(votes = votes, orders = orders)
+
+def subtree(comment_tree, cm_ids):
+    """The ids of the comments in cm_ids and all of their descendants."""
+    found = list(cm_ids)
+    i = 0
+    while i < len(found):
+        found.extend(comment_tree.get(found[i], ()))
+        i += 1
+    return found
 
 def delete_comment(comment):
     #nothing really to do here, atm
     pass
 
 def link_comments(link_id):
+    """Returns (cids, comment_tree, depth, num_children, parents,
+    sort_data) for the comments on a link. parents maps each comment to
+    its parent's id (None for top level comments). sort_data is
+    described in make_sort_data."""
+    return _link_comments(link_id)[0]
+
+def _link_comments(link_id):
+    """link_comments plus the number of deltas applied to the stored
+    tree."""
     key = comments_key(link_id)
-    r = g.permacache.get(key)
-    if r:
-        return r
+    d_key = delta_key(link_id)
+    r = g.permacache.get_multi([key, d_key])
+    if r.get(key):
+        tree = r[key]
+        if len(tree) < 6:
+            #stored before the tree had parent pointers or sort orders
+            tree = upgrade_tree(link_id, tree)
+
+        deltas = [x.split(',') for x in (r.get(d_key) or '').split(';') if x]
+        for delta in deltas:
+            #the tree may have been rewritten with these changes in it
+            #before the deltas were cleared, applying them is harmless
+            if delta[0].startswith('v'):
+                cm_id = int(delta[0][1:])
+                if cm_id in tree[4]:
+                    reposition(tree, cm_id, (int(delta[1]), int(delta[2]),
+                                             float(delta[3])))
+            else:
+                cm_id = int(delta[0])
+                if cm_id not in tree[4]:
+                    p_id = int(delta[1]) if delta[1] else None
+                    #votes follow in their own delta
+                    add_to_tree(tree, cm_id, p_id, (0, 0, 0.))
+
+        #so that the next reads don't replay them again
+        if deltas and compact_tree(link_id, tree, r[d_key]):
+            return tree, 0
+        return tree, len(deltas)
     else:
         with g.make_lock(lock_key(link_id)):
             r = load_link_comments(link_id)
             g.permacache.set(key, r)
-        return r
+            g.permacache.delete(d_key)
+        return r, 0
+
+def compact_tree(link_id, tree, deltas):
+    """Stores a tree that has had deltas applied to it in place of the
+    stored tree and deltas. Gives up, returning False, if the link is
+    locked or more deltas were appended since deltas was read."""
+    try:
+        with g.make_lock(lock_key(link_id), timeout = 0):
+            if g.permacache.get(delta_key(link_id)) != deltas:
+                return False
+            g.permacache.set(comments_key(link_id), tree)
+            g.permacache.delete(delta_key(link_id))
+            return True
+    except TimeoutExpired:
+        return False
+
+def upgrade_tree(link_id, tree):
+    """Adds the parent pointers and sort orders to a tree stored
+    without them, and stores it again."""
+    cids, comment_tree, depth, num_children = tree[:4]
+    if len(tree) > 4:
+        parents = tree[4]
+    else:
+        parents = dict((cid, p_id)
+                       for p_id, children in comment_tree.iteritems()
+                       for cid in children)
+    found = link_comment_votes(link_id)[1]
+    #anything missing from the db sorts last
+    votes = dict((cm_id, found.get(cm_id, (0, 0, 0.))) for cm_id in cids)
+    tree = (cids, comment_tree, depth, num_children, parents,
+            make_sort_data(comment_tree, votes))
+    with g.make_lock(lock_key(link_id)):
+        g.permacache.set(comments_key(link_id), tree)
+    return tree
+
+def link_comment_votes(link_id):
+    """The parent id and the votes of every comment on a link, as two
+    dicts by comment id, from one narrow query rather than loading the
+    comments."""
+    rows = Comment._data_values('link_id', link_id, 'parent_id',
+                                thing_cols = ('ups', 'downs', 'date'))
+    parents = dict((row[0], row[1]) for row in rows)
+    votes = dict((row[0], (row[2], row[3], epoch_seconds(row[4])))
+                 for row in rows)
+    return parents, votes
 
 def load_link_comments(link_id):
-    q = Comment._query(Comment.c.link_id == link_id,
-                       Comment.c._deleted == (True, False),
-                       Comment.c._spam == (True, False),
-                       data = True)
-    comments = list(q)
-    cids = [c._id for c in comments]
+    #only the parent ids and votes are needed to build the tree
+    parents, votes = link_comment_votes(link_id)
+    cids = sorted(parents)
 
     #make a tree
     comment_tree = {}
-    for cm in comments:
-        p_id = cm.parent_id if hasattr(cm, 'parent_id') else None
-        comment_tree.setdefault(p_id, []).append(cm._id)
+    for cm_id in cids:
+        comment_tree.setdefault(parents[cm_id], []).append(cm_id)
 
-    #calculate the depths
+    #calculate the depths and the number of children in one post-order
+    #pass. comments whose parent is missing get a child count but no
+    #depth, like top level comments' descendants do.
     depth = {}
-    level = 0
-    cur_level = comment_tree.get(None, ())
-    while cur_level:
-        next_level = []
-        for cm_id in cur_level:
-            depth[cm_id] = level
-            next_level.extend(comment_tree.get(cm_id, ()))
-        cur_level = next_level
-        level += 1
-
-    #calc the number of children
     num_children = {}
-    for cm_id in cids:
-        num = 0
-        todo = [cm_id]
-        while todo:
-            more = comment_tree.get(todo.pop(0), ())
-            num += len(more)
-            todo.extend(more)
-        num_children[cm_id] = num
-
-    return cids, comment_tree, depth, num_children
+    stack = [(cm_id, 0 if parents[cm_id] is None else None, False)
+             for cm_id in reversed(cids) if parents[cm_id] not in parents]
+    while stack:
+        cm_id, level, visited = stack.pop()
+        children = comment_tree.get(cm_id, ())
+        if visited:
+            num_children[cm_id] = sum(num_children[child] + 1
+                                      for child in children)
+        else:
+            if level is not None:
+                depth[cm_id] = level
+                level += 1
+            stack.append((cm_id, level, True))
+            stack.extend((child, level, False) for child in children)
+
+    return (cids, comment_tree, depth, num_children, parents,
+            make_sort_data(comment_tree, votes))
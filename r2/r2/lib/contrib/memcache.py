@@ -45,8 +45,13 @@ More detailed documentation is available in the L{Client} class.
 
 import sys
 import socket
+import select
+import errno
 import time
 import types
+import struct
+import threading
+from bisect import bisect_left
 from md5 import md5
 try:
     import cPickle as pickle
@@ -54,7 +59,7 @@ except ImportError:
     import pickle
 
 try:
-    from zlib import compress, decompress
+    from zlib import compress as compress_fn, decompress
     _supports_compress = True
 except ImportError:
     _supports_compress = False
@@ -87,6 +92,149 @@ except ImportError:
     class local(object):
         pass
 
+class _ConnectionPool(object):
+    """Sockets to one server shared by every thread's _Host for it, at
+    most max_size of them kept open. get() waits up to timeout seconds
+    for a free one, then opens one past the limit rather than fail the
+    call, which put() closes again."""
+    def __init__(self, address, max_size, timeout):
+        self.address = address
+        self.max_size = max_size
+        self.timeout = timeout
+        self.free = []
+        self.size = 0
+        self.waits = self.timeouts = 0
+        self.cond = threading.Condition()
+
+    def get(self):
+        self.cond.acquire()
+        try:
+            deadline = None
+            while not self.free and self.size >= self.max_size:
+                if deadline is None:
+                    deadline = time.time() + self.timeout
+                    self.waits += 1
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self.timeouts += 1
+                    break
+                self.cond.wait(remaining)
+            if self.free:
+                return self.free.pop()
+            self.size += 1
+        finally:
+            self.cond.release()
+
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            s.connect(self.address)
+        except socket.error:
+            self.discard()
+            raise
+        return s
+
+    def put(self, s):
+        self.cond.acquire()
+        try:
+            if self.size > self.max_size:
+                #one opened past the limit
+                self.size -= 1
+            else:
+                self.free.append(s)
+                self.cond.notify()
+                s = None
+        finally:
+            self.cond.release()
+        if s:
+            s.close()
+
+    def discard(self):
+        """Forget a socket that was closed instead of put back."""
+        self.cond.acquire()
+        try:
+            self.size -= 1
+            self.cond.notify()
+        finally:
+            self.cond.release()
+
+    def stats(self):
+        return dict(open = self.size, free = len(self.free),
+                    waits = self.waits, timeouts = self.timeouts)
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def _get_pool(ip, port, binary, max_size, timeout):
+    """The process-wide pool for a server. Binary and text connections
+    are kept apart since memcached fixes a connection's protocol when
+    it reads the first command."""
+    key = (ip, port, binary)
+    _pools_lock.acquire()
+    try:
+        if key not in _pools:
+            _pools[key] = _ConnectionPool((ip, port), max_size, timeout)
+        return _pools[key]
+    finally:
+        _pools_lock.release()
+
+# the binary protocol: every request and response is a 24 byte header
+# followed by extras, key and value. the quiet ops only respond on a
+# failure (or for GETKQ, a hit), so a multi-get is a GETKQ per key with
+# a NOOP at the end to say it's done.
+_BIN_HEADER = struct.Struct('!BBHBBHLLQ')
+_BIN_HEADER_LEN = _BIN_HEADER.size
+_BIN_REQUEST = 0x80
+_BIN_RESPONSE = 0x81
+_BIN_OPS = dict(get = 0x00, set = 0x01, add = 0x02, replace = 0x03,
+                delete = 0x04, incr = 0x05, decr = 0x06, flush_all = 0x08,
+                noop = 0x0a, getkq = 0x0d, append = 0x0e, stats = 0x10,
+                setq = 0x11, addq = 0x12, deleteq = 0x14)
+_BIN_NOT_FOUND = 0x01
+
+def _bin_request(op, key='', extras='', value='', opaque=0):
+    return (_BIN_HEADER.pack(_BIN_REQUEST, _BIN_OPS[op], len(key),
+                             len(extras), 0, 0,
+                             len(extras) + len(key) + len(value), opaque, 0)
+            + extras + key + value)
+
+def _bin_parse(buf, pos=0):
+    """Parse the response at buf[pos:] into (end, opcode, status, opaque,
+    extras, key, value), or None if it isn't all there yet."""
+    if len(buf) < pos + _BIN_HEADER_LEN:
+        return None
+    (magic, op, keylen, extlen, datatype, status, bodylen, opaque,
+     cas) = _BIN_HEADER.unpack_from(buf, pos)
+    if magic != _BIN_RESPONSE:
+        raise _Error("bad response magic %x" % magic)
+    start = pos + _BIN_HEADER_LEN
+    end = start + bodylen
+    if len(buf) < end:
+        return None
+    return (end, op, status, opaque, buf[start:start + extlen],
+            buf[start + extlen:start + extlen + keylen],
+            buf[start + extlen + keylen:end])
+
+def _releasing(fn):
+    """Wraps a Client call to give the pooled sockets it used back when
+    it's done, or close them if it failed partway through a reply."""
+    def wrapper(self, *a, **kw):
+        if not self.pool_size:
+            return fn(self, *a, **kw)
+        clean = False
+        try:
+            result = fn(self, *a, **kw)
+            clean = True
+            return result
+        except (ValueError, Client.MemcachedKeyError,
+                Client.MemcachedStringEncodingError):
+            clean = True
+            raise
+        finally:
+            self._release_all(clean)
+    wrapper.__name__ = fn.__name__
+    wrapper.__doc__ = fn.__doc__
+    return wrapper
+
 
 class Client(local):
     """
@@ -115,6 +263,7 @@ class Client(local):
     _FLAG_COMPRESSED = 1<<3
 
     _SERVER_RETRIES = 10  # how many times to try finding a free server.
+    _IO_TIMEOUT = 3  # seconds a pipelined request waits without any progress.
 
     # exceptions for Client
     class MemcachedKeyError(Exception):
@@ -126,20 +275,41 @@ class Client(local):
     class MemcachedStringEncodingError(Exception):
         pass
 
-    def __init__(self, servers, debug=0):
+    def __init__(self, servers, debug=0, pipeline=False, hashing='modulo',
+                 old_servers=None, old_hashing=None, binary=False,
+                 pool_size=0, serializer=None):
         """
         Create a new Client object with the given list of servers.
 
         @param servers: C{servers} is passed to L{set_servers}.
         @param debug: whether to display error messages when a server can't be
         contacted.
+        @param pipeline: whether L{get_multi} and L{set_multi} overlap their
+        I/O across servers instead of reading each server's reply in turn.
+        @param hashing: how keys are placed on servers, 'modulo' or 'ketama'.
+        See L{_Placement}.
+        @param old_servers, old_hashing: the placement being migrated from,
+        passed to L{set_servers}.
+        @param binary: whether to speak memcached's binary protocol instead
+        of the text one.
+        @param pool_size: if set, the client's threads share at most this
+        many sockets to each server (per protocol) instead of every thread
+        keeping its own open. A call takes a socket for each server it
+        uses and gives it back when it returns.
+        @param serializer: the L{Serializer} values are stored with, by
+        default protocol 1 pickles that are never compressed.
         """
         local.__init__(self)
-        self.set_servers(servers)
+        self.serializer = serializer or Serializer()
+        self.hashing = hashing
+        self.binary = binary
+        self.pool_size = pool_size
+        self.set_servers(servers, old_servers, old_hashing)
         self.debug = debug
+        self.pipeline = pipeline
         self.stats = {}
 
-    def set_servers(self, servers):
+    def set_servers(self, servers, old_servers=None, old_hashing=None):
         """
         Set the pool of servers used by this client.
 
@@ -148,10 +318,35 @@ class Client(local):
             1. Strings of the form C{"host:port"}, which implies a default weight of 1.
             2. Tuples of the form C{("host:port", weight)}, where C{weight} is
             an integer weight value.
+        @param old_servers, old_hashing: if either is given, the client is
+        migrating from that placement (defaulting to the new servers or
+        hashing): keys that miss are looked for where the old placement
+        put them, and deletes go to both. Writes only go to the new one.
         """
-        self.servers = [_Host(s, self.debuglog) for s in servers]
-        self._init_buckets()
-
+        hosts = {}
+        def make_hosts(servers):
+            out = []
+            for s in servers:
+                host = _Host(s, self.debuglog)
+                if (host.ip, host.port) not in hosts and self.pool_size:
+                    host.pool = _get_pool(host.ip, host.port, self.binary,
+                                          self.pool_size, self._IO_TIMEOUT)
+                out.append((hosts.setdefault((host.ip, host.port), host),
+                            host.weight))
+            return out
+
+        new = make_hosts(servers)
+        self.servers = [host for host, weight in new]
+        self.placement = _Placement(new, self.hashing)
+        self.buckets = self.placement.buckets
+
+        self.old_placement = None
+        if old_servers is not None or old_hashing:
+            old = make_hosts(old_servers) if old_servers is not None else new
+            self.old_placement = _Placement(old, old_hashing or self.hashing)
+        self.all_servers = hosts.values()
+
+    @_releasing
     def get_stats(self):
         '''Get statistics from each of the servers.
 
@@ -164,9 +359,16 @@ class Client(local):
         for s in self.servers:
             if not s.connect(): continue
             name = '%s:%s (%s)' % ( s.ip, s.port, s.weight )
-            s.send_cmd('stats')
             serverData = {}
             data.append(( name, serverData ))
+            if self.binary:
+                s.send_cmds(_bin_request('stats'))
+                while 1:
+                    op, status, opaque, extras, key, value = s.read_binary()
+                    if not key: break
+                    serverData[key] = value
+                continue
+            s.send_cmd('stats')
             readline = s.readline
             while 1:
                 line = readline()
@@ -176,13 +378,27 @@ class Client(local):
 
         return(data)
 
+    @_releasing
     def flush_all(self):
         'Expire all data currently in the memcache servers.'
-        for s in self.servers:
+        for s in self.all_servers:
             if not s.connect(): continue
+            if self.binary:
+                s.send_cmds(_bin_request('flush_all'))
+                s.read_binary()
+                continue
             s.send_cmd('flush_all')
             s.expect("OK")
 
+    def _release_all(self, clean=True):
+        for s in self.all_servers:
+            s.release(clean)
+
+    def pool_stats(self):
+        """The connection pool stats for each server, if pooling."""
+        return dict(('%s:%s' % (s.ip, s.port), s.pool.stats())
+                    for s in self.all_servers if s.pool)
+
     def debuglog(self, str):
         if self.debug:
             sys.stderr.write("MemCached: %s\n" % str)
@@ -197,48 +413,31 @@ class Client(local):
         """
         Reset every host in the pool to an "alive" state.
         """
-        for s in self.servers:
+        for s in self.all_servers:
             s.dead_until = 0
 
-    def _init_buckets(self):
-        self.buckets = []
-        for server in self.servers:
-            for i in range(server.weight):
-                self.buckets.append(server)
-
-    def _get_server(self, key):
+    def _get_server(self, key, placement=None):
         if type(key) == types.TupleType:
             serverhash, key = key
         else:
-            serverhash = serverHashFunction(key)
+            serverhash = None
 
-        # the original version suffered from a failure rate of
-        # 1 in n^_SERVER_RETRIES, where n = number of bukets
-        # if one server is down.  This is particularly bad for
-        # n = 2, and the hashing is poor enough to guarantee
-        # that making _SERVER_RETRIES larger doesn't help.
-
-        #make a copy
-        good_servers = list(self.buckets)
-        while good_servers:
-            server = good_servers.pop(serverhash % len(good_servers))
+        for server in (placement or self.placement).candidates(key, serverhash):
             if server.connect():
                 return server, key
 
-        # removed by chris
-        #for i in range(Client._SERVER_RETRIES):
-        #    server = self.buckets[serverhash % len(self.buckets)]
-        #    if server.connect():
-        #        #print "(using server %s)" % server,
-        #        return server, key
-        #    serverhash = serverHashFunction(str(serverhash) + str(i))
-
         return None, key
 
+    def _moved(self, server, key):
+        """Whether server, where another placement puts key, isn't where
+        the current placement puts it."""
+        return server and server is not self._get_server(key)[0]
+
     def disconnect_all(self):
-        for s in self.servers:
+        for s in self.all_servers:
             s.close_socket()
 
+    @_releasing
     def delete_multi(self, keys, seconds=0, key_prefix=''):
         '''
         Delete multiple keys in the memcache doing just one query.
@@ -267,8 +466,36 @@ class Client(local):
         '''
 
         self._statlog('delete_multi')
-
-        server_keys, prefixed_to_orig_key = self._map_and_prefix_keys(keys, key_prefix)
+        if self.old_placement:
+            keys = list(keys)
+            self._delete_multi(keys, seconds, key_prefix, self.old_placement)
+        return self._delete_multi(keys, seconds, key_prefix)
+
+    def _delete_multi(self, keys, seconds, key_prefix, placement=None):
+        server_keys, prefixed_to_orig_key = self._map_and_prefix_keys(
+            keys, key_prefix, placement, only_moved = placement is not None)
+
+        if self.binary:
+            # quiet deletes only answer when the key wasn't there
+            def parse(server):
+                pos = 0
+                while True:
+                    r = _bin_parse(server.buffer, pos)
+                    if not r:
+                        break
+                    pos = r[0]
+                    if r[1] == _BIN_OPS['noop']:
+                        server.buffer = server.buffer[pos:]
+                        return True
+                server.buffer = server.buffer[pos:]
+                return False
+            requests = {}
+            for server, keys in server_keys.iteritems():
+                requests[server] = (''.join(_bin_request('deleteq', key)
+                                            for key in keys)
+                                    + _bin_request('noop'))
+            self._pipeline(requests, parse)
+            return 1
 
         # send out all requests on each server before reading anything
         dead_servers = []
@@ -304,6 +531,7 @@ class Client(local):
                 rc = 0
         return rc
 
+    @_releasing
     def delete(self, key, time=0):
         '''Deletes a key from the memcache.
 
@@ -311,8 +539,15 @@ class Client(local):
         @param seconds: number of seconds any subsequent set / update commands should fail. Defaults to 0 for no delay.
         @rtype: int
         '''
-        server, key = self._get_server(key)
-        key = check_key(key)
+        if self.old_placement:
+            self._delete(key, time, self.old_placement)
+        return self._delete(key, time)
+
+    def _delete(self, key, time=0, placement=None):
+        server, skey = self._get_server(key, placement)
+        if placement and not self._moved(server, key):
+            return 0
+        key = check_key(skey)
         if not server:
             return 0
         self._statlog('delete')
@@ -322,6 +557,11 @@ class Client(local):
             cmd = "delete %s" % key
 
         try:
+            if self.binary:
+                # binary deletes can't be delayed, time is ignored
+                server.send_cmds(_bin_request('delete', key))
+                server.read_binary()
+                return 1
             server.send_cmd(cmd)
             server.expect("DELETED")
         except socket.error, msg:
@@ -329,6 +569,7 @@ class Client(local):
             return 0
         return 1
 
+    @_releasing
     def incr(self, key, delta=1):
         """
         Sends a command to the server to atomically increment the value for C{key} by
@@ -354,6 +595,7 @@ class Client(local):
         """
         return self._incrdecr("incr", key, delta)
 
+    @_releasing
     def decr(self, key, delta=1):
         """
         Like L{incr}, but decrements.  Unlike L{incr}, underflow is checked and
@@ -372,6 +614,19 @@ class Client(local):
         if not server:
             return 0
         self._statlog(cmd)
+        if self.binary:
+            try:
+                # an expiration of all ones fails if the key isn't there
+                server.send_cmds(_bin_request(cmd, key, struct.pack(
+                    '!QQL', delta, 0, 0xffffffff)))
+                op, status, opaque, extras, rkey, value = server.read_binary()
+            except (_Error, socket.error), msg:
+                server.mark_dead(msg)
+                return None
+            if status:
+                # like int('NOT_FOUND') in the text protocol
+                raise ValueError(value)
+            return int(struct.unpack('!Q', value)[0])
         cmd = "%s %s %d" % (cmd, key, delta)
         try:
             server.send_cmd(cmd)
@@ -381,6 +636,7 @@ class Client(local):
             server.mark_dead(msg[1])
             return None
 
+    @_releasing
     def add(self, key, val, time=0):
         '''
         Add new key with value.
@@ -391,6 +647,7 @@ class Client(local):
         @rtype: int
         '''
         return self._set("add", key, val, time)
+    @_releasing
     def replace(self, key, val, time=0, min_compress_len=0):
         '''Replace existing key with value.
 
@@ -401,6 +658,18 @@ class Client(local):
         @rtype: int
         '''
         return self._set("replace", key, val, time, min_compress_len)
+    @_releasing
+    def append(self, key, val, time=0):
+        '''Append val to the end of an existing key's value.
+
+        Only makes sense for string values, the flags of the existing
+        value are kept.
+
+        @return: Nonzero on success.
+        @rtype: int
+        '''
+        return self._set("append", key, val, time)
+    @_releasing
     def set(self, key, val, time=0, min_compress_len=0):
         '''Unconditionally sets a key to a given value in the memcache.
 
@@ -427,11 +696,13 @@ class Client(local):
         return self._set("set", key, val, time, min_compress_len)
 
 
-    def _map_and_prefix_keys(self, key_iterable, key_prefix):
+    def _map_and_prefix_keys(self, key_iterable, key_prefix, placement=None,
+                             only_moved=False):
         """Compute the mapping of server (_Host instance) -> list of keys to stuff onto that server, as well as the mapping of
         prefixed key -> original key.
 
-
+        With only_moved, keys that placement puts on the same server as
+        the current placement are left out.
         """
         # Check it just once ...
         key_extra_len=len(key_prefix)
@@ -449,10 +720,11 @@ class Client(local):
                 # Tuple of hashvalue, key ala _get_server(). Caller is essentially telling us what server to stuff this on.
                 # Ensure call to _get_server gets a Tuple as well.
                 str_orig_key = str(orig_key[1])
-                server, key = self._get_server((orig_key[0], key_prefix + str_orig_key)) # Gotta pre-mangle key before hashing to a server. Returns the mangled key.
+                hash_key = (orig_key[0], key_prefix + str_orig_key) # Gotta pre-mangle key before hashing to a server.
             else:
                 str_orig_key = str(orig_key) # set_multi supports int / long keys.
-                server, key = self._get_server(key_prefix + str_orig_key)
+                hash_key = key_prefix + str_orig_key
+            server, key = self._get_server(hash_key, placement)
 
             # Now check to make sure key length is proper ...
             #changed by steve
@@ -461,6 +733,8 @@ class Client(local):
 
             if not server:
                 continue
+            if only_moved and not self._moved(server, hash_key):
+                continue
 
             if not server_keys.has_key(server):
                 server_keys[server] = []
@@ -469,6 +743,7 @@ class Client(local):
 
         return (server_keys, prefixed_to_orig_key)
 
+    @_releasing
     def set_multi(self, mapping, time=0, key_prefix='', min_compress_len=0):
         '''
         Sets multiple keys in the memcache doing just one query.
@@ -510,35 +785,111 @@ class Client(local):
 
         '''
 
+        stored = {}
+        for key, val in mapping.iteritems():
+            name = key[1] if type(key) is types.TupleType else key
+            stored[key] = self._val_to_store_info(val, min_compress_len,
+                                                  key_prefix + str(name))
+        return Client.set_stored_multi(self, stored, time, key_prefix)
+
+    @_releasing
+    def set_stored_multi(self, stored, time=0, key_prefix='', cmd='set'):
+        '''
+        L{set_multi} for values that have already been through
+        L{_val_to_store_info}, so they can be serialized in one thread and
+        sent from another. With cmd 'add', keys that already exist are
+        left alone and returned as not stored.
+
+        @return: List of keys which failed to be stored.
+        @rtype: list
+        '''
+
         self._statlog('set_multi')
 
+        server_keys, prefixed_to_orig_key = self._map_and_prefix_keys(stored.iterkeys(), key_prefix)
+
+        # build every server's commands, skipping values too big to store
+        cmds = {}
+        sent = {}
+        for server, keys in server_keys.iteritems():
+            bigcmd = []
+            write = bigcmd.append
+            server_sent = []
+            for key in keys: # These are mangled keys
+                store_info = stored[prefixed_to_orig_key[key]]
+                if not store_info:
+                    continue
+                if self.binary:
+                    # the opaque says which key a failure is for
+                    write(_bin_request(cmd + 'q', key,
+                                       struct.pack('!LL', store_info[0], time),
+                                       store_info[2], len(server_sent)))
+                else:
+                    write("%s %s %d %d %d\r\n%s\r\n" % (cmd, key, store_info[0], time, store_info[1], store_info[2]))
+                server_sent.append(key)
+            if server_sent:
+                if self.binary:
+                    write(_bin_request('noop'))
+                cmds[server] = ''.join(bigcmd)
+                sent[server] = server_sent
 
+        notstored = [] # original keys.
 
-        server_keys, prefixed_to_orig_key = self._map_and_prefix_keys(mapping.iterkeys(), key_prefix)
+        if self.binary:
+            def parse(server):
+                keys = sent[server]
+                pos = 0
+                done = False
+                while True:
+                    r = _bin_parse(server.buffer, pos)
+                    if not r:
+                        break
+                    pos, op, status, opaque = r[:4]
+                    if op == _BIN_OPS['noop']:
+                        done = True
+                        break
+                    notstored.append(prefixed_to_orig_key[keys[opaque]])
+                server.buffer = server.buffer[pos:]
+                return done
+            self._pipeline(cmds, parse)
+            return notstored
+
+        if self.pipeline:
+            replies = dict((server, 0) for server in sent)
+            def parse(server):
+                keys = sent[server]
+                n = replies[server]
+                buf = server.buffer
+                pos = 0
+                while n < len(keys):
+                    end = buf.find('\r\n', pos)
+                    if end < 0:
+                        break
+                    if buf[pos:end] != 'STORED':
+                        notstored.append(prefixed_to_orig_key[keys[n]]) #un-mangle.
+                    n += 1
+                    pos = end + 2
+                server.buffer = buf[pos:]
+                replies[server] = n
+                return n == len(keys)
+            self._pipeline(cmds, parse)
+            return notstored
 
         # send out all requests on each server before reading anything
         dead_servers = []
 
-        for server in server_keys.iterkeys():
-            bigcmd = []
-            write = bigcmd.append
+        for server, cmd in cmds.iteritems():
             try:
-                for key in server_keys[server]: # These are mangled keys
-                    store_info = self._val_to_store_info(mapping[prefixed_to_orig_key[key]], min_compress_len)
-                    if not store_info:
-                        continue
-                    write("set %s %d %d %d\r\n%s\r\n" % (key, store_info[0], time, store_info[1], store_info[2]))
-                server.send_cmds(''.join(bigcmd))
+                server.send_cmds(cmd)
             except socket.error, msg:
                 server.mark_dead(msg[1])
                 dead_servers.append(server)
 
         # if any servers died on the way, don't expect them to respond.
         for server in dead_servers:
-            del server_keys[server]
+            del sent[server]
 
-        notstored = [] # original keys.
-        for server, keys in server_keys.iteritems():
+        for server, keys in sent.iteritems():
             try:
                 for key in keys:
                     line = server.readline()
@@ -550,55 +901,119 @@ class Client(local):
                 server.mark_dead(msg)
         return notstored
 
-    @staticmethod
-    def _val_to_store_info(val, min_compress_len):
-        """
-           Transform val to a storable representation, returning a tuple of the flags, the length of the new value, and the new value itself.
-        """
-        flags = 0
-        if isinstance(val, str):
-            pass
-        elif isinstance(val, int):
-            flags |= Client._FLAG_INTEGER
-            val = "%d" % val
-            # force no attempt to compress this silly string.
-            min_compress_len = 0
-        elif isinstance(val, long):
-            flags |= Client._FLAG_LONG
-            val = "%d" % val
-            # force no attempt to compress this silly string.
-            min_compress_len = 0
-        else:
-            flags |= Client._FLAG_PICKLE
-            val = pickle.dumps(val, 1)  # Ack! JLR hacks it so that LinkedDict unpicling works w/o figuring out __reduce__.
+    def _pipeline(self, requests, parse):
+        """Send each server (a _Host) its request and parse the replies as
+        they arrive, so one slow server only delays its own keys.
+        requests maps server -> command string. parse(server) consumes
+        the complete replies in server.buffer and returns True once the
+        server has answered everything. Servers that fail or make no
+        progress for _IO_TIMEOUT seconds are marked dead."""
+        servers = {}
+        sending = {}
+        reading = {}
+        for server, cmd in requests.iteritems():
+            sock = server.socket
+            if not sock:
+                continue
+            sock.setblocking(0)
+            servers[sock] = server
+            sending[sock] = [cmd, 0]
+            reading[sock] = server
 
-        #  silently do not store if value length exceeds maximum
-        if len(val) >= SERVER_MAX_VALUE_LENGTH:
-            return (0)
+        def fail(sock, msg):
+            sending.pop(sock, None)
+            reading.pop(sock, None)
+            servers[sock].mark_dead(msg)
 
-        lv = len(val)
-        # We should try to compress if min_compress_len > 0 and we could import zlib and this string is longer than our min threshold.
-        if min_compress_len and _supports_compress and lv > min_compress_len:
-            comp_val = compress(val)
-            #Only retain the result if the compression result is smaller than the original.
-            if len(comp_val) < lv:
-                flags |= Client._FLAG_COMPRESSED
-                val = comp_val
+        try:
+            while reading:
+                try:
+                    r, w, x = select.select(reading.keys(), sending.keys(), [],
+                                            self._IO_TIMEOUT)
+                except select.error, msg:
+                    if msg[0] == errno.EINTR:
+                        continue
+                    raise
+
+                if not r and not w:
+                    for sock in reading.keys():
+                        fail(sock, 'timed out')
+                    break
+
+                for sock in w:
+                    cmd, pos = sending[sock]
+                    try:
+                        pos += sock.send(buffer(cmd, pos))
+                    except socket.error, msg:
+                        if msg[0] not in (errno.EAGAIN, errno.EINTR):
+                            fail(sock, msg)
+                        continue
+                    if pos < len(cmd):
+                        sending[sock][1] = pos
+                    else:
+                        del sending[sock]
 
-        return (flags, len(val), val)
+                for sock in r:
+                    server = reading.get(sock)
+                    if not server:
+                        continue
+                    try:
+                        data = sock.recv(65536)
+                    except socket.error, msg:
+                        if msg[0] not in (errno.EAGAIN, errno.EINTR):
+                            fail(sock, msg)
+                        continue
+                    if not data:
+                        fail(sock, 'Connection closed while reading from %s'
+                             % repr(server))
+                        continue
+                    server.buffer += data
+                    try:
+                        done = parse(server)
+                    except _Error, msg:
+                        fail(sock, msg)
+                        continue
+                    if done:
+                        del reading[sock]
+                        sending.pop(sock, None)
+        finally:
+            for sock, server in servers.iteritems():
+                if server.socket is sock:
+                    sock.setblocking(1)
+
+    def _val_to_store_info(self, val, min_compress_len, key=None,
+                           compress=True):
+        """
+           Transform val to a storable representation, returning a tuple of the flags, the length of the new value, and the new value itself.
+           See L{Serializer.dumps}.
+        """
+        return self.serializer.dumps(val, min_compress_len, key, compress)
 
     def _set(self, cmd, key, val, time, min_compress_len=0):
-        server, key = self._get_server(key)
-        key = check_key(key)
+        server, name = self._get_server(key)
+        key = check_key(name)
         if not server:
             return 0
 
         self._statlog(cmd)
 
-        store_info = self._val_to_store_info(val, min_compress_len)
+        # appending to a compressed value would corrupt it
+        store_info = self._val_to_store_info(val, min_compress_len, name,
+                                             compress = cmd != 'append')
         if not store_info:
             return 0
 
+        if self.binary:
+            extras = ''
+            if cmd != 'append':
+                extras = struct.pack('!LL', store_info[0], time)
+            try:
+                server.send_cmds(_bin_request(cmd, key, extras, store_info[2]))
+                return server.read_binary()[1] == 0
+            except (_Error, socket.error), msg:
+                server.mark_dead(msg)
+            return 0
+
         fullcmd = "%s %s %d %d %d\r\n%s" % (cmd, key, store_info[0], time, store_info[1], store_info[2])
         try:
             server.send_cmd(fullcmd)
@@ -607,18 +1022,38 @@ class Client(local):
             server.mark_dead(msg[1])
         return 0
 
+    @_releasing
     def get(self, key):
         '''Retrieves a key from the memcache.
 
         @return: The value or None.
         '''
-        server, key = self._get_server(key)
-        key = check_key(key)
+        value = self._get(key)
+        if value is None and self.old_placement:
+            value = self._get(key, self.old_placement)
+        return value
+
+    def _get(self, key, placement=None):
+        server, skey = self._get_server(key, placement)
+        if placement and not self._moved(server, key):
+            return None
+        key = check_key(skey)
         if not server:
             return None
 
         self._statlog('get')
 
+        if self.binary:
+            try:
+                server.send_cmds(_bin_request('get', key))
+                op, status, opaque, extras, rkey, value = server.read_binary()
+            except (_Error, socket.error), msg:
+                server.mark_dead(msg)
+                return None
+            if status:
+                return None
+            return self._decode_value(value, struct.unpack('!L', extras)[0])
+
         try:
             server.send_cmd("get %s" % key)
             rkey, flags, rlen, = self._expectvalue(server)
@@ -633,6 +1068,7 @@ class Client(local):
             return None
         return value
 
+    @_releasing
     def get_multi(self, keys, key_prefix=''):
         '''
         Retrieves multiple keys from the memcache doing just one query.
@@ -673,8 +1109,42 @@ class Client(local):
 
         self._statlog('get_multi')
 
-        server_keys, prefixed_to_orig_key = self._map_and_prefix_keys(keys,
-                                                                      key_prefix)
+        if not self.old_placement:
+            return self._get_multi(keys, key_prefix)
+
+        keys = list(keys)
+        retvals = self._get_multi(keys, key_prefix)
+        missing = [k for k in keys if k not in retvals]
+        if missing:
+            retvals.update(self._get_multi(missing, key_prefix,
+                                           self.old_placement))
+        return retvals
+
+    def _get_multi(self, keys, key_prefix, placement=None):
+        server_keys, prefixed_to_orig_key = self._map_and_prefix_keys(
+            keys, key_prefix, placement, only_moved = placement is not None)
+
+        if self.binary:
+            retvals = {}
+            def parse(server):
+                return self._parse_binary_values(server, prefixed_to_orig_key,
+                                                 retvals)
+            getkq = lambda key: _bin_request('getkq', key)
+            self._pipeline(dict((server, ''.join(map(getkq, keys))
+                                 + _bin_request('noop'))
+                                for server, keys in server_keys.iteritems()),
+                           parse)
+            return retvals
+
+        if self.pipeline:
+            retvals = {}
+            def parse(server):
+                return self._parse_values(server, prefixed_to_orig_key,
+                                          retvals)
+            self._pipeline(dict((server, "get %s\r\n" % " ".join(keys))
+                                for server, keys in server_keys.iteritems()),
+                           parse)
+            return retvals
 
         # send out all requests on each server before reading anything
         dead_servers = []
@@ -726,28 +1196,256 @@ class Client(local):
         if len(buf) == rlen:
             buf = buf[:-2]  # strip \r\n
 
+        return self._decode_value(buf, flags)
+
+    def _parse_values(self, server, prefixed_to_orig_key, retvals):
+        """Decode the complete VALUE replies in server.buffer into
+        retvals, leaving any partial one there. Returns True once the
+        END line has been read."""
+        buf = server.buffer
+        pos = 0
+        done = False
+        while True:
+            end = buf.find('\r\n', pos)
+            if end < 0:
+                break
+            line = buf[pos:end]
+            if line == 'END':
+                pos = end + 2
+                done = True
+                break
+            if line[:5] != 'VALUE':
+                raise _Error("unexpected response '%s'" % line)
+            resp, rkey, flags, rlen = line.split()[:4]
+            start = end + 2
+            stop = start + int(rlen)
+            if len(buf) < stop + 2:
+                break
+            retvals[prefixed_to_orig_key[rkey]] = \
+                self._decode_value(buf[start:stop], int(flags))
+            pos = stop + 2
+        server.buffer = buf[pos:]
+        return done
+
+    def _parse_binary_values(self, server, prefixed_to_orig_key, retvals):
+        """_parse_values for the GETKQ hits and closing NOOP of a binary
+        multi-get."""
+        buf = server.buffer
+        pos = 0
+        done = False
+        noop = _BIN_OPS['noop']
+        while True:
+            r = _bin_parse(buf, pos)
+            if not r:
+                break
+            pos, op, status, opaque, extras, key, value = r
+            if op == noop:
+                done = True
+                break
+            if not status:
+                flags = struct.unpack('!L', extras)[0]
+                retvals[prefixed_to_orig_key[key]] = \
+                    self._decode_value(value, flags)
+        server.buffer = buf[pos:]
+        return done
+
+    def _decode_value(self, buf, flags):
+        try:
+            return self.serializer.loads(flags, buf)
+        except Exception, e:
+            self.debuglog("couldn't decode value with flags %x: %s\n"
+                          % (flags, e))
+            return None
+
+
+class Serializer(object):
+    """Turns values into the (flags, length, data) stored in memcache and
+    back.
+
+    Strings are stored as they are and ints and longs as digits, so that
+    incr, decr and append work on them. Anything else is pickled with
+    protocol. Values longer than compress_len bytes are zlib compressed
+    if that makes them smaller, 0 never compresses. With track_sizes,
+    sizes() has the bytes set under each kind of key.
+    """
+    max_categories = 500
+
+    def __init__(self, protocol=1, compress_len=0, track_sizes=False):
+        self.protocol = protocol
+        self.compress_len = compress_len
+        self.track_sizes = track_sizes
+        self.lock = threading.Lock()
+        self.reset_sizes()
+
+    def dumps(self, val, min_compress_len=0, key=None, compress=True):
+        """The (flags, length, data) for val, or 0 if it's too big to
+        store. min_compress_len overrides compress_len if it's set."""
+        flags = 0
+        if isinstance(val, str):
+            pass
+        elif isinstance(val, int):
+            flags |= Client._FLAG_INTEGER
+            val = "%d" % val
+            # force no attempt to compress this silly string.
+            compress = False
+        elif isinstance(val, long):
+            flags |= Client._FLAG_LONG
+            val = "%d" % val
+            # force no attempt to compress this silly string.
+            compress = False
+        else:
+            flags |= Client._FLAG_PICKLE
+            val = pickle.dumps(val, self.protocol)
+
+        lv = len(val)
+        min_compress_len = min_compress_len or self.compress_len
+        # We should try to compress if min_compress_len > 0 and we could import zlib and this string is longer than our min threshold.
+        if (compress and min_compress_len and _supports_compress
+            and lv > min_compress_len):
+            comp_val = compress_fn(val)
+            #Only retain the result if the compression result is smaller than the original.
+            if len(comp_val) < lv:
+                flags |= Client._FLAG_COMPRESSED
+                val = comp_val
+
+        if self.track_sizes and key:
+            self._record(key, lv, len(val))
+
+        #  silently do not store if value length exceeds maximum
+        if len(val) >= SERVER_MAX_VALUE_LENGTH:
+            return (0)
+
+        return (flags, len(val), val)
+
+    def loads(self, flags, buf):
         if flags & Client._FLAG_COMPRESSED:
             buf = decompress(buf)
 
-
         if  flags == 0 or flags == Client._FLAG_COMPRESSED:
             # Either a bare string or a compressed string now decompressed...
-            val = buf
+            return buf
         elif flags & Client._FLAG_INTEGER:
-            val = int(buf)
+            return int(buf)
         elif flags & Client._FLAG_LONG:
-            val = long(buf)
+            return long(buf)
         elif flags & Client._FLAG_PICKLE:
-            try:
-                val = pickle.loads(buf)
-            except:
-                self.debuglog('Pickle error...\n')
-                val = None
-        else:
-            self.debuglog("unknown flags on get: %x\n" % flags)
+            return pickle.loads(buf)
+        raise _Error("unknown flags on get: %x" % flags)
 
-        return val
+    def _record(self, key, size, stored):
+        category = key_category(key)
+        self.lock.acquire()
+        try:
+            if (category not in self._sizes
+                and len(self._sizes) >= self.max_categories):
+                category = 'other'
+            count, total, total_stored, largest = \
+                self._sizes.get(category, (0, 0, 0, 0))
+            self._sizes[category] = (count + 1, total + size,
+                                     total_stored + stored,
+                                     max(largest, stored))
+        finally:
+            self.lock.release()
+
+    def sizes(self):
+        """For each kind of key, the number of values set, their total
+        size before and after compression and the largest stored, as a
+        dict of (count, bytes, stored_bytes, largest)."""
+        self.lock.acquire()
+        try:
+            return dict(self._sizes)
+        finally:
+            self.lock.release()
+
+    def reset_sizes(self):
+        self._sizes = {}
+
+def key_category(key):
+    """The kind of thing a key holds: up to its last underscore, so
+    'Link_' for 'Link_123', or else the text before its first digit."""
+    i = key.rfind('_')
+    if i < 0:
+        i = len(key)
+        for j, c in enumerate(key):
+            if c.isdigit():
+                i = j
+                break
+    else:
+        i += 1
+    return key[:min(i, 40)]
+
+def ring_hash(key):
+    """A key's position on a ketama ring."""
+    return struct.unpack('<I', md5(key).digest()[:4])[0]
+
+class _Placement(object):
+    """Which server a key lives on, for a list of (_Host, weight).
+
+    'modulo' hashing spreads crc32(key) over a bucket per unit of weight,
+    so changing the servers moves nearly every key. 'ketama' puts
+    points_per_weight points per unit of weight for each server on a
+    hash ring and gives a key to the server of the first point at or
+    after ring_hash(key), so adding or removing a server only moves the
+    keys on the arcs it gains or loses, about 1/n of them.
+    """
+    points_per_weight = 160
 
+    def __init__(self, servers, hashing='modulo'):
+        if hashing not in ('modulo', 'ketama'):
+            raise ValueError("unknown hashing '%s'" % hashing)
+        self.hashing = hashing
+
+        self.buckets = []
+        for server, weight in servers:
+            for i in range(weight):
+                self.buckets.append(server)
+
+        self.num_servers = len(set(server for server, weight in servers))
+        points = []
+        if hashing == 'ketama':
+            for server, weight in servers:
+                name = '%s:%d' % (server.ip, server.port)
+                #each md5 digest gives four points
+                for i in xrange(weight * self.points_per_weight / 4):
+                    digest = md5('%s-%d' % (name, i)).digest()
+                    for j in xrange(0, 16, 4):
+                        point = struct.unpack('<I', digest[j:j+4])[0]
+                        points.append((point, server))
+            points.sort(key = lambda p: p[0])
+        self.points = [p for p, server in points]
+        self.ring = [server for p, server in points]
+
+    def candidates(self, key, serverhash=None):
+        """The servers key can be on, in order of preference: the first
+        that is up gets it."""
+        if self.hashing == 'ketama':
+            if serverhash is None:
+                serverhash = ring_hash(key)
+            n = len(self.ring)
+            start = bisect_left(self.points, serverhash & 0xffffffff)
+            seen = set()
+            for i in xrange(n):
+                server = self.ring[(start + i) % n]
+                if server not in seen:
+                    seen.add(server)
+                    yield server
+                    if len(seen) == self.num_servers:
+                        break
+            return
+
+        if serverhash is None:
+            serverhash = serverHashFunction(key)
+
+        # the original version suffered from a failure rate of
+        # 1 in n^_SERVER_RETRIES, where n = number of bukets
+        # if one server is down.  This is particularly bad for
+        # n = 2, and the hashing is poor enough to guarantee
+        # that making _SERVER_RETRIES larger doesn't help.
+
+        #make a copy
+        good_servers = list(self.buckets)
+        while good_servers:
+            yield good_servers.pop(serverhash % len(good_servers))
 
 class _Host:
     _DEAD_RETRY = 1  # number of seconds before retrying a dead server.
@@ -770,6 +1468,7 @@ class _Host:
 
         self.deaduntil = 0
         self.socket = None
+        self.pool = None
 
         self.buffer = ''
 
@@ -794,6 +1493,15 @@ class _Host:
             return None
         if self.socket:
             return self.socket
+        if self.pool:
+            try:
+                s = self.pool.get()
+            except socket.error, msg:
+                self.mark_dead("connect: %s" % msg)
+                return None
+            self.socket = s
+            self.buffer = ''
+            return s
         s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         # Python 2.3-ism:  s.settimeout(1)
         try:
@@ -809,6 +1517,18 @@ class _Host:
         if self.socket:
             self.socket.close()
             self.socket = None
+            if self.pool:
+                self.pool.discard()
+
+    def release(self, clean=True):
+        """Give a pooled socket back for other threads to use, unless it
+        might have part of a reply left to read."""
+        if self.pool and self.socket:
+            if clean and not self.buffer:
+                self.pool.put(self.socket)
+                self.socket = None
+            else:
+                self.close_socket()
 
     def send_cmd(self, cmd):
         self.socket.sendall(cmd + '\r\n')
@@ -837,6 +1557,13 @@ class _Host:
             self.buffer = ''
         return buf
 
+    def read_binary(self):
+        """Read one binary protocol response: (opcode, status, opaque,
+        extras, key, value)."""
+        header = self.recv(_BIN_HEADER_LEN)
+        bodylen = _BIN_HEADER.unpack(header)[6]
+        return _bin_parse(header + self.recv(bodylen))[1:]
+
     def expect(self, text):
         line = self.readline()
         if line != text:
@@ -0,0 +1,177 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+# 
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+# 
+# The Original Code is Reddit.
+# 
+# The Original Developer is the Initial Developer.  The Initial Developer of the
+# Original Code is CondeNet, Inc.
+# 
+# All portions of the code written by CondeNet are Copyright (c) 2006-2008
+# CondeNet, Inc. All Rights Reserved.
+################################################################################
+from __future__ import with_statement
+
+from pylons import g
+from threading import Thread, Lock, Condition
+import time, atexit
+
+log = g.log
+
+class CounterAggregator(object):
+    """Collects the increments made by DataThing._incr in process and
+    writes them to the db as coalesced deltas every `interval`
+    seconds, one update per type and prop. Until a delta is written,
+    merge_pending() adds it to things that are loaded from the db.
+
+    Loading from the db and merging is bracketed by begin_fill() and
+    end_fill(), and a flush doesn't write a type's deltas while it's
+    being filled, nor fill it while they're being written. So a fill
+    either reads the row before the write and adds the delta, or reads
+    it after and doesn't, never both or neither."""
+
+    def __init__(self, interval = 5):
+        self.interval = interval
+        self.lock = Lock()
+        #(cls, prop) -> {thing_id: delta}
+        self.pending = {}
+        #the deltas currently being written, still visible to readers
+        self.flushing = {}
+        #cls -> number of fills in progress, and the classes being
+        #written
+        self.fills = {}
+        self.writing = set()
+        self.fill_lock = Condition(Lock())
+        self.thread = None
+        self.written = 0
+        self.coalesced = 0
+
+    def incr(self, cls, thing_id, prop, amt):
+        with self.lock:
+            deltas = self.pending.setdefault((cls, prop), {})
+            if thing_id in deltas:
+                self.coalesced += 1
+            deltas[thing_id] = deltas.get(thing_id, 0) + amt
+
+            if not self.thread:
+                self.thread = Thread(target = self._run)
+                self.thread.setDaemon(True)
+                self.thread.start()
+
+    def _delta(self, key, thing_id):
+        return (self.pending.get(key, {}).get(thing_id, 0) +
+                self.flushing.get(key, {}).get(thing_id, 0))
+
+    def has_pending(self, cls, thing_id, prop):
+        with self.lock:
+            key = (cls, prop)
+            return (thing_id in self.pending.get(key, ()) or
+                    thing_id in self.flushing.get(key, ()))
+
+    def begin_fill(self, cls):
+        """called before reading things of cls from the db"""
+        with self.fill_lock:
+            while cls in self.writing:
+                self.fill_lock.wait()
+            self.fills[cls] = self.fills.get(cls, 0) + 1
+
+    def end_fill(self, cls):
+        """called once what was read has been through merge_pending"""
+        with self.fill_lock:
+            self.fills[cls] -= 1
+            if not self.fills[cls]:
+                del self.fills[cls]
+                self.fill_lock.notifyAll()
+
+    def _begin_write(self, cls):
+        with self.fill_lock:
+            #new fills wait from here on, so a busy type can't hold
+            #off the write forever
+            self.writing.add(cls)
+            while self.fills.get(cls):
+                self.fill_lock.wait()
+
+    def _end_write(self, cls):
+        with self.fill_lock:
+            self.writing.discard(cls)
+            self.fill_lock.notifyAll()
+
+    def merge_pending(self, cls, items, base):
+        """adds the unwritten deltas to things that were just read from
+        the db. items is a dict of id to thing. base picks the deltas
+        of the base props, which _byID reads, rather than those of the
+        data props, which only _load_multi does."""
+        with self.lock:
+            keys = set(k for k in self.pending.keys() + self.flushing.keys()
+                       if k[0] is cls and k[1].startswith('_') == base)
+            for key in keys:
+                prop = key[1]
+                for thing_id, item in items.iteritems():
+                    amt = self._delta(key, thing_id)
+                    if amt:
+                        #a data prop with no default starts from nothing
+                        item.__setattr__(prop, getattr(item, prop, 0) + amt,
+                                         False)
+
+    def flush(self):
+        """writes every pending delta to the db. deltas that fail to
+        write are put back to be retried on the next flush."""
+        with self.lock:
+            self.flushing, self.pending = self.pending, {}
+
+        for (cls, prop), deltas in self.flushing.items():
+            key = (cls, prop)
+            deltas = dict((i, amt) for i, amt in deltas.iteritems() if amt)
+            retry = False
+            self._begin_write(cls)
+            try:
+                try:
+                    if not deltas:
+                        pass
+                    elif prop.startswith('_'):
+                        cls._incr_props_multi(cls._type_id, prop[1:], deltas)
+                    else:
+                        cls._incr_data_multi(cls._type_id, prop, deltas)
+                    self.written += len(deltas)
+                except NotImplementedError:
+                    #retrying won't help
+                    log.error('counter flush dropped %d deltas for %s.%s'
+                              % (len(deltas), cls.__name__, prop))
+                except Exception, e:
+                    log.error('counter flush failed for %s.%s: %s'
+                              % (cls.__name__, prop, e))
+                    retry = True
+
+                #written (or not) and out of flushing before any fill
+                #of cls can read the row
+                with self.lock:
+                    del self.flushing[key]
+                    if retry:
+                        again = self.pending.setdefault(key, {})
+                        for thing_id, amt in deltas.iteritems():
+                            again[thing_id] = again.get(thing_id, 0) + amt
+            finally:
+                self._end_write(cls)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception, e:
+                log.error('counter flush failed: %s' % e)
+
+def make_aggregator(interval):
+    aggregator = CounterAggregator(interval)
+    #don't lose the last few seconds of votes when a script exits
+    atexit.register(aggregator.flush)
+    return aggregator
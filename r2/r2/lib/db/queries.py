@@ -1,13 +1,19 @@
+from __future__ import with_statement
 from r2.models import Account, Link, Comment, Vote, SaveHide
 from r2.models import Message, Inbox, Subreddit
 from r2.lib.db.thing import Thing, Merge
-from r2.lib.db.operators import asc, desc, timeago
+from r2.lib.db.operators import asc, desc, timeago, eq, gte, query_func
+from r2.lib.db import operators
 from r2.lib.db import query_queue
 from r2.lib.db.sorts import epoch_seconds
-from r2.lib.utils import fetch_things2, worker
+from r2.lib.utils import fetch_things2, worker, tup, to36
+from r2.lib import utils
+from r2.lib.lock import TimeoutExpired
 from r2.lib.solrsearch import DomainSearchQuery
 
 from datetime import datetime
+from array import array
+import heapq, bisect
 
 from pylons import g
 query_cache = g.permacache
@@ -39,6 +45,32 @@ db_times = dict(all = None,
                 month = Thing.c._date >= timeago('1 month'),
                 year = Thing.c._date >= timeago('1 year'))
 
+def make_sort_key(sort):
+    """Returns a function that maps a cached tuple of (fullname,
+    *sort_cols) to a key that sorts ascending in the query's order."""
+    #negate the descending columns so every column sorts ascending
+    signs = [1 if isinstance(s, asc) else -1 for s in sort]
+    def sort_key(t):
+        return tuple(sign * v for sign, v in zip(signs, t[1:]))
+    return sort_key
+
+class LazySortKeys(object):
+    """The sort keys of a sorted list of cached tuples, computed only
+    for the positions that are read, so a bisect costs O(log n) keys
+    instead of n."""
+    def __init__(self, data, sort_key):
+        self.data = data
+        self.sort_key = sort_key
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, i):
+        return self.sort_key(self.data[i])
+
+#columns make_item_tuple can compute from the item itself
+insertable_cols = ('_date', '_hot', '_score', '_controversy')
+
 #we need to define the filter functions here so cachedresults can be pickled
 def filter_identity(x):
     return x
@@ -48,6 +80,85 @@ def filter_thing2(x):
     the object of the relationship."""
     return x._thing2
 
+class PackedResults(object):
+    """A compact, read-only stand-in for the list of (fullname,
+    *sort_cols) tuples that CachedResults keeps in the query cache. All
+    of the fullnames share a prefix, so only the prefix, an array of
+    ids and an array of floats per sort column are stored, and the
+    tuples are only built as they are read."""
+    def __init__(self, prefix, ids, cols):
+        self.prefix = prefix
+        self.ids = ids
+        self.cols = cols
+
+    @classmethod
+    def pack(cls, data):
+        """Returns a PackedResults of data, or None if the tuples don't
+        fit the encoding (mixed types or non-numeric sort columns)."""
+        if not data:
+            return None
+
+        prefix = data[0][0].rsplit('_', 1)[0] + '_'
+        ids = array('I')
+        cols = [array('d') for x in data[0][1:]]
+        try:
+            for t in data:
+                name = t[0]
+                id36 = name[len(prefix):]
+                if (not name.startswith(prefix) or not id36
+                    or to36(int(id36, 36)) != id36):
+                    return None
+                ids.append(int(id36, 36))
+                if len(t) != len(cols) + 1:
+                    return None
+                for col, val in zip(cols, t[1:]):
+                    if isinstance(val, bool) or float(val) != val:
+                        return None
+                    col.append(val)
+        except (TypeError, ValueError, OverflowError):
+            return None
+        return cls(prefix, ids, cols)
+
+    def fullname(self, i):
+        return self.prefix + to36(self.ids[i])
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[n] for n in xrange(*i.indices(len(self)))]
+        return (self.fullname(i),) + tuple(col[i] for col in self.cols)
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+    def fullnames(self):
+        for i in xrange(len(self)):
+            yield self.fullname(i)
+
+    def __getstate__(self):
+        #arrays pickle as lists of python objects, strings don't
+        return (self.prefix, self.ids.tostring(),
+                [col.tostring() for col in self.cols])
+
+    def __setstate__(self, state):
+        self.prefix, ids, cols = state
+        self.ids = array('I', ids)
+        self.cols = [array('d', col) for col in cols]
+
+    def __repr__(self):
+        return '<PackedResults %s x %d>' % (self.prefix, len(self))
+
+def pack_results(data):
+    """The form of a CachedResults list that goes in the query cache:
+    packed when possible, the plain list otherwise. Readers accept
+    both, so entries written before packing still load."""
+    if g.pack_query_cache:
+        return PackedResults.pack(data) or data
+    return data
+
 class CachedResults(object):
     """Given a query returns a list-like object that will lazily look up
     the query from the persistent cache. """
@@ -66,6 +177,17 @@ class CachedResults(object):
             self._fetched = True
             self.data = query_cache.get(self.iden) or []
 
+    def lock(self):
+        """The lock to hold while changing the cached data in place, so
+        that concurrent inserts and deletes don't overwrite each other.
+        The data has to be fetched again once it's held."""
+        self._fetched = False
+        return g.make_lock('lock_query_' + self.iden)
+
+    def store(self):
+        """Writes the data back to the cache."""
+        query_cache.set(self.iden, pack_results(self.data))
+
     def make_item_tuple(self, item):
         """Given a single 'item' from the result of a query build the tuple
         that will be stored in the query cache. It is effectively the
@@ -83,38 +205,80 @@ class CachedResults(object):
         return tuple(lst)
 
     def can_insert(self):
-        """True if a new item can just be inserted, which is when the
-        query is only sorted by date."""
-        return self.query._sort == [desc('_date')]
+        """True if a new or changed item can be put straight into the
+        cached data, which is when every sort column can be computed
+        from the item."""
+        return all(s.col in insertable_cols for s in self.query._sort)
 
     def can_delete(self):
         """True if a item can be removed from the listing, always true for now."""
         return True
 
+    def matches(self, item):
+        """Whether item belongs in the results of the query: True or
+        False, or None if a rule can't be checked without the db."""
+        for op in self.query._rules:
+            #or_/and_ and query_funcs need the db to be evaluated
+            if not isinstance(op, operators.op):
+                return None
+            elif isinstance(op.lval, query_func):
+                return None
+            elif isinstance(op, eq):
+                if getattr(item, op.lval_name, None) not in tup(op.rval):
+                    return False
+            elif (isinstance(op, gte) and op.lval_name == '_date'
+                  and isinstance(op.rval, timeago)):
+                if item._date < utils.timeago(op.rval.interval):
+                    return False
+            else:
+                return None
+        return True
+
     def insert(self, item):
-        """Inserts the item at the front of the cached data. Assumes the query
-        is sorted by date descending"""
+        """Puts the item at its sorted position in the cached data,
+        replacing the tuple it had before, and truncates the data to
+        precompute_limit. Returns False if the listing has to be
+        recomputed instead, which is when the item fell off the end of
+        a full listing or the query's rules can't be checked."""
         self.fetch()
+
+        matches = self.matches(item)
+        if matches is None:
+            return False
+        elif not matches:
+            self.delete(item)
+            return True
+
         t = self.make_item_tuple(item)
-        changed = False
-        if t not in self.data:
-            self.data.insert(0, t)
-            changed = True
+        data = list(self.data)
+        if t in data:
+            return True
+
+        present = len(data)
+        data = [x for x in data if x[0] != t[0]]
+        was_present = len(data) != present
+
+        sort_key = make_sort_key(self.query._sort)
+        pos = bisect.bisect_left(LazySortKeys(data, sort_key), sort_key(t))
 
-        if changed:
-            query_cache.set(self.iden, self.data[:precompute_limit])
+        if pos >= precompute_limit:
+            #the item's real replacement isn't in the cache
+            return not was_present
+
+        data.insert(pos, t)
+        self.data = data[:precompute_limit]
+        self.store()
+        return True
 
     def delete(self, item):
         """Deletes an item from the cached data."""
         self.fetch()
-        t = self.make_item_tuple(item)
-        changed = False
-        while t in self.data:
-            self.data.remove(t)
-            changed = True
-            
-        if changed:
-            query_cache.set(self.iden, self.data)
+        fullname = self.filter(item)._fullname
+        data = [x for x in self.data if x[0] != fullname]
+
+        if len(data) != len(self.data):
+            self.data = data
+            self.store()
         
     def update(self):
         """Runs the query and stores the result in the cache. It also stores
@@ -122,7 +286,7 @@ class CachedResults(object):
         results faster."""
         self.data = [self.make_item_tuple(i) for i in self.query]
         self._fetched = True
-        query_cache.set(self.iden, self.data)
+        self.store()
 
     def __repr__(self):
         return '<CachedResults %s %s>' % (self.query._rules, self.query._sort)
@@ -130,36 +294,62 @@ class CachedResults(object):
     def __iter__(self):
         self.fetch()
 
-        for x in self.data:
-            yield x[0]
+        if isinstance(self.data, PackedResults):
+            for name in self.data.fullnames():
+                yield name
+        else:
+            for x in self.data:
+                yield x[0]
+
+def fetch_multi(results):
+    """Loads the cached data of several CachedResults with a single
+    get_multi."""
+    need = [r for r in results if not r._fetched]
+    if need:
+        cached = query_cache.get_multi([r.iden for r in need])
+        for r in need:
+            r._fetched = True
+            r.data = cached.get(r.iden) or []
+
+class MergedCachedResults(object):
+    """The lazy merge of several CachedResults that share a sort. Each
+    cached list is already sorted, so they are merged with a heap and
+    fullnames are only produced as fast as they're consumed."""
+    def __init__(self, results):
+        self.results = results
+
+        #make sure the sorts match
+        sort = results[0].query._sort if results else []
+        assert(all(r.query._sort == sort for r in results[1:]))
+
+        self.sort_key = make_sort_key(sort)
+
+    def __iter__(self):
+        fetch_multi(self.results)
+
+        #ties go to the earlier result, like a stable sort would
+        heap = [(self.sort_key(r.data[0]), n, 0)
+                for n, r in enumerate(self.results) if r.data]
+        heapq.heapify(heap)
+
+        while heap:
+            key, n, pos = heap[0]
+            data = self.results[n].data
+            yield data[pos][0]
+
+            pos += 1
+            if pos < len(data):
+                heapq.heapreplace(heap, (self.sort_key(data[pos]), n, pos))
+            else:
+                heapq.heappop(heap)
+
+    def __repr__(self):
+        return '<MergedCachedResults %s>' % (self.results,)
 
 def merge_cached_results(*results):
     """Given two CachedResults, mergers their lists based on the sorts of
     their queries."""
-    if len(results) == 1:
-        return list(results[0])
-
-    #make sure the sorts match
-    sort = results[0].query._sort
-    assert(all(r.query._sort == sort for r in results[1:]))
-
-    def thing_cmp(t1, t2):
-        for i, s in enumerate(sort):
-            #t1 and t2 are tuples of (fullname, *sort_cols), so we can
-            #get the value to compare right out of the tuple
-            v1, v2 = t1[i + 1], t2[i + 1]
-            if v1 != v2:
-                return cmp(v1, v2) if isinstance(s, asc) else cmp(v2, v1)
-        #they're equal
-        return 0
-
-    all_items = []
-    for r in results:
-        r.fetch()
-        all_items.extend(r.data)
-
-    #all_items = Thing._by_fullname(all_items, return_dict = False)
-    return [i[0] for i in sorted(all_items, cmp = thing_cmp)]
+    return MergedCachedResults(results)
 
 def make_results(query, filter = filter_identity):
     if g.use_query_cache:
@@ -270,11 +460,18 @@ def add_queries(queries, insert_item = None, delete_item = None):
             if not isinstance(q, CachedResults):
                 continue
 
-            if insert_item and q.can_insert():
-                q.insert(insert_item)
-            elif delete_item and q.can_delete():
-                q.delete(delete_item)
-            else:
+            try:
+                if insert_item and q.can_insert():
+                    with q.lock():
+                        if not q.insert(insert_item):
+                            query_queue.add_query(q)
+                elif delete_item and q.can_delete():
+                    with q.lock():
+                        q.delete(delete_item)
+                else:
+                    query_queue.add_query(q)
+            except TimeoutExpired:
+                #a recompute gets it right in the end
                 query_queue.add_query(q)
     worker.do(_add_queries)
 
@@ -342,7 +539,8 @@ def new_vote(vote):
         results = all_queries(get_links, sr, ('hot', 'new'), ['all'])
         results.extend(all_queries(get_links, sr, ('top', 'controversial'), db_times.keys()))
         results.append(get_links(sr, 'toplinks', 'all'))
-        add_queries(results)
+        #reposition the link in each listing rather than recomputing them
+        add_queries(results, insert_item = item)
     
     #must update both because we don't know if it's a changed vote
     if vote._name == '1':
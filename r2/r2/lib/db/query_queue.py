@@ -7,18 +7,22 @@ import cPickle as pickle
 from datetime import datetime
 from urllib2 import Request, urlopen
 from urllib import urlencode
-from threading import Lock
-import time
+from threading import Lock, Condition
+import time, select
 
 import sqlalchemy as sa
+import psycopg2
 from sqlalchemy.exceptions import SQLError
 
 from pylons import g
 
-#the current 
+#the idens currently being sent to the worker
 running = set()
 running_lock = Lock()
 
+#counters reported by run(), see log_stats()
+stats = dict(claimed = 0, done = 0, failed = 0, latency = 0.0)
+
 def make_query_queue_table():
     metadata = make_metadata(query_queue_engine)
     table =  sa.Table(settings.DB_APP_NAME + '_query_queue', metadata,
@@ -31,18 +35,37 @@ def make_query_queue_table():
 
 query_queue_table = make_query_queue_table()
 
+notify_channel = settings.DB_APP_NAME + '_query_queue'
+
 def add_query(cached_results):
-    """Adds a CachedResults instance to the queue db, ignoring duplicates"""
+    """Adds a CachedResults instance to the queue db. If the query is
+    already queued and hasn't been claimed, the two are coalesced. A
+    claimed query has a date in the future (see claim_queries), and
+    the worker may have already read the old data, so it's put back in
+    line instead. With query_queue_notify on, the run() loop is woken
+    up with a NOTIFY."""
+    table = query_queue_table
     d = dict(iden = cached_results.query._iden(),
-             query = pickle.dumps(cached_results, -1),
-             date = datetime.now(tz))
+             query = psycopg2.Binary(pickle.dumps(cached_results, -1)))
+    sql = ("insert into %(t)s (iden, query, date) "
+           "select %%(iden)s, %%(query)s, now() where not exists "
+           "(select 1 from %(t)s where iden = %%(iden)s); "
+           "update %(t)s set date = now() "
+           "where iden = %%(iden)s and date > now()"
+           % dict(t = table.name))
+    if g.query_queue_notify:
+        sql += '; notify %s' % notify_channel
     try:
-        query_queue_table.insert().execute(d)
+        table.engine.execute(sql, d)
     except SQLError, e:
-        #don't worry about inserting duplicates
+        #someone else inserted the same query between our check and
+        #insert, which coalesces the two
         if not 'IntegrityError' in e.message:
             raise
 
+    if local_notifier:
+        local_notifier.notify()
+
 def remove_query(iden):
     """Removes a row identified with iden from the query queue. To be
     called after a CachedResults is updated."""
@@ -50,67 +73,254 @@ def remove_query(iden):
     d = table.delete(table.c.iden == iden)
     d.execute()
 
-def get_query():
-    """Gets the next query off the queue, ignoring the currently running
-    queries."""
+def remove_queries(claimed):
+    """Removes claimed rows, a list of (iden, date) pairs from
+    claim_queries, from the queue. Rows that have been requeued since
+    they were claimed have a new date and are left for the next run."""
+    table = query_queue_table
+    if claimed:
+        d = table.delete(sa.or_(*[sa.and_(table.c.iden == iden,
+                                          table.c.date == date)
+                                  for iden, date in claimed]))
+        d.execute()
+
+def claim_queries(limit, debounce = 0, lease = 300, exclude = ()):
+    """Claims up to limit of the oldest queries in one statement by
+    moving their date lease seconds into the future, which hides them
+    from other claims until the lease runs out. Only queries that have
+    been queued for at least debounce seconds are claimed, so repeated
+    adds of the same query in that window are sent once. Queries in
+    exclude (the ones still running) are skipped without touching
+    their date, so one requeued while it runs can be claimed as soon as
+    it finishes. Returns a list of (iden, pickled query, claimed date,
+    queued date)."""
+    table = query_queue_table
+    not_running = "and iden not in %(exclude)s " if exclude else ""
+    sql = ("update %(t)s set date = now() + %%(lease)s * interval '1 second' "
+           "from (select iden, date from %(t)s "
+           "where date <= now() - %%(debounce)s * interval '1 second' "
+           "%(not_running)s"
+           "order by date limit %%(limit)s) as c "
+           "where %(t)s.iden = c.iden "
+           "and %(t)s.date <= now() - %%(debounce)s * interval '1 second' "
+           "returning %(t)s.iden, %(t)s.query, %(t)s.date, c.date"
+           % dict(t = table.name, not_running = not_running))
+    r = table.engine.execute(sql, dict(limit = limit, debounce = debounce,
+                                       lease = lease,
+                                       exclude = tuple(exclude)))
+    return [tuple(row) for row in r.fetchall()]
+
+def release_queries(claimed):
+    """Undoes claim_queries for claimed rows that won't be sent, by
+    putting their queued date back, unless they've been requeued
+    since."""
+    table = query_queue_table
+    for iden, q, date, queued in claimed:
+        u = table.update(sa.and_(table.c.iden == iden, table.c.date == date),
+                         values = dict(date = queued))
+        u.execute()
+
+def next_claim_in(debounce = 0):
+    """Seconds until the next query in the queue can be claimed (which
+    may be negative), or None if the queue is empty. Claimed queries
+    count too, for when their lease runs out."""
     table = query_queue_table
+    r = table.engine.execute("select extract(epoch from min(date) - now()) "
+                             "from %s" % table.name).fetchone()
+    if r and r[0] is not None:
+        return float(r[0]) + debounce
+
+class Listener(object):
+    """Waits for the NOTIFYs sent by add_query on a connection of its
+    own, so run() doesn't have to poll the queue table."""
+    #seconds to wait before reconnecting after an error
+    retry_delay = 1
+
+    def __init__(self):
+        self.conn = None
+
+    def connect(self):
+        kw = dict(database = g.query_queue_db_name)
+        for k, v in (('host', g.query_queue_db_host),
+                     ('user', g.query_queue_db_user),
+                     ('password', g.query_queue_db_pass)):
+            if v:
+                kw[k] = v
+        conn = psycopg2.connect(**kw)
+        #notifies aren't delivered inside a transaction
+        conn.set_isolation_level(0)
+        conn.cursor().execute('listen %s' % notify_channel)
+        self.conn = conn
+
+    def wait(self, timeout):
+        """Blocks until a query is added or timeout seconds have passed.
+        Returns True if a query was added."""
+        try:
+            if not self.conn:
+                self.connect()
+            if select.select([self.conn], [], [], max(timeout, 0))[0]:
+                self.conn.poll()
+                notified = bool(self.conn.notifies)
+                del self.conn.notifies[:]
+                return notified
+        except (psycopg2.Error, select.error), e:
+            #reconnect on the next wait, the queue table still has
+            #anything we missed in the meantime
+            g.log.error('query queue listener: %r' % e)
+            self.conn = None
+            time.sleep(self.retry_delay)
+        return False
+
+class LocalNotifier(object):
+    """An in-process stand-in for the NOTIFYs and Listener, for tests
+    and for running the queue and the adds in one process. While
+    local_notifier is set to one, add_query notifies it and run()
+    waits on it instead of listening to postgres."""
+    def __init__(self):
+        self.cond = Condition()
+        self.notified = False
 
-    s = table.select(order_by = sa.asc(table.c.date), limit = 1)
-    s.append_whereclause(sa.and_(*[table.c.iden != i for i in running]))
-    r = s.execute().fetchone()
+    def notify(self):
+        with self.cond:
+            self.notified = True
+            self.cond.notifyAll()
 
-    if r:
-        return r.iden, r.query
-    else:
-        return None, None
+    def wait(self, timeout):
+        """Like Listener.wait: True if notify() was called since the
+        last wait, or is called within timeout seconds."""
+        with self.cond:
+            if not self.notified:
+                self.cond.wait(max(timeout, 0))
+            notified, self.notified = self.notified, False
+            return notified
 
-def make_query_job(iden, pickled_cr):
-    """Creates a job to send to the query worker. Updates a cached result
-    then removes the query from both the queue and the running set. If
-    sending the job fails, the query is only remove from the running
-    set."""
+local_notifier = None
+
+def queue_depth():
+    """The number of queries in the queue, claimed or not."""
+    table = query_queue_table
+    return sa.select([sa.func.count(table.c.iden)]).scalar()
+
+def make_query_job(claimed):
+    """Creates a job to send to the query worker. Sends a batch of
+    claimed queries in one request, removes the ones the worker updated
+    from the queue and then removes them all from the running set. The
+    queries that weren't updated are tried again when their lease runs
+    out (e.g. in the event the worker is down), or right away if the
+    worker answered with something other than 'ok'."""
     precompute_worker = g.query_queue_worker
     def job():
+        done = set()
+        release = False
         try:
-            finished = False
             r = Request(url = precompute_worker + '/doquery',
-                        data = urlencode([('query', pickled_cr)]),
+                        data = urlencode([('query', q)
+                                          for iden, q, date, queued in claimed]),
                         #this header prevents pylons from turning the
                         #parameter into unicode, which breaks pickling
                         headers = {'x-dont-decode':'true'})
-            urlopen(r)
-            finished = True
+            #the worker responds with 'ok' and the idens it updated
+            res = urlopen(r).read().split()
+            if res[:1] == ['ok']:
+                done.update(res[1:])
+            else:
+                g.log.error('query worker responded %r' % ' '.join(res)[:100])
+                release = True
         finally:
-            with running_lock:
-                running.remove(iden)
-                #if finished is false, we'll leave the query in the db
-                #so we can try again later (e.g. in the event the
-                #worker is down)
-                if finished:
-                    remove_query(iden)
+            try:
+                remove_queries([(iden, date)
+                                for iden, q, date, queued in claimed
+                                if iden in done])
+                if release:
+                    release_queries(claimed)
+            finally:
+                now = datetime.now(tz)
+                with running_lock:
+                    for iden, q, date, queued in claimed:
+                        running.discard(iden)
+                        if iden in done:
+                            stats['done'] += 1
+                            stats['latency'] += total_seconds(now - queued)
+                        else:
+                            stats['failed'] += 1
     return job
 
+def total_seconds(td):
+    return td.days * 86400 + td.seconds + td.microseconds / 1e6
+
+def log_stats():
+    """Logs the queue depth and the counters since the last call."""
+    with running_lock:
+        s = stats.copy()
+        stats.update(claimed = 0, done = 0, failed = 0, latency = 0.0)
+    latency = s['latency'] / s['done'] if s['done'] else 0
+    g.log.info('query queue: depth %d, running %d, claimed %d, done %d, '
+               'failed %d, avg latency %.1fs'
+               % (queue_depth(), len(running), s['claimed'], s['done'],
+                  s['failed'], latency))
+
 def run():
-    """Pull jobs from the queue, creates a job, and sends them to a
-    WorkQueue for processing."""
+    """Claims batches of queries from the queue and sends each batch to
+    a WorkQueue to be delivered to the worker in one request. Queries
+    stay in the queue table until the worker has updated them, so a
+    crash of either side only delays them until their lease runs
+    out."""
     num_workers = g.num_query_queue_workers
+    batch_size = getattr(g, 'query_queue_batch_size', None) or 1
+    debounce = getattr(g, 'query_queue_debounce', None) or 0
+    lease = getattr(g, 'query_queue_lease', None) or 300
+    stats_interval = 60
+
+    #the longest we'll wait without being notified
+    max_wait = 60
+
     wq = WorkQueue(num_workers = num_workers)
     wq.start()
 
+    listener = None
+    if local_notifier:
+        listener = local_notifier
+    elif g.query_queue_notify:
+        listener = Listener()
+        #start listening before the first claim so no adds are missed
+        listener.wait(0)
+
+    last_stats = time.time()
     while True:
-        job = None
+        claimed = []
         #limit the total number of jobs in the WorkQueue. we don't
         #need to load the entire db queue right away (the db queue can
         #get quite large).
-        if len(running) < 2 * num_workers:
+        if len(running) < 2 * num_workers * batch_size:
             with running_lock:
-                iden, pickled_cr = get_query()
-                if pickled_cr is not None:
-                    if not iden in running:
-                        running.add(iden)
-                        job = make_query_job(iden, pickled_cr)
-                        wq.add(job)
-
-        #if we didn't find a job, sleep before trying again
-        if not job:
-            time.sleep(1)
+                exclude = list(running)
+            claimed = claim_queries(batch_size, debounce, lease, exclude)
+            with running_lock:
+                #one that started running since we looked is given back
+                #to be claimed when it's done
+                taken = [c for c in claimed if c[0] in running]
+                claimed = [c for c in claimed if c[0] not in running]
+                running.update(c[0] for c in claimed)
+                stats['claimed'] += len(claimed)
+            if taken:
+                release_queries(taken)
+            if claimed:
+                wq.add(make_query_job(claimed))
+
+        if time.time() - last_stats >= stats_interval:
+            last_stats = time.time()
+            log_stats()
+
+        #if we didn't find a job, wait before trying again
+        if not claimed:
+            if not listener:
+                time.sleep(1)
+            elif len(running) >= 2 * num_workers * batch_size:
+                #wait for a job to finish
+                time.sleep(0.1)
+            else:
+                #sleep until the oldest query is old enough to be
+                #claimed, or a new one comes in
+                wait = next_claim_in(debounce)
+                listener.wait(max_wait if wait is None
+                              else min(max(wait, 0.1), max_wait))
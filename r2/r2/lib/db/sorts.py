@@ -36,10 +36,14 @@ def score(ups, downs):
 
 def hot(ups, downs, date):
     """The hot formula. Should match the equivalent function in postgres."""
+    return epoch_hot(ups, downs, epoch_seconds(date))
+
+def epoch_hot(ups, downs, seconds):
+    """hot() for a date given in seconds from the epoch."""
     s = score(ups, downs)
     order = log(max(abs(s), 1), 10)
     sign = 1 if s > 0 else -1 if s < 0 else 0
-    seconds = epoch_seconds(date) - 1134028003
+    seconds = seconds - 1134028003
     return round(order + sign * seconds / 45000, 7)
 
 def controversy(ups, downs):
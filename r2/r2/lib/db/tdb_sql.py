@@ -27,7 +27,9 @@ import operators
 import sqlalchemy as sa
 from sqlalchemy.databases import postgres
 from datetime import datetime
+from threading import Thread
 import cPickle as pickle
+import sys
 
 from copy import deepcopy
 
@@ -38,6 +40,10 @@ settings = storage()
 settings.DEBUG = g.debug
 settings.DB_CREATE_TABLES = True
 settings.DB_APP_NAME = 'reddit'
+#how many ids to send in a single IN clause, and how many connections
+#from the pool a single bulk fetch may use at once
+settings.FETCH_CHUNK_SIZE = getattr(g, 'db_fetch_chunk_size', None) or 200
+settings.FETCH_THREADS = getattr(g, 'db_fetch_threads', None) or 4
 
 max_val_len = 1000
 
@@ -347,6 +353,46 @@ def set_thing_props(type_id, thing_id, **props):
     for t in extra_thing_tables.get(type_id, ()):
         do_update(t)
 
+def values_list(rows, cols):
+    """builds a '(VALUES ...) AS v (cols)' from-item for rows, a list of
+    tuples matching cols. returns the sql and its bind params."""
+    params = {}
+    tuples = []
+    for i, row in enumerate(rows):
+        binds = []
+        for j, val in enumerate(row):
+            name = 'v%d_%d' % (i, j)
+            params[name] = val
+            binds.append('%%(%s)s' % name)
+        tuples.append('(%s)' % ', '.join(binds))
+    sql = '(VALUES %s) AS v (%s)' % (', '.join(tuples), ', '.join(cols))
+    return sql, params
+
+def set_thing_props_multi(type_id, props_by_id):
+    """sets the base props of many things of one type. things that
+    change the same set of props are updated with a single statement."""
+    table = types_id[type_id].thing_table
+
+    groups = {}
+    for thing_id, props in props_by_id.iteritems():
+        if props:
+            cols = tuple(sorted(props.keys()))
+            row = (thing_id,) + tuple(props[c] for c in cols)
+            groups.setdefault(cols, []).append(row)
+
+    def do_update(t):
+        transactions.add_engine(t.engine)
+        for cols, rows in groups.iteritems():
+            values, params = values_list(rows, ('thing_id',) + cols)
+            sets = ', '.join('%s = v.%s' % (c, c) for c in cols)
+            sql = ('UPDATE %s SET %s FROM %s WHERE %s.thing_id = v.thing_id'
+                   % (t.name, sets, values, t.name))
+            t.engine.execute(sql, params)
+
+    do_update(table)
+    for t in extra_thing_tables.get(type_id, ()):
+        do_update(t)
+
 def incr_thing_prop(type_id, thing_id, prop, amount):
     table = types_id[type_id].thing_table
     
@@ -360,6 +406,23 @@ def incr_thing_prop(type_id, thing_id, prop, amount):
     for t in extra_thing_tables.get(type_id, ()):
         do_update(t)
 
+def incr_thing_prop_multi(type_id, prop, amounts):
+    """applies amounts, a dict of thing_id to delta, to prop with one
+    update per table"""
+    table = types_id[type_id].thing_table
+    values, params = values_list(amounts.items(), ('thing_id', 'amount'))
+
+    def do_update(t):
+        transactions.add_engine(t.engine)
+        sql = ('UPDATE %s SET %s = %s.%s + v.amount FROM %s '
+               'WHERE %s.thing_id = v.thing_id'
+               % (t.name, prop, t.name, prop, values, t.name))
+        t.engine.execute(sql, params)
+
+    do_update(table)
+    for t in extra_thing_tables.get(type_id, ()):
+        do_update(t)
+
 class CreationError(Exception): pass
 
 #TODO does the type exist?
@@ -429,30 +492,35 @@ def db2py(val, kind):
 
     return val
 
-#TODO i don't need type_id
-def set_data(table, type_id, thing_id, **vals):
-    s = sa.select([table.c.key], sa.and_(table.c.thing_id == thing_id))
+def set_data_multi(table, vals_by_id):
+    """writes the data props in vals_by_id, a dict of thing_id to a
+    dict of props, as an upsert: one UPDATE for the keys that already
+    exist and one INSERT for the rest, sent in a single round trip."""
+    rows = []
+    for thing_id, vals in vals_by_id.iteritems():
+        for key, val in vals.iteritems():
+            val, kind = py2db(val, return_kind=True)
+            rows.append((thing_id, key, val, kind))
+
+    if not rows:
+        return
 
     transactions.add_engine(table.engine)
-    keys = [x.key for x in s.execute().fetchall()]
-
-    i = table.insert(values = dict(thing_id = thing_id))
-    u = table.update(sa.and_(table.c.thing_id == thing_id,
-                             table.c.key == sa.bindparam('key')))
+    values, params = values_list(rows, ('thing_id', 'key', 'value', 'kind'))
+    name = table.name
+    update = ('UPDATE %s SET value = v.value, kind = v.kind FROM %s '
+              'WHERE %s.thing_id = v.thing_id AND %s.key = v.key'
+              % (name, values, name, name))
+    insert = ('INSERT INTO %s (thing_id, key, value, kind) '
+              'SELECT v.thing_id, v.key, v.value, v.kind FROM %s '
+              'WHERE NOT EXISTS (SELECT 1 FROM %s d WHERE '
+              'd.thing_id = v.thing_id AND d.key = v.key)'
+              % (name, values, name))
+    table.engine.execute(update + '; ' + insert, params)
 
-    inserts = []
-    for key, val in vals.iteritems():
-        val, kind = py2db(val, return_kind=True)
-
-        #TODO one update?
-        if key in keys:
-            u.execute(key = key, value = val, kind = kind)
-        else:
-            inserts.append({'key':key, 'value':val, 'kind': kind})
-
-    #do one insert
-    if inserts:
-        i.execute(*inserts)
+#TODO i don't need type_id
+def set_data(table, type_id, thing_id, **vals):
+    set_data_multi(table, {thing_id: vals})
 
 def incr_data_prop(table, type_id, thing_id, prop, amount):
     t = table
@@ -462,6 +530,62 @@ def incr_data_prop(table, type_id, thing_id, prop, amount):
                  values={t.c.value : sa.cast(t.c.value, sa.Float) + amount})
     u.execute()
 
+def incr_data_prop_multi(table, prop, amounts):
+    transactions.add_engine(table.engine)
+    values, params = values_list(amounts.items(), ('thing_id', 'amount'))
+    params['key'] = prop
+    name = table.name
+    sql = ('UPDATE %s SET value = CAST(%s.value AS float) + v.amount FROM %s '
+           'WHERE %s.thing_id = v.thing_id AND %s.key = %%(key)s'
+           % (name, name, values, name, name))
+    table.engine.execute(sql, params)
+
+def fetch_chunk(table, id_col, ids):
+    s = sa.select([table], id_col.in_(*ids))
+    return s.execute().fetchall()
+
+def fetch_chunked(table, id_col, ids):
+    """select the rows of table whose id_col is in ids. the ids are
+    sent as IN lists of at most settings.FETCH_CHUNK_SIZE, and when
+    there is more than one chunk they are run in parallel on up to
+    settings.FETCH_THREADS connections from the pool."""
+    ids = list(set(ids))
+    size = settings.FETCH_CHUNK_SIZE
+    chunks = [ids[i:i + size] for i in xrange(0, len(ids), size)]
+    num_threads = min(len(chunks), settings.FETCH_THREADS)
+
+    #the other connections can't see this thread's transaction
+    if num_threads <= 1 or transactions.trans:
+        rows = []
+        for chunk in chunks:
+            rows.extend(fetch_chunk(table, id_col, chunk))
+        return rows
+
+    results = [None] * len(chunks)
+    errors = []
+    def fetch_every(start):
+        try:
+            for i in xrange(start, len(chunks), num_threads):
+                results[i] = fetch_chunk(table, id_col, chunks[i])
+        except:
+            errors.append(sys.exc_info())
+
+    threads = [Thread(target = fetch_every, args = (n,))
+               for n in xrange(num_threads)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    if errors:
+        e_type, e_val, e_tb = errors[0]
+        raise e_type, e_val, e_tb
+
+    rows = []
+    for r in results:
+        rows.extend(r)
+    return rows
+
 def fetch_query(table, id_col, thing_id):
     """pull the columns from the thing/data tables for a list or single
     thing_id"""
@@ -470,10 +594,8 @@ def fetch_query(table, id_col, thing_id):
     if not isinstance(thing_id, iters):
         single = True
         thing_id = (thing_id,)
-    
-    s = sa.select([table], sa.or_(*[id_col == tid
-                                    for tid in thing_id]))
-    r = s.execute().fetchall()
+
+    r = fetch_chunked(table, id_col, thing_id)
     return (r, single)
 
 #TODO specify columns to return?
@@ -492,10 +614,18 @@ def set_thing_data(type_id, thing_id, **vals):
     table = types_id[type_id].data_table[0]
     return set_data(table, type_id, thing_id, **vals)
 
+def set_thing_data_multi(type_id, vals_by_id):
+    table = types_id[type_id].data_table[0]
+    return set_data_multi(table, vals_by_id)
+
 def incr_thing_data(type_id, thing_id, prop, amount):
     table = types_id[type_id].data_table[0]
     return incr_data_prop(table, type_id, thing_id, prop, amount)    
 
+def incr_thing_data_multi(type_id, prop, amounts):
+    table = types_id[type_id].data_table[0]
+    return incr_data_prop_multi(table, prop, amounts)
+
 def get_thing_data(type_id, thing_id):
     table = types_id[type_id].data_table[0]
     return get_data(table, thing_id)
@@ -518,14 +648,28 @@ def get_thing(type_id, thing_id):
             res[row.thing_id] = stor
     return res
 
+def get_max_thing_id(type_id):
+    """the highest thing_id of a type, or 0 if there are none"""
+    table = types_id[type_id].thing_table
+    r = sa.select([sa.func.max(table.c.thing_id)]).execute().fetchone()
+    return r[0] or 0
+
 def set_rel_data(rel_type_id, thing_id, **vals):
     table = rel_types_id[rel_type_id].rel_table[3]
     return set_data(table, rel_type_id, thing_id, **vals)
 
+def set_rel_data_multi(rel_type_id, vals_by_id):
+    table = rel_types_id[rel_type_id].rel_table[3]
+    return set_data_multi(table, vals_by_id)
+
 def incr_rel_data(rel_type_id, thing_id, prop, amount):
     table = rel_types_id[rel_type_id].rel_table[3]
     return incr_data_prop(table, rel_type_id, thing_id, prop, amount)
 
+def incr_rel_data_multi(rel_type_id, prop, amounts):
+    table = rel_types_id[rel_type_id].rel_table[3]
+    return incr_data_prop_multi(table, prop, amounts)
+
 def get_rel_data(rel_type_id, rel_id):
     table = rel_types_id[rel_type_id].rel_table[3]
     return get_data(table, rel_id)
@@ -546,6 +690,12 @@ def get_rel(rel_type_id, rel_id):
             res[row.rel_id] = stor
     return res
 
+def get_max_rel_id(rel_type_id):
+    """the highest rel_id of a relation, or 0 if there are none"""
+    table = rel_types_id[rel_type_id].rel_table[0]
+    r = sa.select([sa.func.max(table.c.rel_id)]).execute().fetchone()
+    return r[0] or 0
+
 def del_rel(rel_type_id, rel_id):
     tables = rel_types_id[rel_type_id].rel_table
     table = tables[0]
@@ -765,6 +915,43 @@ def find_data(type_id, get_cols, sort, limit, constraints):
 
     return Results(r, lambda(row): row if get_cols else row.thing_id)
 
+def find_data_values(type_id, key, val, get_key, thing_cols = ()):
+    """a narrow projection of the data table: (thing_id, value of
+    get_key, *thing_cols) for every thing whose key prop is val,
+    ordered by thing_id. the value is None when the thing has no
+    get_key. thing_cols are columns of the thing table, e.g. 'ups'."""
+    d_table = types_id[type_id].data_table[0]
+    t_table = types_id[type_id].thing_table
+    #the thing table can only be joined when it's in the same db
+    joined = thing_cols if t_table.engine is d_table.engine else ()
+    cols = ''.join(', t.%s' % col for col in joined)
+    #substring matches the key_value index
+    sql = ("select a.thing_id, b.value, b.kind%(cols)s from %(t)s a "
+           "left join %(t)s b on b.thing_id = a.thing_id "
+           "and b.key = %%(get_key)s "
+           "%(join)s"
+           "where a.key = %%(key)s "
+           "and substring(a.value, 1, %(len)d) = %%(val)s "
+           "order by a.thing_id"
+           % dict(t = d_table.name, len = max_val_len, cols = cols,
+                  join = ("join %s t on t.thing_id = a.thing_id "
+                          % t_table.name) if joined else ''))
+    r = d_table.engine.execute(sql, dict(key = key, get_key = get_key,
+                                         val = str(py2db(val))))
+    rows = [(row.thing_id,
+             db2py(row.value, row.kind) if row.kind else None)
+            + tuple(getattr(row, col) for col in joined)
+            for row in r.fetchall()]
+
+    if thing_cols and not joined:
+        t_rows = fetch_chunked(t_table, t_table.c.thing_id,
+                               [row[0] for row in rows])
+        t_rows = dict((row.thing_id, tuple(getattr(row, col)
+                                           for col in thing_cols))
+                      for row in t_rows)
+        #things whose thing row is gone are left out, like the join does
+        rows = [row + t_rows[row[0]] for row in rows if row[0] in t_rows]
+    return rows
 
 def find_rels(rel_type_id, get_cols, sort, limit, constraints):
     r_table, t1_table, t2_table, d_table = rel_types_id[rel_type_id].rel_table
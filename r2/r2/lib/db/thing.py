@@ -29,10 +29,13 @@ from .. utils import iters, Results, tup, to36, Storage
 from r2.config import cache
 from r2.config.databases import tz
 from r2.lib.cache import sgm
+from counters import make_aggregator
+from pylons import g
 
-import new, sys, sha
+import new, sys, sha, time
 from datetime import datetime
 from copy import copy, deepcopy
+from threading import local
 
 class NotFound(Exception): pass
 CreationError = tdb.CreationError
@@ -40,6 +43,13 @@ CreationError = tdb.CreationError
 thing_types = {}
 rel_types = {}
 
+#when enabled, _incr leaves the db writes to the aggregator
+if g.aggregate_counters:
+    interval = getattr(g, 'counter_flush_interval', None) or 5
+    counters = make_aggregator(interval)
+else:
+    counters = None
+
 def begin():
     tdb.transactions.begin()
 
@@ -49,6 +59,182 @@ def commit():
 def rollback():
     tdb.transactions.rollback()
 
+class WriteBehind(local):
+    """A per-thread buffer of committed but unwritten things. While it
+    is active, DataThing._commit records the dirty props here and only
+    updates the local cache; flush() then writes everything out grouped
+    by type, with one set_multi to the cache chain."""
+    def __init__(self):
+        self.active = False
+        self.pending = {}
+        self.order = []
+
+    def add(self, thing, thing_props, data_props):
+        key = (thing.__class__, thing._id)
+        entry = self.pending.get(key)
+        if entry:
+            entry[0] = thing
+            entry[1].update(thing_props)
+            entry[2].update(data_props)
+        else:
+            self.pending[key] = [thing, dict(thing_props), dict(data_props)]
+            self.order.append(key)
+
+    def has(self, thing):
+        return (thing.__class__, thing._id) in self.pending
+
+    def discard(self):
+        """drops everything pending without writing it"""
+        self.pending = {}
+        self.order = []
+
+    def flush(self, things = None):
+        """writes the pending things, or only those of things that are
+        pending"""
+        if things is None:
+            keys = self.order
+        else:
+            keys = [(t.__class__, t._id) for t in tup(things)]
+            keys = [k for k in keys if k in self.pending]
+
+        if not keys:
+            return
+
+        by_cls = {}
+        cls_order = []
+        to_cache = {}
+        for key in keys:
+            thing, thing_props, data_props = self.pending.pop(key)
+            cls = key[0]
+            if cls not in by_cls:
+                by_cls[cls] = ({}, {})
+                cls_order.append(cls)
+            props, datas = by_cls[cls]
+            if thing_props:
+                props[thing._id] = thing_props
+            if data_props:
+                datas[thing._id] = data_props
+            to_cache[thing_prefix(cls.__name__, thing._id)] = thing
+        self.order = [k for k in self.order if k in self.pending]
+
+        for cls in cls_order:
+            props, datas = by_cls[cls]
+            if datas:
+                cls._set_data_multi(cls._type_id, datas)
+            if props:
+                cls._set_props_multi(cls._type_id, props)
+
+        cache.set_multi(to_cache)
+
+write_behind = WriteBehind()
+
+def begin_write_behind():
+    """buffers commits on this thread until end_write_behind"""
+    #anything still pending is from a request that never finished
+    write_behind.discard()
+    write_behind.active = True
+
+def end_write_behind():
+    write_behind.flush()
+    write_behind.active = False
+
+def abort_write_behind():
+    """ends write-behind without writing what was committed, for
+    requests that fail part way through"""
+    write_behind.discard()
+    write_behind.active = False
+
+def flush_writes(things = None):
+    """an explicit flush point for code that needs earlier commits to
+    be in the db, e.g. before running a query that depends on them"""
+    write_behind.flush(things)
+
+class IdentityMap(local):
+    """A per-thread map of (cls, id) to the one instance _byID returns
+    for that thing while the map is active, normally for a request.
+    Repeat lookups skip the cache chain entirely."""
+    def __init__(self):
+        self.active = False
+        self.things = {}
+        self.hits = 0
+        self.misses = 0
+
+    def clear(self):
+        self.things = {}
+        self.hits = 0
+        self.misses = 0
+
+identity_map = IdentityMap()
+
+def begin_identity_map():
+    identity_map.clear()
+    identity_map.active = True
+
+def end_identity_map():
+    """Deactivates and empties the identity map, returning its (hits,
+    misses)."""
+    counts = (identity_map.hits, identity_map.misses)
+    identity_map.clear()
+    identity_map.active = False
+    return counts
+
+class NotFoundCache(object):
+    """Remembers for time seconds which ids _byID didn't find in the db,
+    so that repeated lookups of deleted or made up ids (bots, crawlers,
+    old permalinks) don't each go to the db. The entries live in the
+    shared cache layer, keyed by type and id. A time of 0 turns it
+    off.
+
+    Only ids below the highest id of their type in the db are
+    remembered: anything above it may be a thing that is being
+    created, or that a lagging slave hasn't seen yet. The counts in
+    stats() are totals for the process."""
+    def __init__(self, time):
+        self.time = time
+        self.max_ids = {}
+        self.hits = self.misses = self.stores = 0
+
+    def _prefix(self, cls):
+        return thing_prefix(cls.__name__) + 'notfound_'
+
+    def filter(self, cls, ids):
+        """the ids that aren't known to be missing"""
+        if not self.time:
+            return ids
+        known = cache.caches[-1].get_multi(ids, self._prefix(cls))
+        self.hits += len(known)
+        self.misses += len(ids) - len(known)
+        return [i for i in ids if i not in known]
+
+    def _max_id(self, cls, ids):
+        #a max that is out of date only means fewer ids are cached, so
+        #it's looked up again at most once a second
+        max_id, checked = self.max_ids.get(cls, (0, 0))
+        if max(ids) >= max_id and time.time() - checked > 1:
+            max_id = cls._get_max_id(cls._type_id)
+            self.max_ids[cls] = (max_id, time.time())
+        return max_id
+
+    def add(self, cls, ids):
+        if self.time and ids:
+            max_id = self._max_id(cls, ids)
+            ids = [i for i in ids if i < max_id]
+        if self.time and ids:
+            cache.caches[-1].set_multi(dict((i, True) for i in ids),
+                                       self._prefix(cls), time = self.time)
+            self.stores += len(ids)
+
+    def forget(self, cls, ids):
+        if self.time:
+            prefix = self._prefix(cls)
+            cache.caches[-1].delete_multi([prefix + str(i) for i in tup(ids)])
+
+    def stats(self):
+        return dict(hits = self.hits, misses = self.misses,
+                    stores = self.stores)
+
+not_found_cache = NotFoundCache(getattr(g, 'not_found_cache_time', None) or 0)
+
 def obj_id(things):
     return tuple(t if isinstance(t, (int, long)) else t._id for t in things)
 
@@ -68,7 +254,25 @@ class SafeSetAttr:
     def __exit__(self, type, value, tb):
         self.cls.__safe__ = False
 
+_slot_names = {}
+def slot_names(cls):
+    """every slot defined by cls and its bases"""
+    names = _slot_names.get(cls)
+    if names is None:
+        names = []
+        for base in cls.__mro__:
+            for name in base.__dict__.get('__slots__', ()):
+                if name not in names:
+                    names.append(name)
+        names = _slot_names[cls] = tuple(names)
+    return names
+
 class DataThing(object):
+    #the state every thing has lives in slots, as do the base props of
+    #Thing and relations. anything else set on a thing goes in the
+    #__dict__ subclasses get
+    __slots__ = ('_id', '_t', '_dirties', '_created', '_loaded',
+                 'safe_set_attr')
     _base_props = ()
     _int_props = ()
     _data_int_props = ()
@@ -107,18 +311,17 @@ class DataThing(object):
             self._dirties[attr] = val
 
     def __getattr__(self, attr):
-        #makes pickling work for some reason
-        if attr.startswith('__'):
-            raise AttributeError
+        #only called for what isn't a slot, in the __dict__ or on the
+        #class: data props and their defaults. _t is only missing while
+        #a thing is being built or unpickled
+        if attr.startswith('__') or attr == '_t':
+            raise AttributeError, attr
 
         try:
-            if hasattr(self, '_t'):
-                return self._t[attr]
-            else:
-                raise AttributeError, attr
+            return self._t[attr]
         except KeyError:
             try:
-                return getattr(self, '_defaults')[attr]
+                return self._defaults[attr]
             except KeyError:
                 if self._loaded:
                     raise AttributeError, '%s not found' % attr
@@ -126,53 +329,164 @@ class DataThing(object):
                     raise AttributeError,\
                               attr + ' not found. thing is not loaded'
 
+    #fields that are rebuilt or defaulted when a thing is unpickled
+    _transient = ('safe_set_attr', '__safe__')
+
+    def __getstate__(self):
+        """the pickled (cached) state: the base props, _t and anything
+        else set on the thing, without the SafeSetAttr and its
+        back-reference, or the clean/created flags when they're the
+        usual ones."""
+        state = dict(getattr(self, '__dict__', ()))
+        for k in slot_names(self.__class__):
+            try:
+                state[k] = object.__getattribute__(self, k)
+            except AttributeError:
+                pass
+        for k in self._transient:
+            state.pop(k, None)
+        if not state.get('_dirties', True):
+            del state['_dirties']
+        if state.get('_created'):
+            del state['_created']
+        return state
+
+    def __setstate__(self, state):
+        #old pickles have the whole __dict__, slots included
+        setattr = object.__setattr__
+        for k, v in state.iteritems():
+            if k not in self._transient:
+                setattr(self, k, v)
+        if '_dirties' not in state:
+            setattr(self, '_dirties', {})
+        if '_created' not in state:
+            setattr(self, '_created', True)
+        setattr(self, 'safe_set_attr', SafeSetAttr(self))
+
+    def _dirty_props(self, keys=None):
+        """splits the dirty attributes (or just the dirty ones in keys)
+        into (thing_props, data_props) as they will be written"""
+        if keys:
+            to_set = dict((k, self._dirties[k])
+                          for k in keys if self._dirties.has_key(k))
+        else:
+            to_set = self._dirties
+
+        data_props = {}
+        thing_props = {}
+        for k, v in to_set.iteritems():
+            if k.startswith('_'):
+                thing_props[k[1:]] = v
+            else:
+                data_props[k] = v
+        return thing_props, data_props
+
+    def _clean(self, keys=None):
+        if keys:
+            for k in keys:
+                if self._dirties.has_key(k):
+                    del self._dirties[k]
+        else:
+            self._dirties.clear()
+
     def _commit(self, keys=None):
-        if not self._created:
+        #new things are written right away so that nobody can load
+        #one from the db before its data is there
+        creating = not self._created
+        if creating:
             self._create()
 
         if self._dirty:
-            if keys:
-                keys = tup(keys)
-                to_set = dict((k, self._dirties[k])
-                              for k in keys if self._dirties.has_key(k))
+            keys = tup(keys) if keys else None
+            thing_props, data_props = self._dirty_props(keys)
+
+            if write_behind.active and not creating:
+                write_behind.add(self, thing_props, data_props)
             else:
-                to_set = self._dirties
+                if data_props:
+                    self._set_data(self._type_id, self._id, **data_props)
 
-            data_props = {}
-            thing_props = {}
-            for k, v in to_set.iteritems():
-                if k.startswith('_'):
-                    thing_props[k[1:]] = v
-                else:
-                    data_props[k] = v
+                if thing_props:
+                    self._set_props(self._type_id, self._id, **thing_props)
 
-            if data_props:
-                self._set_data(self._type_id, self._id, **data_props)
-            
-            if thing_props:
-                self._set_props(self._type_id, self._id, **thing_props)
-            
-            if keys:
-                for k in keys:
-                    if self._dirties.has_key(k):
-                        del self._dirties[k]
-            else:
-                self._dirties.clear()
+            self._clean(keys)
 
-        # always set the cache
-        cache.set(thing_prefix(self.__class__.__name__, self._id), self)
+        # always set the cache. pending things only go to the local
+        # cache until they're flushed
+        key = thing_prefix(self.__class__.__name__, self._id)
+        if write_behind.has(self):
+            cache.caches[0].set(key, self)
+        else:
+            cache.set(key, self)
+
+        #once everything is written. lookups on a slave that hasn't
+        #seen it yet can't cache it as missing again, as it's above
+        #the max id there
+        if creating:
+            not_found_cache.forget(self.__class__, self._id)
+
+    @classmethod
+    def _commit_multi(cls, things):
+        """commits many things of this class at once. the data props of
+        all of them are written with one batched upsert, the base props
+        with one update per set of changed props, and the cache with a
+        single set_multi."""
+        things = tup(things)
+        if not things:
+            return
+
+        #older buffered values mustn't land on top of these
+        flush_writes(things)
+
+        datas = {}
+        props = {}
+        created = []
+        for t in things:
+            if not t._created:
+                t._create()
+                created.append(t._id)
+            if t._dirty:
+                thing_props, data_props = t._dirty_props()
+                if data_props:
+                    datas[t._id] = data_props
+                if thing_props:
+                    props[t._id] = thing_props
+                t._clean()
+
+        if datas:
+            cls._set_data_multi(cls._type_id, datas)
+
+        if props:
+            cls._set_props_multi(cls._type_id, props)
+
+        cache.set_multi(dict((t._id, t) for t in things),
+                        thing_prefix(cls.__name__))
+
+        if created:
+            not_found_cache.forget(cls, created)
 
     @classmethod
     def _load_multi(cls, need):
         need = tup(need)
+        #don't read over data that hasn't been written yet
+        flush_writes(need)
         need_ids = [n._id for n in need]
-        datas = cls._get_data(cls._type_id, need_ids)
-        to_save = {}
-        for i in need:
-            #if there wasn't any data, keep the empty dict
-            i._t.update(datas.get(i._id, i._t))
-            i._loaded = True
-            to_save[i._id] = i
+        if counters:
+            counters.begin_fill(cls)
+        try:
+            datas = cls._get_data(cls._type_id, need_ids)
+            to_save = {}
+            for i in need:
+                #if there wasn't any data, keep the empty dict
+                i._t.update(datas.get(i._id, i._t))
+                i._loaded = True
+                to_save[i._id] = i
+
+            if counters:
+                counters.merge_pending(cls, to_save, False)
+        finally:
+            if counters:
+                counters.end_fill(cls)
 
         prefix = thing_prefix(cls.__name__)
 
@@ -209,13 +523,22 @@ class DataThing(object):
         if self._dirty:
             raise ValueError, "cannot incr dirty thing"
 
+        #the increment goes straight to the db, so earlier commits of
+        #this thing have to get there first
+        flush_writes(self)
+
         prefix = thing_prefix(self.__class__.__name__)
         key =  prefix + prop + '_' + str(self._id)
         cache_val = old_val = cache.get(key)
         if old_val is None:
             old_val = getattr(self, prop)
 
-        if self._defaults.has_key(prop) and self._defaults[prop] == old_val:
+        #an unwritten delta means the value only looks like the default
+        pending = counters and counters.has_pending(self.__class__,
+                                                    self._id, prop)
+
+        if (not pending and self._defaults.has_key(prop)
+            and self._defaults[prop] == old_val):
             #potential race condition if the same property gets incr'd
             #from default at the same time
             setattr(self, prop, old_val + amt)
@@ -223,7 +546,11 @@ class DataThing(object):
         else:
             self.__setattr__(prop, old_val + amt, False)
             #db
-            if prop.startswith('_'):
+            #relations have no batched base prop increment
+            if counters and (not prop.startswith('_')
+                             or isinstance(self, Thing)):
+                counters.incr(self.__class__, self._id, prop, amt)
+            elif prop.startswith('_'):
                 tdb.incr_thing_prop(self._type_id, self._id, prop[1:], amt)
             else:
                 self._incr_data(self._type_id, self._id, prop, amt)
@@ -250,9 +577,24 @@ class DataThing(object):
         prefix = thing_prefix(cls.__name__)
 
         def items_db(ids):
-            items = cls._get_item(cls._type_id, ids)
-            for i in items.keys():
-                items[i] = cls._build(i, items[i])
+            ids = not_found_cache.filter(cls, ids)
+            if not ids:
+                return {}
+
+            if counters:
+                counters.begin_fill(cls)
+            try:
+                items = cls._get_item(cls._type_id, ids)
+                for i in items.keys():
+                    items[i] = cls._build(i, items[i])
+
+                #the data props aren't loaded yet; _load_multi merges those
+                if counters:
+                    counters.merge_pending(cls, items, True)
+            finally:
+                if counters:
+                    counters.end_fill(cls)
+            not_found_cache.add(cls, [i for i in ids if i not in items])
 
             #avoid race condition when incrmenting int props (data int
             #props are set in load_multi)
@@ -263,7 +605,26 @@ class DataThing(object):
 
             return items
 
-        bases = sgm(cache, ids, items_db, prefix)
+        if identity_map.active:
+            known = identity_map.things
+            bases = {}
+            need = []
+            for i in ids:
+                thing = known.get((cls, i))
+                if thing is None:
+                    need.append(i)
+                else:
+                    bases[i] = thing
+            identity_map.hits += len(ids) - len(need)
+            identity_map.misses += len(need)
+
+            if need:
+                found = sgm(cache, need, items_db, prefix)
+                for i, thing in found.iteritems():
+                    known[(cls, i)] = thing
+                bases.update(found)
+        else:
+            bases = sgm(cache, ids, items_db, prefix)
 
         #check to see if we found everything we asked for
         if any(i not in bases for i in ids):
@@ -353,9 +714,23 @@ class DataThing(object):
     def _set_data(*a, **kw):
         raise NotImplementedError()
 
+    def _set_data_multi(*a, **kw):
+        raise NotImplementedError()
+
+    @classmethod
+    def _set_props_multi(cls, type_id, props_by_id):
+        for thing_id, props in props_by_id.iteritems():
+            cls._set_props(type_id, thing_id, **props)
+
     def _incr_data(*a, **kw):
         raise NotImplementedError()
 
+    def _incr_data_multi(*a, **kw):
+        raise NotImplementedError()
+
+    def _incr_props_multi(*a, **kw):
+        raise NotImplementedError()
+
     def _get_item(*a, **kw):
         raise NotImplementedError
 
@@ -387,13 +762,19 @@ class ThingMeta(type):
 class Thing(DataThing):
     __metaclass__ = ThingMeta
     _base_props = ('_ups', '_downs', '_date', '_deleted', '_spam')
+    __slots__ = _base_props
     _int_props = ('_ups', '_downs')
     _make_fn = staticmethod(tdb.make_thing)
     _set_props = staticmethod(tdb.set_thing_props)
     _get_data = staticmethod(tdb.get_thing_data)
     _set_data = staticmethod(tdb.set_thing_data)
+    _set_data_multi = staticmethod(tdb.set_thing_data_multi)
+    _set_props_multi = staticmethod(tdb.set_thing_props_multi)
     _get_item = staticmethod(tdb.get_thing)
+    _get_max_id = staticmethod(tdb.get_max_thing_id)
     _incr_data = staticmethod(tdb.incr_thing_data)
+    _incr_data_multi = staticmethod(tdb.incr_thing_data_multi)
+    _incr_props_multi = staticmethod(tdb.incr_thing_prop_multi)
     _type_prefix = 't'
 
     def __init__(self, ups = 0, downs = 0, date = None, deleted = False,
@@ -469,8 +850,15 @@ class Thing(DataThing):
 
         return Things(cls, *rules, **kw)
 
-    def __getattr__(self, attr):
-        return DataThing.__getattr__(self, attr)
+    @classmethod
+    def _data_values(cls, key, val, get_key, thing_cols = ()):
+        """Returns (id, value of get_key, *thing_cols) for every thing
+        of this type whose data prop key is val, deleted and spam
+        included, without loading the rest of their data. The value is
+        None for things without get_key. thing_cols are base props
+        without their underscore, e.g. 'ups'."""
+        return tdb.find_data_values(cls._type_id, key, val, get_key,
+                                    thing_cols)
             
         
 
@@ -503,12 +891,16 @@ def Relation(type1, type2, denorm1 = None, denorm2 = None):
         _type2 = type2
 
         _base_props = ('_thing1_id', '_thing2_id', '_name', '_date')
+        __slots__ = _base_props
         _make_fn = staticmethod(tdb.make_relation)
         _set_props = staticmethod(tdb.set_rel_props)
         _get_data = staticmethod(tdb.get_rel_data)
         _set_data = staticmethod(tdb.set_rel_data)
+        _set_data_multi = staticmethod(tdb.set_rel_data_multi)
         _get_item = staticmethod(tdb.get_rel)
+        _get_max_id = staticmethod(tdb.get_max_rel_id)
         _incr_data = staticmethod(tdb.incr_rel_data)
+        _incr_data_multi = staticmethod(tdb.incr_rel_data_multi)
         _type_prefix = 'r'
 
         def __init__(self, thing1, thing2, name, date = None, id = None, **attrs):
@@ -569,6 +961,9 @@ def Relation(type1, type2, denorm1 = None, denorm2 = None):
 
         def _commit(self):
             DataThing._commit(self)
+            self._after_commit()
+
+        def _after_commit(self):
             #if i denormalized i need to check here
             if denorm1: self._thing1._commit(denorm1[0])
             if denorm2: self._thing2._commit(denorm2[0])
@@ -577,7 +972,15 @@ def Relation(type1, type2, denorm1 = None, denorm2 = None):
                       + str((self._thing1_id, self._thing2_id, self._name)),
                       self._id)
 
+        @classmethod
+        def _commit_multi(cls, rels):
+            rels = tup(rels)
+            super(RelationCls, cls)._commit_multi(rels)
+            for rel in rels:
+                rel._after_commit()
+
         def _delete(self):
+            flush_writes(self)
             tdb.del_rel(self._type_id, self._id)
             
             #clear cache
@@ -780,7 +1183,8 @@ class Query(object):
                 lst = Thing._by_fullname(names, data = self._data, return_dict = False)
 
         if lst is None:
-            #hit the db
+            #hit the db, which has to see any buffered commits
+            flush_writes()
             lst = self._cursor().fetchall()
         else:
             used_cache = True
@@ -852,6 +1256,14 @@ def load_things(rels, load_data=False):
     if not kind._gay():
         t2_items = kind._type2._byID(t2_ids, load_data)
 
+def prefetch(cls, items, attr, data = False):
+    """Loads the cls things whose ids are the attr of each of items with
+    a single _byID, for add_props and the like. Items without attr are
+    skipped. Returns a dict of id to thing."""
+    ids = set(getattr(i, attr) for i in items if hasattr(i, attr))
+    ids.discard(None)
+    return cls._byID(ids, data = data) if ids else {}
+
 class Relations(Query):
     #params are thing1, thing2, name, date
     def __init__(self, kind, *rules, **kw):
@@ -1036,10 +1448,10 @@ def MultiRelation(name, *relations):
         c = operators.Slots()
         rels = rels_tmp
 
-        def __init__(self, thing1, thing2, *a, **kw):
-            r = self.rel(thing1, thing2)
-            self.__class__ = r
-            self.__init__(thing1, thing2, *a, **kw)
+        def __new__(cls, thing1, thing2, *a, **kw):
+            #the relations keep their state in slots, so build the
+            #right one instead of changing __class__ afterwards
+            return cls.rel(thing1, thing2)(thing1, thing2, *a, **kw)
 
         @classmethod
         def rel(cls, thing1, thing2):
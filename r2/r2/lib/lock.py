@@ -23,11 +23,18 @@
 from __future__ import with_statement
 from time import sleep
 from datetime import datetime
-
-from pylons import c
+from threading import local
 
 class TimeoutExpired(Exception): pass
 
+class HeldLocks(local):
+    """the locks each thread holds. per thread rather than per request
+    so that background threads can take locks too"""
+    def __init__(self):
+        self.locks = {}
+
+held = HeldLocks()
+
 class MemcacheLock(object):
     """A simple global lock based on the memcache 'add' command. We
     attempt to grab a lock by 'adding' the lock name. If the response
@@ -43,32 +50,31 @@ class MemcacheLock(object):
     def __enter__(self):
         start = datetime.now()
 
-        if not c.locks:
-            c.locks = {}
-
         #if this thread already has this lock, move on
-        if c.locks.get(self.key):
+        if held.locks.get(self.key):
             return
 
-        #try and fetch the lock, looping until it's available
+        #try and fetch the lock, looping until it's available. a
+        #timeout of 0 only tries once
         while not self.cache.add(self.key, 1, time = self.time):
-            if (datetime.now() - start).seconds > self.timeout:
+            if (not self.timeout
+                or (datetime.now() - start).seconds > self.timeout):
                 raise TimeoutExpired
 
             sleep(.1)
 
         #tell this thread we have this lock so we can avoid deadlocks
         #of requests for the same lock in the same thread
-        c.locks[self.key] = True
+        held.locks[self.key] = True
         self.have_lock = True
 
     def __exit__(self, type, value, tb):
         #only release the lock if we gained it in the first place
         if self.have_lock:
             self.cache.delete(self.key)
-            del c.locks[self.key]
+            del held.locks[self.key]
 
 def make_lock_factory(cache):
-    def factory(key):
-        return MemcacheLock(key, cache)
+    def factory(key, **kw):
+        return MemcacheLock(key, cache, **kw)
     return factory
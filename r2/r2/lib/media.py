@@ -73,16 +73,18 @@ def make_link_info_job(results, link, useragent):
 
     return job
 
-def update_link(link, thumbnail, media_object):
+def update_link(link, thumbnail, media_object, commit = True):
     """Sets the link's has_thumbnail and media_object attributes iin the
-    database."""
+    database. If commit is False the link is left dirty so the caller
+    can write many links at once with Link._commit_multi."""
     if thumbnail:
         link.has_thumbnail = True
 
     if media_object:
         link.media_object = media_object
 
-    link._commit()
+    if commit:
+        link._commit()
 
 def process_new_links(period = media_period, force = False):
     """Fetches links from the last period and sets their media
@@ -103,11 +105,12 @@ def process_new_links(period = media_period, force = False):
     #send links to a queue
     wq = WorkQueue(jobs, num_workers = 20, timeout = 30)
     wq.start()
-    wq.jobs.join()
+    wq.wait()
 
     #when the queue is finished, do the db writes in this thread
     for link, info in results.items():
-        update_link(link, info[0], info[1])
+        update_link(link, info[0], info[1], commit = False)
+    Link._commit_multi(results.keys())
 
 def set_media(link):
     """Sets the media properties for a single link."""
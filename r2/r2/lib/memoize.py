@@ -20,11 +20,14 @@
 # CondeNet, Inc. All Rights Reserved.
 ################################################################################
 from r2.config import cache
+from r2.lib.cache import flights
 import sha
 
 class NoneResult(object): pass
 
 def memoize(iden, time = 0):
+    """caches fn's results by iden and arguments. When a result is
+    missing only one caller computes it; see cache.SingleFlight"""
     def memoize_fn(fn):
         from r2.lib.memoize import NoneResult
         def new_fn(*a, **kw):
@@ -32,10 +35,13 @@ def memoize(iden, time = 0):
             #print 'CHECKING', key
             res = cache.get(key)
             if res is None:
-                res = fn(*a, **kw)
-                if res is None:
-                    res = NoneResult
-                cache.set(key, res, time = time)
+                def miss_fn(keys):
+                    res = fn(*a, **kw)
+                    if res is None:
+                        res = NoneResult
+                    return {key: res}
+                res = flights.fill_multi(cache, [key], miss_fn,
+                                         time = time)[key]
             if res == NoneResult:
                 res = None
             return res
@@ -46,6 +52,8 @@ def clear_memo(iden, *a, **kw):
     key = iden + str(a) + str(kw)
     #print 'CLEARING', key
     cache.delete(key)
+    #an explicit clear shouldn't be answered with the old value
+    flights.shared_cache(cache).delete(flights.side_key('stale_', key))
 
 @memoize('test')
 def test(x, y):
@@ -27,9 +27,11 @@ def run():
     sr_counts = count.get_sr_counts()
     names = [k for k, v in sr_counts.iteritems() if v != 0]
     srs = Subreddit._by_fullname(names)
+    changed = []
     for name in names:
         sr,c = srs[name], sr_counts[name]
         if c != sr._downs and c > 0:
             sr._downs = max(c, 0)
-            sr._commit()
+            changed.append(sr)
+    Subreddit._commit_multi(changed)
     count.clear_sr_counts(names)
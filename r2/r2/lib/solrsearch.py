@@ -32,8 +32,8 @@ from r2.models import *
 from r2.lib.contrib import pysolr
 from r2.lib.contrib.pysolr import SolrError
 from r2.lib.utils import timeago, set_emptying_cache, IteratorChunker
+from r2.lib.utils import make_script_cache
 from r2.lib.utils import psave, pload, unicode_safe, tup
-from r2.lib.cache import SelfEmptyingCache
 from Queue import Queue
 from threading import Thread
 import time
@@ -366,7 +366,7 @@ def reindex_all(types = None, delete_all_first=False):
     # utils.set_emptying_cache, except that that preserves memcached,
     # and we don't even want to get memcached for total indexing,
     # because it would dump out more recent stuff)
-    g.cache.caches = (SelfEmptyingCache(),) # + g.cache.caches[1:]
+    g.cache.caches = (make_script_cache(),) # + g.cache.caches[1:]
 
     count = 0
     q=Queue(100)
@@ -53,6 +53,15 @@ assert(c1.get_multi(('p_3', 'p_4')) == {'p_3':3, 'p_4': 4})
 assert(c2.get_multi(('p_3', 'p_4')) == {'p_3':3, 'p_4': 4})
 assert(c.get_multi(('p_3', 'p_4')) == {'p_3':3, 'p_4': 4})
 
+#set multi, prefix and time
+c2.set_multi({'7': 7}, prefix='t_', time=100)
+assert(c2.get('t_7') == 7)
+
+#backfills don't replace what's there
+c.backfill_multi({'7': 8, '8': 8}, prefix='t_')
+assert(c2.get('t_7') == 7)
+assert(c2.get('t_8') == 8)
+
 #incr
 c.set('5', 1)
 c.set('6', 1)
@@ -83,3 +92,85 @@ c2.set('1', 4)
 c.set('3', 3)
 
 assert(c.get_multi((1,2,3)) == {1:1, 2:2, 3:3})
+
+#single flight
+import threading, time
+
+calls = []
+def miss(keys):
+    calls.append(list(keys))
+    time.sleep(.5)
+    return dict((k, 'v' + k) for k in keys if k != 'gone')
+
+#one thread computes, the rest wait for it
+sf = SingleFlight(wait = 2)
+outs = []
+def fill():
+    chain = CacheChain((LocalCache(), c2))
+    outs.append(sf.fill_multi(chain, ['a', 'b', 'gone'], miss, 'sf_',
+                              time = 10))
+threads = [threading.Thread(target = fill) for i in range(8)]
+for t in threads: t.start()
+for t in threads: t.join()
+assert(len(calls) == 1)
+assert(outs == [{'a': 'va', 'b': 'vb'}] * 8)
+assert(c2.get('sf_a') == 'va')
+assert(c2.get('stale_sf_a') == 'va')
+assert(c2.get('lease_sf_a') is None)
+
+#another process has the lease: the stale copy is served right away
+c2.delete('sf_a')
+c2.add('lease_sf_a', 1, time = 30)
+chain = CacheChain((LocalCache(), c2))
+start = time.time()
+assert(sf.fill_multi(chain, ['a'], miss, 'sf_', time = 10) == {'a': 'va'})
+assert(time.time() - start < .3)
+assert(len(calls) == 1)
+
+#no stale copy: wait for the other process to fill it
+c2.delete('stale_sf_a')
+def other():
+    time.sleep(.3)
+    c2.set('sf_a', 'new')
+    c2.delete('lease_sf_a')
+threading.Thread(target = other).start()
+assert(sf.fill_multi(chain, ['a'], miss, 'sf_', time = 10) == {'a': 'new'})
+assert(len(calls) == 1)
+
+#nobody fills it: computed once the lease wait is up, not the full wait
+c2.delete('sf_a')
+c2.delete('stale_sf_a')
+c2.add('lease_sf_a', 1, time = 30)
+chain = CacheChain((LocalCache(), c2))
+start = time.time()
+assert(sf.fill_multi(chain, ['a'], miss, 'sf_', time = 10) == {'a': 'va'})
+assert(time.time() - start < sf.wait)
+assert(len(calls) == 2)
+c2.delete('lease_sf_a')
+
+#side keys too long for memcache are hashed
+long_key = 'k' * 245
+assert(len(sf.side_key('stale_', 'sf_' + long_key)) <= 250)
+assert(sf.side_key('stale_', 'sf_a') == 'stale_sf_a')
+assert(sf.fill_multi(chain, [long_key], miss, 'sf_', time = 10)
+       == {long_key: 'v' + long_key})
+assert(c2.get(sf.side_key('stale_', 'sf_' + long_key)) == 'v' + long_key)
+assert(c2.get(sf.side_key('lease_', 'sf_' + long_key)) is None)
+
+#without memcache there are no leases
+assert(SingleFlight().fill_multi(LocalCache(), ['x'], miss) == {'x': 'vx'})
+
+#failures get to the caller and leave no flights or leases behind
+def fail(keys):
+    raise ValueError
+try:
+    sf.fill_multi(chain, ['z'], fail, 'sf_')
+    assert(False)
+except ValueError:
+    pass
+assert(not sf.flights)
+assert(c2.get('lease_sf_z') is None)
+
+#through sgm
+assert(sgm(chain, [1, 2], lambda keys: dict((k, k * 2) for k in keys),
+           'sf_', single_flight = True) == {1: 2, 2: 4})
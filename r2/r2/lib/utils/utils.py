@@ -863,16 +863,25 @@ def fetch_things2(query, chunk_size = 100, batch_fn = None):
             query._after(i)
             items = list(query)
 
+def make_script_cache():
+    """
+        A bounded LRU cache for the thread-local layer of long-running
+        processes, sized by script_cache_items and script_cache_bytes
+    """
+    from pylons import g
+    from r2.lib.cache import LRUCache
+    return LRUCache(getattr(g, 'script_cache_items', None) or 100*1000,
+                    getattr(g, 'script_cache_bytes', None) or 0)
+
 def set_emptying_cache():
     """
         The default thread-local cache is a regular dictionary, which
         isn't designed for long-running processes. This sets the
-        thread-local cache to be a SelfEmptyingCache, which naively
-        empties itself out every N requests
+        thread-local cache to be an LRUCache (see make_script_cache),
+        which evicts the least recently used items past its limit
     """
     from pylons import g
-    from r2.lib.cache import SelfEmptyingCache
-    g.cache.caches = [SelfEmptyingCache(),] + list(g.cache.caches[1:])
+    g.cache.caches = [make_script_cache(),] + list(g.cache.caches[1:])
 
 def find_recent_broken_things(from_time = None, delete = False):
     """
@@ -20,79 +20,185 @@
 # CondeNet, Inc. All Rights Reserved.
 ################################################################################
 
+from __future__ import with_statement
 from pylons import g
-from Queue import Queue, Empty
-from threading import Thread
-from datetime import datetime, timedelta
-import time
+from Queue import Queue
+from threading import Thread, Lock, Event, currentThread
+import sys, time, traceback
 
 log = g.log
 
+class JobTimeout(Exception): pass
+
+class Job(object):
+    """The pending result of a function added to a WorkQueue."""
+    def __init__(self, fn):
+        self.fn = fn
+        self.result = None
+        self.exception = None
+        self.exc_info = None
+        self.started = None
+        self._done = Event()
+
+    def done(self):
+        return self._done.isSet()
+
+    def get(self, timeout = None):
+        """Blocks until the job is finished and returns its result, or
+        raises the exception it raised, with its traceback (JobTimeout
+        if it timed out)."""
+        self._done.wait(timeout)
+        if not self.done():
+            raise JobTimeout
+        if self.exc_info is not None:
+            e_type, e_val, e_tb = self.exc_info
+            raise e_type, e_val, e_tb
+        if self.exception is not None:
+            raise self.exception
+        return self.result
+
+    def _finish(self, result = None, exception = None, exc_info = None):
+        """exc_info is the sys.exc_info() of a job that raised"""
+        self.result = result
+        self.exc_info = exc_info
+        self.exception = exc_info[1] if exc_info else exception
+        self._done.set()
+
 class WorkQueue(object):
     """A WorkQueue is a queue that takes a number of functions and runs
-    them in parallel"""
+    them in parallel on a fixed pool of threads"""
 
-    def __init__(self, jobs = [], num_workers = 5, timeout = None):
+    def __init__(self, jobs = [], num_workers = 5, timeout = None,
+                 max_queued = 0):
         """Creates a WorkQueue that will process jobs with num_workers
         threads. If a job takes longer than timeout seconds to run, WorkQueue
-        won't wait for it to finish before claiming to be finished."""
-        self.jobs = Queue()
-        self.work_count = Queue(num_workers)
-        self.workers = {}
-        if timeout:
-            self.timeout = timedelta(seconds = timeout)
-        else:
-            self.timeout = None
-
-        for j in jobs:
-            self.jobs.put(j)
-
-    def monitor(self):
-        """The monitoring thread. Every second it checks for finished, dead,
-        or timed-out jobs and removes them from the queue."""
+        won't wait for it to finish before claiming to be finished, and
+        replaces the thread running it. If max_queued is set, add()
+        blocks while that many jobs are waiting for a thread."""
+        self.jobs = Queue(max_queued)
+        self.num_workers = num_workers
+        self.timeout = timeout
+        self.initial_jobs = list(jobs)
+
+        self.lock = Lock()
+        #worker thread -> the job it's running
+        self.running = {}
+        #threads whose job timed out, they exit when it finishes
+        self.retired = set()
+
+        self.started = None
+        self.counts = dict(added = 0, done = 0, failed = 0, timed_out = 0)
+
+    def worker(self):
+        """The main loop of a pool thread. Pull a job off the job queue
+        and run it."""
+        me = currentThread()
         while True:
-            for worker, start_time in self.workers.items():
-                if (not worker.isAlive() or
-                    self.timeout
-                    and datetime.now() - start_time > self.timeout): 
-
-                    self.work_count.get_nowait()
+            job = self.jobs.get()
+            with self.lock:
+                self.running[me] = job
+                job.started = time.time()
+
+            result, exc_info = None, None
+            retired = False
+            try:
+                try:
+                    result = job.fn()
+                except:
+                    #anything a job raises, SystemExit included, is its
+                    #result rather than the end of this thread
+                    exc_info = sys.exc_info()
+                    log.error('WorkQueue job failed: %s'
+                              % traceback.format_exc())
+            finally:
+                #whatever happens the job is finished, or wait() hangs
+                with self.lock:
+                    if me in self.retired:
+                        #the job already finished as timed out
+                        self.retired.remove(me)
+                        retired = True
+                    else:
+                        del self.running[me]
+                        self.counts['failed' if exc_info else 'done'] += 1
+                if not retired:
+                    job._finish(result, exc_info = exc_info)
                     self.jobs.task_done()
-                    del self.workers[worker]
 
-            time.sleep(1)
+            if retired:
+                return
 
-    def run(self):
-        """The main thread for the queue. Pull a job off the job queue and
-        create a thread for it."""
+    def monitor(self):
+        """The monitoring thread. Sleeps until the oldest running job is
+        due and times it out if it's still running."""
         while True:
-            job = self.jobs.get()
-
-            work_thread = Thread(target = job)
-            work_thread.setDaemon(True)
-            self.work_count.put(True)
-            self.workers[work_thread] = datetime.now()
-            work_thread.start()
+            now = time.time()
+            next_due = now + self.timeout
+            timed_out = []
+            with self.lock:
+                for worker, job in self.running.items():
+                    due = job.started + self.timeout
+                    if due <= now:
+                        timed_out.append(job)
+                        self.retired.add(worker)
+                        del self.running[worker]
+                        self.counts['timed_out'] += 1
+                    else:
+                        next_due = min(next_due, due)
+
+            for job in timed_out:
+                job._finish(exception = JobTimeout())
+                self.start_worker()
+                self.jobs.task_done()
+
+            time.sleep(max(next_due - time.time(), 0.01))
+
+    def start_worker(self):
+        t = Thread(target = self.worker)
+        t.setDaemon(True)
+        t.start()
 
     def start(self):
-        """Spawn a monitoring thread and the main thread for this queue. """
-        monitor_thread = Thread(target = self.monitor)
-        monitor_thread.setDaemon(True)
-        monitor_thread.start()
-
-        main_thread = Thread(target = self.run)
-        main_thread.setDaemon(True)
-        main_thread.start()
+        """Spawn the worker threads and, if jobs can time out, a
+        monitoring thread for this queue."""
+        self.started = time.time()
+        for i in xrange(self.num_workers):
+            self.start_worker()
+
+        if self.timeout:
+            monitor_thread = Thread(target = self.monitor)
+            monitor_thread.setDaemon(True)
+            monitor_thread.start()
+
+        jobs, self.initial_jobs = self.initial_jobs, []
+        for j in jobs:
+            self.add(j)
 
     def add(self, job):
-        """Put a new job on the queue."""
+        """Put a new job on the queue, blocking while the queue is full.
+        Returns the Job for the result."""
+        job = Job(job)
+        with self.lock:
+            self.counts['added'] += 1
         self.jobs.put(job)
+        return job
 
     def wait(self):
         """Blocks until every job that has been added to the queue is
         finished."""
         self.jobs.join()
 
+    def stats(self):
+        """The job counts, how many jobs are waiting and running and the
+        jobs finished per second since start()."""
+        with self.lock:
+            s = self.counts.copy()
+            s['running'] = len(self.running)
+        s['queued'] = self.jobs.qsize()
+        elapsed = time.time() - self.started if self.started else 0
+        finished = s['done'] + s['failed'] + s['timed_out']
+        s['throughput'] = finished / elapsed if elapsed else 0
+        return s
+
 def test():
     def make_job(n):
         import random, time
@@ -32,10 +32,15 @@ import subreddit
 from r2.lib.wrapped import Wrapped
 from r2.lib import utils
 from r2.lib.db import operators
+from r2.lib.db.thing import prefetch
 from r2.lib.cache import sgm
-from r2.lib.comment_tree import link_comments
+from r2.lib.comment_tree import link_comments, tree_sorts, sort_key
+from r2.lib.comment_tree import comment_votes, subtree
 
 from copy import deepcopy, copy
+from itertools import islice, count
+from collections import deque
+import heapq
 
 import time
 from datetime import datetime,timedelta
@@ -59,14 +64,7 @@ class Builder(object):
         user = c.user if c.user_is_loggedin else None
 
         #get authors
-        #TODO pull the author stuff into add_props for links and
-        #comments and messages?
-        try:
-            aids = set(l.author_id for l in items)
-        except AttributeError:
-            aids = None
-
-        authors = Account._byID(aids, True) if aids else {}
+        authors = prefetch(Account, items, 'author_id', data=True)
         # srids = set(l.sr_id for l in items if hasattr(l, "sr_id"))
         subreddits = Subreddit.load_subreddits(items)
 
@@ -340,22 +338,27 @@ class UnbannedCommentBuilder(QueryBuilder):
 
 class IDBuilder(QueryBuilder):
     def init_query(self):
-        names = self.names = list(tup(self.query))
+        #the names are consumed lazily so a merged listing only
+        #produces as many as get_items ends up using
+        names = iter(tup(self.query))
 
         if self.reverse:
+            names = list(names)
             names.reverse()
+            names = iter(names)
 
         if self.after:
-            try:
-                i = names.index(self.after._fullname)
-            except ValueError:
-                self.names = ()
-            else:
-                self.names = names[i + 1:]
+            #skip up to and including after. if it isn't there,
+            #names will be exhausted
+            after_name = self.after._fullname
+            for name in names:
+                if name == after_name:
+                    break
+
+        self.names = names
 
     def fetch_more(self, last_item, num_have):
         done = False
-        names = self.names
         if self.num:
             num_need = self.num - num_have
             if num_need <= 0:
@@ -365,10 +368,10 @@ class IDBuilder(QueryBuilder):
                     last_item = None
                 slice_size = max(int(num_need * EXTRA_FACTOR), 1)
         else:
-            slice_size = len(names)
+            slice_size = None
             done = True
 
-        self.names, new_names = names[slice_size:], names[:slice_size]
+        new_names = list(islice(self.names, slice_size))
         new_items = Thing._by_fullname(new_names, data = True, return_dict=False)
 
         return done, new_items
@@ -422,12 +425,16 @@ class CommentBuilder(Builder):
         self.comment = comment
         self.context = context
 
-        if sort.col == '_date':
-            self.sort_key = lambda x: x._date
-        else:
-            self.sort_key = lambda x: (getattr(x, sort.col), x._date)
+        self.sort_col = sort.col
         self.rev_sort = True if isinstance(sort, operators.desc) else False
 
+    def sort_key(self, votes):
+        """The key that puts comments in the builder's order when sorted
+        ascending, from the votes kept in the comment tree."""
+        if self.sort_col in tree_sorts:
+            return sort_key(self.sort_col, votes, self.rev_sort)
+        return ((-1 if self.rev_sort else 1) * votes[2],)
+
     def item_iter(self, a):
         for i in a:
             yield i
@@ -437,10 +444,22 @@ class CommentBuilder(Builder):
 
     def get_items(self, num, nested = True, starting_depth = 0):
         r = link_comments(self.link._id)
-        cids, comment_tree, depth, num_children = r
+        cids, comment_tree, depth, num_children, parents, sort_data = r
+
+        #when loading a portion of the tree, only the subtrees of the
+        #requested comments are walked and loaded
+        if isinstance(self.comment, utils.iters):
+            cids = subtree(comment_tree, [cm._id for cm in self.comment])
+            comment_tree = dict((cid, comment_tree[cid]) for cid in cids
+                                if comment_tree.has_key(cid))
+            #their parents may be needed for a MoreRecursion link
+            cids.extend(set(parents.get(cm._id) for cm in self.comment)
+                        - set(cids) - set([None]))
+
+        #only the thing props are needed to pick the comments, the data
+        #is loaded below for the ones that are shown
         if cids:
-            comments = set(Comment._byID(cids, data = True, 
-                                         return_dict = False))
+            comments = Comment._byID(cids, return_dict = False)
         else:
             comments = ()
 
@@ -458,6 +477,17 @@ class CommentBuilder(Builder):
             
         comment_dict = dict((cm._id, cm) for cm in comments)
 
+        #the children of each comment in the builder's order. the tree
+        #keeps them sorted, and comment_tree is in date order.
+        if self.sort_col in tree_sorts:
+            child_order = sort_data['orders'][self.sort_col]
+            if not self.rev_sort:
+                child_order = dict((k, v[::-1])
+                                   for k, v in child_order.iteritems())
+        else:
+            child_order = dict((k, v[::-1] if self.rev_sort else v)
+                               for k, v in comment_tree.iteritems())
+
         #convert tree into objects
         for k, v in comment_tree.iteritems():
             comment_tree[k] = [comment_dict[cid] for cid in comment_tree[k]]
@@ -482,18 +512,18 @@ class CommentBuilder(Builder):
             top = self.comment
             dont_collapse.append(top._id)
             #add parents for context
-            while self.context > 0 and hasattr(top, 'parent_id'):
+            while self.context > 0 and parents.get(top._id):
                 self.context -= 1
-                new_top = comment_dict[top.parent_id]
+                new_top = comment_dict[parents[top._id]]
                 comment_tree[new_top._id] = [top]
+                child_order[new_top._id] = [top._id]
                 num_children[new_top._id] = num_children[top._id] + 1
                 dont_collapse.append(new_top._id)
                 top = new_top
             candidates = [top]
         #else start with the root comments
         else:
-            candidates = []
-            candidates.extend(comment_tree.get(top, ()))
+            candidates = None
 
         #update the starting depth if required
         if top and depth[top._id] > 0:
@@ -501,32 +531,60 @@ class CommentBuilder(Builder):
             for k, v in depth.iteritems():
                 depth[k] = v - delta
 
-        def sort_candidates():
-            candidates.sort(key = self.sort_key, reverse = self.rev_sort)
-        
+        #candidates are kept in a heap of (sort key, order added,
+        #comment, its siblings, its index in them). siblings are already
+        #in order, so only the first child of a comment is added and
+        #each sibling adds the next one when it's taken.
+        added = count()
+        def push_candidate(cm, siblings = None, i = 0):
+            votes = sort_data['votes'].get(cm._id) or comment_votes(cm)
+            heapq.heappush(heap, self.sort_key(votes) +
+                           (added.next(), cm, siblings, i))
+
+        def pop_candidate():
+            x = heapq.heappop(heap)
+            cm, siblings, i = x[-3:]
+            if siblings and i + 1 < len(siblings):
+                push_candidate(comment_dict[siblings[i + 1]], siblings, i + 1)
+            return cm
+
+        def push_children(cm_id):
+            children = child_order.get(cm_id)
+            if children:
+                push_candidate(comment_dict[children[0]], children, 0)
+
+        heap = []
+        if candidates is None:
+            push_children(None)
+        else:
+            for cm in candidates:
+                push_candidate(cm)
+
         #find the comments
         num_have = 0
-        sort_candidates()
-        while num_have < num and candidates:
-            to_add = candidates.pop(0)
-            comments.remove(to_add)
+        while num_have < num and heap:
+            to_add = pop_candidate()
             if to_add._deleted and not comment_tree.has_key(to_add._id):
                 pass
             elif depth[to_add._id] < MAX_RECURSION:
                 #add children
                 if comment_tree.has_key(to_add._id):
-                    candidates.extend(comment_tree[to_add._id])
-                    sort_candidates()
+                    push_children(to_add._id)
                 items.append(to_add)
                 num_have += 1
             else:
                 #add the recursion limit
-                p_id = to_add.parent_id
+                p_id = parents[to_add._id]
                 w = Wrapped(MoreRecursion(self.link, 0,
                                           comment_dict[p_id]))
                 w.children.append(to_add)
                 extra[p_id] = w
 
+        #load the data for the comments that are shown
+        need = [cm for cm in items if not cm._loaded]
+        if need:
+            Comment._load_multi(need)
+
         wrapped = self.wrap_items(items)
 
         cids = dict((cm._id, cm) for cm in wrapped)
@@ -559,23 +617,19 @@ class CommentBuilder(Builder):
 
         #put the remaining comments into the tree (the show more comments link)
         more_comments = {}
+        candidates = deque()
+        while heap:
+            candidates.append(pop_candidate())
         while candidates:
-            to_add = candidates.pop(0)
+            to_add = candidates.popleft()
             direct_child = True
-            #ignore top-level comments for now
-            if not hasattr(to_add, 'parent_id'):
-                p_id = None
-            else:
-                #find the parent actually being displayed
-                #direct_child is whether the comment is 'top-level'
-                p_id = to_add.parent_id
-                while p_id and not cids.has_key(p_id):
-                    p = comment_dict[p_id]
-                    if hasattr(p, 'parent_id'):
-                        p_id = p.parent_id
-                    else:
-                        p_id = None
-                    direct_child = False
+            #find the parent actually being displayed (None for
+            #top-level comments)
+            #direct_child is whether the comment is 'top-level'
+            p_id = parents[to_add._id]
+            while p_id and not cids.has_key(p_id):
+                p_id = parents[p_id]
+                direct_child = False
 
             mc2 = more_comments.get(p_id)
             if not mc2:
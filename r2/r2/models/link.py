@@ -20,7 +20,7 @@
 # CondeNet, Inc. All Rights Reserved.
 ################################################################################
 from r2.lib.db.thing import Thing, Relation, NotFound, MultiRelation, \
-     CreationError
+     CreationError, prefetch
 from r2.lib.utils import base_url, tup, domain, worker, title_to_url, UrlParser
 from account import Account
 from subreddit import Subreddit
@@ -537,11 +537,8 @@ class PromotedLink(Link):
 
         try:
             if c.user_is_sponsor:
-                promoted_by_ids = set(x.promoted_by
-                                      for x in wrapped
-                                      if hasattr(x,'promoted_by'))
-                promoted_by_accounts = Account._byID(promoted_by_ids,
-                                                     data=True)
+                promoted_by_accounts = prefetch(Account, wrapped,
+                                                'promoted_by', data=True)
             else:
                 promoted_by_accounts = {}
 
@@ -809,14 +806,17 @@ class Comment(Thing, Printable):
 
         cids = dict((w._id, w) for w in wrapped)
 
+        #the parents and their authors for every comment at once
+        parents = prefetch(Comment, wrapped, 'parent_id', data=True)
+        parent_authors = prefetch(Account, parents.values(), 'author_id')
+
         for item in wrapped:
             item.link = links.get(item.link_id)
             if not hasattr(item, 'subreddit'):
                 item.subreddit = item.subreddit_slow
             if hasattr(item, 'parent_id'):
-                parent = Comment._byID(item.parent_id, True)
-                parent_author = Account._byID(parent.author_id)
-                item.parent_author = parent_author
+                parent = parents[item.parent_id]
+                item.parent_author = parent_authors[parent.author_id]
 
                 if not c.full_comment_listing and cids.has_key(item.parent_id):
                     item.parent_permalink = '#' + utils.to36(item.parent_id)
@@ -928,8 +928,7 @@ class Message(Thing, Printable):
         msgtime = c.have_messages
         
         #load the "to" field if required
-        to_ids = set(w.to_id for w in wrapped)
-        tos = Account._byID(to_ids, True) if to_ids else {}
+        tos = prefetch(Account, wrapped, 'to_id', data=True)
 
         for item in wrapped:
             item.to = tos[item.to_id]
@@ -73,7 +73,7 @@ class Listing(object):
             return r
 
         rendered_items = sgm(g.rendercache, fullnames, render_items, 'render_',
-                             time = g.page_cache_time)
+                             time = g.page_cache_time, single_flight = True)
 
         #replace the render function
         for k, v in rendered_items.iteritems():
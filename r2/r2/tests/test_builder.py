@@ -0,0 +1,147 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+# 
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+# 
+# The Original Code is Reddit.
+# 
+# The Original Developer is the Initial Developer.  The Initial Developer of the
+# Original Code is CondeNet, Inc.
+# 
+# All portions of the code written by CondeNet are Copyright (c) 2006-2008
+# CondeNet, Inc. All Rights Reserved.
+################################################################################
+from unittest import TestCase
+
+from r2.tests import *
+from r2.lib import comment_tree
+from r2.lib.db import operators
+from r2.lib.wrapped import Wrapped
+from r2.models import builder
+from r2.models.builder import CommentBuilder
+from r2.tests.test_comment_tree import FakeGlobals
+from r2.tests.test_comment_tree import FakeComment as TreeComment
+
+class FakeLink(object):
+    _id = 1
+
+class FakeComment(TreeComment):
+    """comments as the tree and the builder see them"""
+    _deleted = False
+
+    def __init__(self, *a, **kw):
+        TreeComment.__init__(self, *a, **kw)
+        self._loaded = False
+
+    @property
+    def _fullname(self):
+        return 't1_%d' % self._id
+
+    @classmethod
+    def _byID(cls, ids, return_dict = True):
+        found = [c for c in cls.comments if c._id in ids]
+        cls.by_id.extend(c._id for c in found)
+        return found
+
+    @classmethod
+    def _load_multi(cls, comments):
+        for c in comments:
+            c._loaded = True
+        cls.loaded.extend(c._id for c in comments)
+
+class FakeCommentBuilder(CommentBuilder):
+    def wrap_items(self, items):
+        return [Wrapped(i, deleted = False, collapsed = False)
+                for i in items]
+
+class TestCommentBuilder(TestCase):
+    def setUp(self):
+        self.saved = (comment_tree.g, comment_tree.Comment, builder.Comment,
+                      builder.MAX_RECURSION)
+        comment_tree.g = FakeGlobals()
+        comment_tree.Comment = builder.Comment = FakeComment
+        #1, 3 and 6 at the top, 2 and 5 under 1, 4 under 2
+        FakeComment.comments = [FakeComment(1, ups = 5),
+                                FakeComment(2, 1, ups = 3, seconds = 10),
+                                FakeComment(3, ups = 10, seconds = 20),
+                                FakeComment(4, 2, seconds = 30),
+                                FakeComment(5, 1, ups = 8, seconds = 40),
+                                FakeComment(6, seconds = 50)]
+        FakeComment.by_id = []
+        FakeComment.loaded = []
+
+    def tearDown(self):
+        (comment_tree.g, comment_tree.Comment, builder.Comment,
+         builder.MAX_RECURSION) = self.saved
+
+    def build(self, num, sort = operators.desc('_score')):
+        return FakeCommentBuilder(FakeLink(), sort).get_items(num)
+
+    def shape(self, items):
+        """the listing as nested (id, children) pairs, with the more
+        links as ('more', count) and the recursion links as ('deeper',
+        ids)"""
+        res = []
+        for w in items:
+            if isinstance(w.lookups[0], builder.MoreRecursion):
+                res.append(('deeper', [c._id for c in w.children]))
+                continue
+            elif isinstance(w.lookups[0], builder.MoreComments):
+                res.append(('more', w.count))
+                continue
+            children = w.child.things if hasattr(w, 'child') else []
+            res.append((w._id, self.shape(children)))
+        return res
+
+    def test_order(self):
+        self.assertEqual(self.shape(self.build(10)),
+                         [(3, []),
+                          (1, [(5, []), (2, [(4, [])])]),
+                          (6, [])])
+
+    def test_date_order(self):
+        self.assertEqual(self.shape(self.build(10, operators.desc('_date'))),
+                         [(6, []),
+                          (3, []),
+                          (1, [(5, []), (2, [(4, [])])])])
+        self.assertEqual(self.shape(self.build(10, operators.asc('_date'))),
+                         [(1, [(2, [(4, [])]), (5, [])]),
+                          (3, []),
+                          (6, [])])
+
+    def test_num_children(self):
+        items = self.build(10)
+        self.assertEqual(dict((w._id, w.num_children) for w in items),
+                         {3: 0, 1: 3, 6: 0})
+        two = items[1].child.things[1]
+        self.assertEqual((two._id, two.num_children), (2, 1))
+
+    def test_cutoff(self):
+        #the best comments anywhere in the tree are picked, the rest
+        #are counted in the more links
+        self.assertEqual(self.shape(self.build(3)),
+                         [(3, []),
+                          (1, [(5, []), ('more', 2)]),
+                          ('more', 1)])
+
+    def test_depth_cutoff(self):
+        builder.MAX_RECURSION = 2
+        self.assertEqual(self.shape(self.build(10)),
+                         [(3, []),
+                          (1, [(5, []), (2, [('deeper', [4])])]),
+                          (6, [])])
+        self.assertEqual(sorted(FakeComment.loaded), [1, 2, 3, 5, 6])
+
+    def test_loads_shown_only(self):
+        self.build(3)
+        self.assertEqual(sorted(FakeComment.loaded), [1, 3, 5])
+        #the thing props of the rest are still needed to pick them
+        self.assertEqual(sorted(FakeComment.by_id), [1, 2, 3, 4, 5, 6])
@@ -0,0 +1,110 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+# 
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+# 
+# The Original Code is Reddit.
+# 
+# The Original Developer is the Initial Developer.  The Initial Developer of the
+# Original Code is CondeNet, Inc.
+# 
+# All portions of the code written by CondeNet are Copyright (c) 2006-2008
+# CondeNet, Inc. All Rights Reserved.
+################################################################################
+from unittest import TestCase
+import cPickle as pickle
+
+from r2.tests import *
+from r2.lib.cache import LRUCache, SelfEmptyingCache
+
+class TestLRUCache(TestCase):
+    def test_get_set_delete(self):
+        c = LRUCache(10)
+        c.set('a', 1)
+        c.set('b', [1, 2])
+        self.assertEqual(c.get('a'), 1)
+        self.assertEqual(c.get('b'), [1, 2])
+        self.assertEqual(c.get('c'), None)
+        self.assertEqual(c.get('c', 3), 3)
+        c.set('a', 2)
+        self.assertEqual(c.get('a'), 2)
+        #add doesn't replace
+        c.add('a', 3)
+        self.assertEqual(c.get('a'), 2)
+        c.delete('a')
+        c.delete('missing')
+        self.assertEqual(c.get('a'), None)
+        self.assertEqual(len(c), 1)
+        self.assertRaises(TypeError, c.set, 1, 1)
+
+    def test_incr(self):
+        c = LRUCache(10)
+        c.set('a', 1)
+        c.incr('a', 2)
+        c.decr('a')
+        c.incr('missing')
+        self.assertEqual(c.get('a'), 2)
+        self.assertFalse('missing' in c)
+
+    def test_get_multi(self):
+        c = LRUCache(10)
+        c.set_multi({'1': 1, '2': 2}, prefix = 'p_')
+        self.assertEqual(c.get_multi([1, 2, 3], prefix = 'p_'), {1: 1, 2: 2})
+        self.assertEqual(c.get_multi(['p_1', 'x']), {'p_1': 1})
+        self.assertEqual(c.get_multi(['p_1', 'x'], partial = False), None)
+        c.delete_multi(['p_1'])
+        self.assertEqual(c.get_multi(['p_1', 'p_2']), {'p_2': 2})
+
+    def test_eviction_order(self):
+        c = LRUCache(3)
+        for k in 'abc':
+            c.set(k, k)
+        #reads and writes both count as uses
+        c.get('a')
+        c.get_multi(['b'])
+        c.set('d', 'd')
+        self.assertEqual(sorted(c.get_multi('abcd')), ['a', 'b', 'd'])
+        c.set('b', 'b2')
+        c.set('e', 'e')
+        self.assertFalse('a' in c)
+        self.assertEqual(sorted(c.get_multi('abcde')), ['b', 'd', 'e'])
+        self.assertEqual(c.stats()['evictions'], 2)
+
+    def test_size_bound(self):
+        c = LRUCache(0, 1000)
+        for i in range(100):
+            c.set(str(i), 'x' * 100)
+            self.assertTrue(c.size <= 1000)
+        self.assertTrue(0 < len(c) < 10)
+        #the newest are kept
+        self.assertTrue('99' in c)
+        self.assertFalse('0' in c)
+        #replacing a value resizes it
+        c.set('99', '')
+        c.delete('98')
+        self.assertEqual(c.size, sum(len(pickle.dumps(c.get(k), 2))
+                                     for k in c.map))
+
+    def test_flush_all(self):
+        c = LRUCache(10)
+        c.set('a', 1)
+        c.flush_all()
+        self.assertEqual(len(c), 0)
+        self.assertEqual(c.get('a'), None)
+        c.set('b', 2)
+        self.assertEqual(c.get('b'), 2)
+
+    def test_self_emptying_cache(self):
+        c = SelfEmptyingCache(2)
+        self.assertTrue(isinstance(c, LRUCache))
+        for k in 'abc':
+            c.set(k, k)
+        self.assertEqual(sorted(c.get_multi('abc')), ['b', 'c'])
@@ -0,0 +1,298 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+# 
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+# 
+# The Original Code is Reddit.
+# 
+# The Original Developer is the Initial Developer.  The Initial Developer of the
+# Original Code is CondeNet, Inc.
+# 
+# All portions of the code written by CondeNet are Copyright (c) 2006-2008
+# CondeNet, Inc. All Rights Reserved.
+################################################################################
+from unittest import TestCase
+from datetime import timedelta
+import logging
+import cPickle as pickle
+
+from r2.tests import *
+from r2.lib import comment_tree
+from r2.lib.comment_tree import link_comments, VoteUpdates
+from r2.lib.comment_tree import comments_key, delta_key, lock_key
+from r2.lib.db.sorts import epoch
+from r2.lib.lock import make_lock_factory
+
+class FakeCache(dict):
+    """the bits of the permacache the tree uses. values are copied in
+    and out, like memcache does"""
+    def get(self, key):
+        if key in self:
+            return pickle.loads(self[key])
+
+    def get_multi(self, keys):
+        return dict((k, self.get(k)) for k in keys if k in self)
+
+    def set(self, key, val, time = 0):
+        self[key] = pickle.dumps(val, 2)
+
+    def add(self, key, val, time = 0):
+        if key in self:
+            return False
+        self.set(key, val)
+        return True
+
+    def append(self, key, val):
+        if key not in self:
+            return False
+        self.set(key, self.get(key) + val)
+        return True
+
+    def delete(self, key):
+        self.pop(key, None)
+
+class FakeGlobals(object):
+    def __init__(self):
+        self.permacache = FakeCache()
+        self.make_lock = make_lock_factory(self.permacache)
+        self.comment_tree_deltas = True
+        self.log = logging.getLogger('test_comment_tree')
+
+class FakeComment(object):
+    """comments as the tree sees them"""
+    link_id = 1
+
+    def __init__(self, id, parent_id = None, ups = 1, downs = 0,
+                 seconds = 0):
+        self._id = id
+        if parent_id:
+            self.parent_id = parent_id
+        self._ups = ups
+        self._downs = downs
+        self._date = epoch + timedelta(seconds = seconds)
+
+    #the db
+    comments = []
+
+    @classmethod
+    def _data_values(cls, key, val, get_key, thing_cols = ()):
+        return [(c._id, getattr(c, 'parent_id', None), c._ups, c._downs,
+                 c._date) for c in cls.comments if c.link_id == val]
+
+class TreeTestCase(TestCase):
+    def setUp(self):
+        self.g, self.Comment = comment_tree.g, comment_tree.Comment
+        comment_tree.g = FakeGlobals()
+        comment_tree.Comment = FakeComment
+        self.cache = comment_tree.g.permacache
+        #1 and 3 at the top, 2 under 1, 4 under 2
+        FakeComment.comments = [FakeComment(1, ups = 5),
+                                FakeComment(2, 1, ups = 3, seconds = 10),
+                                FakeComment(3, ups = 10, seconds = 20),
+                                FakeComment(4, 2, seconds = 30)]
+
+    def tearDown(self):
+        comment_tree.g, comment_tree.Comment = self.g, self.Comment
+
+    def add(self, comment):
+        FakeComment.comments.append(comment)
+        comment_tree.add_comment(comment)
+
+class TestUpgradeTree(TreeTestCase):
+    def old_tree(self):
+        return ([1, 2, 3, 4], {None: [1, 3], 1: [2], 2: [4]},
+                {1: 0, 2: 1, 3: 0, 4: 2}, {1: 2, 2: 1, 3: 0, 4: 0})
+
+    def check(self, tree):
+        cids, tree, depth, num_children, parents, sort_data = tree
+        self.assertEqual(parents, {1: None, 2: 1, 3: None, 4: 2})
+        self.assertEqual(sort_data['votes'][3][:2], (10, 0))
+        self.assertEqual(sort_data['orders']['_score'][None], [3, 1])
+        self.assertEqual(sort_data['orders']['_hot'][1], [2])
+
+    def test_four_tuple(self):
+        self.cache.set(comments_key(1), self.old_tree())
+        self.check(link_comments(1))
+        #stored upgraded
+        self.assertEqual(len(self.cache.get(comments_key(1))), 6)
+
+    def test_five_tuple(self):
+        parents = {1: None, 2: 1, 3: None, 4: 2}
+        self.cache.set(comments_key(1), self.old_tree() + (parents,))
+        self.check(link_comments(1))
+        self.assertEqual(len(self.cache.get(comments_key(1))), 6)
+
+class TestLinkComments(TreeTestCase):
+    def test_tuple(self):
+        r = link_comments(1)
+        self.assertEqual(len(r), 6)
+        cids, tree, depth, num_children, parents, sort_data = r
+        self.assertEqual(sorted(cids), [1, 2, 3, 4])
+        self.assertEqual(tree, {None: [1, 3], 1: [2], 2: [4]})
+        self.assertEqual(depth, {1: 0, 2: 1, 3: 0, 4: 2})
+        self.assertEqual(num_children, {1: 2, 2: 1, 3: 0, 4: 0})
+        self.assertEqual(parents, {1: None, 2: 1, 3: None, 4: 2})
+        self.assertEqual(sorted(sort_data['orders']),
+                         sorted(comment_tree.tree_sorts))
+        self.assertEqual(sort_data['votes'][2], (3, 0, 10.))
+        #highest first
+        self.assertEqual(sort_data['orders']['_score'][None], [3, 1])
+        #stored for the next read
+        self.assertEqual(self.cache.get(comments_key(1)), r)
+
+class TestAddComment(TreeTestCase):
+    def setUp(self):
+        TreeTestCase.setUp(self)
+        #rewrite the whole tree on every change
+        comment_tree.g.comment_tree_deltas = False
+
+    def test_nested(self):
+        link_comments(1)
+        self.add(FakeComment(5, 4, seconds = 40))
+        cids, tree, depth, num_children, parents, sort_data = \
+            self.cache.get(comments_key(1))
+        self.assertEqual(cids, [1, 2, 3, 4, 5])
+        self.assertEqual(tree[4], [5])
+        self.assertEqual(depth[5], 3)
+        self.assertEqual(parents[5], 4)
+        #counted in each of its parents
+        self.assertEqual(num_children, {1: 3, 2: 2, 3: 0, 4: 1, 5: 0})
+        for col in comment_tree.tree_sorts:
+            self.assertEqual(sort_data['orders'][col][4], [5])
+
+    def test_sorted_among_siblings(self):
+        link_comments(1)
+        self.add(FakeComment(5, ups = 7, seconds = 40))
+        sort_data = self.cache.get(comments_key(1))[5]
+        self.assertEqual(sort_data['votes'][5], (7, 0, 40.))
+        self.assertEqual(sort_data['orders']['_score'][None], [3, 5, 1])
+
+    def test_duplicate(self):
+        link_comments(1)
+        comment = FakeComment(5, 3)
+        self.add(comment)
+        comment_tree.add_comment(comment)
+        cids, tree, depth, num_children = self.cache.get(comments_key(1))[:4]
+        self.assertEqual(cids, [1, 2, 3, 4, 5])
+        self.assertEqual(tree[3], [5])
+        self.assertEqual(num_children[3], 1)
+
+    def test_old_tree(self):
+        #a tree stored before parents and sort orders were kept
+        self.cache.set(comments_key(1),
+                       ([1, 2, 3, 4], {None: [1, 3], 1: [2], 2: [4]},
+                        {1: 0, 2: 1, 3: 0, 4: 2}, {1: 2, 2: 1, 3: 0, 4: 0}))
+        self.add(FakeComment(5, 3, ups = 2, seconds = 40))
+        r = self.cache.get(comments_key(1))
+        self.assertEqual(len(r), 6)
+        self.assertEqual(r[4], {1: None, 2: 1, 3: None, 4: 2, 5: 3})
+        self.assertEqual(r[5]['votes'][5], (2, 0, 40.))
+        self.assertEqual(r[5]['orders']['_hot'][3], [5])
+        self.assertEqual(link_comments(1), r)
+
+    def test_delete(self):
+        r = link_comments(1)
+        comment_tree.delete_comment(FakeComment.comments[1])
+        #the comment stays in the tree, the builder skips it
+        self.assertEqual(link_comments(1), r)
+
+class TestDeltas(TreeTestCase):
+    def test_append_and_replay(self):
+        stored = link_comments(1)
+        self.add(FakeComment(5, 3, ups = 7, seconds = 40))
+        #the stored tree isn't rewritten, the change is appended
+        self.assertEqual(self.cache.get(comments_key(1)), stored)
+        self.assertTrue(self.cache.get(delta_key(1)).startswith('5,3;v5,7,0,'))
+
+        cids, tree, depth, num_children, parents, sort_data = \
+            comment_tree._link_comments(1)[0]
+        self.assertEqual(cids, [1, 2, 3, 4, 5])
+        self.assertEqual(parents[5], 3)
+        self.assertEqual(depth[5], 1)
+        self.assertEqual(num_children[3], 1)
+        self.assertEqual(sort_data['votes'][5][:2], (7, 0))
+
+    def test_read_compacts(self):
+        link_comments(1)
+        self.add(FakeComment(5, 3))
+        self.add(FakeComment(6))
+        tree, num_deltas = comment_tree._link_comments(1)
+        #folded back in, so later reads don't replay anything
+        self.assertEqual(num_deltas, 0)
+        self.assertFalse(delta_key(1) in self.cache)
+        self.assertEqual(self.cache.get(comments_key(1))[0], [1, 2, 3, 4, 5, 6])
+
+    def test_locked_link_isnt_compacted(self):
+        link_comments(1)
+        self.add(FakeComment(5, 3))
+        self.cache.add(lock_key(1), 1)
+        tree, num_deltas = comment_tree._link_comments(1)
+        #the comment and its votes
+        self.assertEqual(num_deltas, 2)
+        self.assertEqual(tree[0], [1, 2, 3, 4, 5])
+        self.assertTrue(delta_key(1) in self.cache)
+
+    def test_max_deltas(self):
+        max_deltas = comment_tree.max_deltas
+        comment_tree.max_deltas = 0
+        try:
+            link_comments(1)
+            self.add(FakeComment(5, 3))
+        finally:
+            comment_tree.max_deltas = max_deltas
+        #written whole
+        self.assertFalse(delta_key(1) in self.cache)
+        self.assertEqual(self.cache.get(comments_key(1))[0], [1, 2, 3, 4, 5])
+
+    def test_deltas_off(self):
+        comment_tree.g.comment_tree_deltas = False
+        link_comments(1)
+        self.add(FakeComment(5, 3))
+        self.assertFalse(delta_key(1) in self.cache)
+        self.assertEqual(self.cache.get(comments_key(1))[4][5], 3)
+
+class TestVoteUpdates(TreeTestCase):
+    def test_flush(self):
+        link_comments(1)
+        updates = VoteUpdates(3600)
+        updates.add(1, 1, (20, 0, 0.))
+        #only the latest votes are applied
+        updates.add(1, 1, (30, 0, 0.))
+        updates.add(1, 4, (2, 0, 30.))
+        self.assertEqual(self.cache.get(delta_key(1)), None)
+
+        updates.flush()
+        self.assertEqual(updates.pending, {})
+        self.assertEqual(self.cache.get(delta_key(1)).count('v'), 2)
+        self.assertFalse('v1,20' in self.cache.get(delta_key(1)))
+
+        sort_data = link_comments(1)[5]
+        self.assertEqual(sort_data['votes'][1], (30, 0, 0.))
+        self.assertEqual(sort_data['orders']['_score'][None], [1, 3])
+
+    def test_unchanged_votes(self):
+        link_comments(1)
+        updates = VoteUpdates(3600)
+        updates.add(1, 3, (10, 0, 20.))
+        updates.flush()
+        self.assertFalse(delta_key(1) in self.cache)
+
+    def test_failures_dont_stop_the_rest(self):
+        link_comments(1)
+        updates = VoteUpdates(3600)
+        #link 2's lock is held elsewhere
+        self.cache.add(lock_key(2), 1)
+        lock = comment_tree.g.make_lock
+        comment_tree.g.make_lock = lambda key, **kw: lock(key, timeout = 0)
+        updates.add(2, 7, (1, 0, 0.))
+        updates.add(1, 1, (30, 0, 0.))
+        updates.flush()
+        self.assertEqual(link_comments(1)[5]['votes'][1], (30, 0, 0.))
@@ -0,0 +1,159 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+# 
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+# 
+# The Original Code is Reddit.
+# 
+# The Original Developer is the Initial Developer.  The Initial Developer of the
+# Original Code is CondeNet, Inc.
+# 
+# All portions of the code written by CondeNet are Copyright (c) 2006-2008
+# CondeNet, Inc. All Rights Reserved.
+################################################################################
+from __future__ import with_statement
+from unittest import TestCase
+from threading import Thread
+
+from r2.tests import *
+from r2.lib.db.counters import CounterAggregator
+from r2.lib.db.thing import Thing
+
+class Counted(Thing):
+    _nodb = True
+    _defaults = dict(num_comments = 0)
+
+class TestMergePending(TestCase):
+    def setUp(self):
+        #long enough that nothing is flushed during the test
+        self.counters = CounterAggregator(interval = 3600)
+        self.counters.incr(Counted, 5, '_ups', 2)
+        self.counters.incr(Counted, 5, 'num_comments', 3)
+        self.counters.incr(Counted, 5, 'pics_link_karma', 1)
+
+    def test_base_props_on_unloaded(self):
+        t = Counted(ups = 1, id = 5)
+        self.counters.merge_pending(Counted, {5: t}, True)
+        self.assertEqual(t._ups, 3)
+        #the data props are left to _load_multi
+        self.assertEqual(t._t, {})
+        self.assertFalse(t._loaded)
+
+    def test_data_props_on_loaded(self):
+        t = Counted(ups = 1, id = 5)
+        with t.safe_set_attr:
+            t._loaded = True
+        self.counters.merge_pending(Counted, {5: t}, False)
+        self.assertEqual(t.num_comments, 3)
+        #no default, so the delta is the value
+        self.assertEqual(t.pics_link_karma, 1)
+        self.assertEqual(t._ups, 1)
+
+    def test_other_ids(self):
+        t = Counted(ups = 1, id = 6)
+        self.counters.merge_pending(Counted, {6: t}, True)
+        self.assertEqual(t._ups, 1)
+
+#a stand-in for the thing table
+rows = {}
+during_write = []
+
+class Flushed(Thing):
+    _nodb = True
+    _type_id = 1
+
+    @staticmethod
+    def _incr_props_multi(type_id, prop, amounts):
+        for thing_id, amt in amounts.iteritems():
+            rows[thing_id] = rows[thing_id] + amt
+        for fn in during_write:
+            fn()
+
+class TestFlushRace(TestCase):
+    def setUp(self):
+        self.counters = CounterAggregator(interval = 3600)
+        rows.clear()
+        rows[5] = 1
+        del during_write[:]
+        self.threads = []
+
+    def fill(self):
+        """what _byID does on a cache miss"""
+        self.counters.begin_fill(Flushed)
+        try:
+            t = Flushed(ups = rows[5], id = 5)
+            self.counters.merge_pending(Flushed, {5: t}, True)
+        finally:
+            self.counters.end_fill(Flushed)
+        return t._ups
+
+    def fill_during_write(self):
+        #a fill from another thread once the row has the delta
+        filled = []
+        def fill():
+            t = Thread(target = lambda: filled.append(self.fill()))
+            t.start()
+            #it has to wait for the write to finish
+            t.join(.2)
+            self.assertTrue(t.isAlive())
+            self.threads.append(t)
+        during_write.append(fill)
+        return filled
+
+    def flush(self):
+        self.counters.flush()
+        for t in self.threads:
+            t.join()
+
+    def test_fill_during_flush(self):
+        self.counters.incr(Flushed, 5, '_ups', 2)
+        filled = self.fill_during_write()
+        self.flush()
+        self.assertEqual(rows[5], 3)
+        self.assertEqual(filled, [3])
+        self.assertEqual(self.fill(), 3)
+
+    def test_pending_during_flush(self):
+        #an increment that comes in during the write is still added
+        self.counters.incr(Flushed, 5, '_ups', 2)
+        filled = self.fill_during_write()
+        during_write.insert(0, lambda: self.counters.incr(Flushed, 5,
+                                                          '_ups', 4))
+        self.flush()
+        self.assertEqual(filled, [7])
+        self.assertEqual(self.fill(), 7)
+
+    def test_write_waits_for_fill(self):
+        self.counters.incr(Flushed, 5, '_ups', 2)
+        self.counters.begin_fill(Flushed)
+        t = Flushed(ups = rows[5], id = 5)
+        flusher = Thread(target = self.counters.flush)
+        flusher.start()
+        flusher.join(.2)
+        #the row isn't written until the fill is done with it
+        self.assertTrue(flusher.isAlive())
+        self.assertEqual(rows[5], 1)
+        self.counters.merge_pending(Flushed, {5: t}, True)
+        self.counters.end_fill(Flushed)
+        flusher.join()
+        self.assertEqual(t._ups, 3)
+        self.assertEqual(rows[5], 3)
+
+    def test_failed_write(self):
+        def fail():
+            #as if the write had rolled back
+            rows[5] = 1
+            raise ValueError
+        self.counters.incr(Flushed, 5, '_ups', 2)
+        during_write.append(fail)
+        self.counters.flush()
+        self.assertEqual(self.fill(), 3)
+        self.assertTrue(self.counters.has_pending(Flushed, 5, '_ups'))
@@ -0,0 +1,422 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+# 
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+# 
+# The Original Code is Reddit.
+# 
+# The Original Developer is the Initial Developer.  The Initial Developer of the
+# Original Code is CondeNet, Inc.
+# 
+# All portions of the code written by CondeNet are Copyright (c) 2006-2008
+# CondeNet, Inc. All Rights Reserved.
+################################################################################
+from unittest import TestCase
+import cPickle as pickle
+import random
+import socket
+import struct
+import threading
+import time
+
+from r2.tests import *
+from r2.lib.contrib.memcache import _Placement, _Host, Client, Serializer
+from r2.lib.contrib.memcache import key_category
+from r2.lib.contrib.memcache import _ConnectionPool, _Error, _BIN_HEADER
+from r2.lib.contrib.memcache import _bin_request, _bin_parse
+from r2.lib.contrib import memcache
+
+def placement(servers, hashing):
+    return _Placement([(_Host(s), w) for s, w in servers], hashing)
+
+def owners(p, keys):
+    """the ip:port of the server each key lives on"""
+    def name(server):
+        return '%s:%d' % (server.ip, server.port)
+    return dict((k, name(p.candidates(k).next())) for k in keys)
+
+class TestKetamaPlacement(TestCase):
+    servers = [('10.0.0.%d:11211' % i, 1) for i in range(5)]
+    keys = ['key%d' % i for i in range(20000)]
+
+    def test_spread(self):
+        placed = owners(placement(self.servers, 'ketama'), self.keys)
+        for s, w in self.servers:
+            share = placed.values().count(s) / float(len(self.keys))
+            self.assertTrue(0.1 < share < 0.3, (s, share))
+
+    def test_add_server(self):
+        before = owners(placement(self.servers[:4], 'ketama'), self.keys)
+        after = owners(placement(self.servers, 'ketama'), self.keys)
+        moved = [k for k in self.keys if before[k] != after[k]]
+        #keys only move to the new server, about 1/5 of them
+        for k in moved:
+            self.assertEqual(after[k], self.servers[4][0])
+        self.assertTrue(0.1 < len(moved) / float(len(self.keys)) < 0.3)
+
+    def test_remove_server(self):
+        before = owners(placement(self.servers, 'ketama'), self.keys)
+        after = owners(placement(self.servers[1:], 'ketama'), self.keys)
+        #only the removed server's keys move
+        for k in self.keys:
+            if before[k] != self.servers[0][0]:
+                self.assertEqual(before[k], after[k])
+
+    def test_weights(self):
+        servers = [('10.0.0.1:11211', 1), ('10.0.0.2:11211', 3)]
+        placed = owners(placement(servers, 'ketama'), self.keys)
+        share = placed.values().count('10.0.0.2:11211') / float(len(self.keys))
+        self.assertTrue(0.65 < share < 0.85, share)
+
+    def test_candidates(self):
+        p = placement(self.servers, 'ketama')
+        for k in self.keys[:100]:
+            candidates = list(p.candidates(k))
+            #every server once, for failover
+            self.assertEqual(len(candidates), len(self.servers))
+            self.assertEqual(len(set(candidates)), len(self.servers))
+
+    def test_modulo_moves_most(self):
+        before = owners(placement(self.servers[:4], 'modulo'), self.keys)
+        after = owners(placement(self.servers, 'modulo'), self.keys)
+        moved = [k for k in self.keys if before[k] != after[k]]
+        self.assertTrue(len(moved) > len(self.keys) / 2)
+
+    def test_unknown_hashing(self):
+        self.assertRaises(ValueError, placement, self.servers, 'nope')
+
+class TestSerializer(TestCase):
+    values = ['', 'a string', 0, 42, -7, 10L ** 30,
+              dict(id=1, name='thing', ups=[1, 2, 3]),
+              (u'caf\xe9', None, 1.5, True)]
+
+    def round_trip(self, s, val):
+        flags, length, data = s.dumps(val)
+        self.assertEqual(length, len(data))
+        return s.loads(flags, data)
+
+    def test_round_trip(self):
+        for protocol in (1, 2):
+            for compress_len in (0, 1):
+                s = Serializer(protocol=protocol, compress_len=compress_len)
+                for val in self.values:
+                    out = self.round_trip(s, val)
+                    self.assertEqual(out, val)
+                    self.assertEqual(type(out), type(val))
+
+    def test_numbers_as_digits(self):
+        #so incr and decr work on them
+        s = Serializer(compress_len=1)
+        self.assertEqual(s.dumps(1234), (Client._FLAG_INTEGER, 4, '1234'))
+        self.assertEqual(s.dumps(10L), (Client._FLAG_LONG, 2, '10'))
+        self.assertEqual(s.dumps('str'), (0, 3, 'str'))
+
+    def test_protocol(self):
+        val = dict(a=1)
+        flags, length, data = Serializer(protocol=2).dumps(val)
+        self.assertEqual(data, pickle.dumps(val, 2))
+        flags, length, data = Serializer(protocol=1).dumps(val)
+        self.assertEqual(data, pickle.dumps(val, 1))
+
+    def test_load_old_pickles(self):
+        #values written with protocol 1 still load after switching to 2
+        val = dict(id=1, names=['a', 'b'])
+        s = Serializer(protocol=2)
+        self.assertEqual(s.loads(Client._FLAG_PICKLE, pickle.dumps(val, 1)),
+                         val)
+
+    def test_compression(self):
+        val = 'x' * 1000
+        flags, length, data = Serializer(compress_len=100).dumps(val)
+        self.assertTrue(flags & Client._FLAG_COMPRESSED)
+        self.assertTrue(length < 100)
+        self.assertEqual(Serializer().loads(flags, data), val)
+
+        #under the threshold
+        flags, length, data = Serializer(compress_len=2000).dumps(val)
+        self.assertEqual((flags, data), (0, val))
+
+        #0 never compresses, min_compress_len overrides it
+        self.assertEqual(Serializer().dumps(val)[0], 0)
+        flags = Serializer().dumps(val, min_compress_len=100)[0]
+        self.assertTrue(flags & Client._FLAG_COMPRESSED)
+
+        #compressed pickles
+        val = range(1000)
+        flags, length, data = Serializer(compress_len=100).dumps(val)
+        self.assertEqual(flags,
+                         Client._FLAG_PICKLE | Client._FLAG_COMPRESSED)
+        self.assertEqual(Serializer().loads(flags, data), val)
+
+    def test_no_compress(self):
+        val = 'x' * 1000
+        s = Serializer(compress_len=100)
+        self.assertEqual(s.dumps(val, compress=False), (0, 1000, val))
+
+    def test_incompressible(self):
+        #kept as is when compressing doesn't make it smaller
+        r = random.Random(1)
+        val = ''.join(chr(r.randrange(256)) for i in xrange(500))
+        self.assertEqual(Serializer(compress_len=10).dumps(val),
+                         (0, 500, val))
+
+    def test_key_category(self):
+        self.assertEqual(key_category('Link_123'), 'Link_')
+        self.assertEqual(key_category('query_cache_abc_1'), 'query_cache_abc_')
+        self.assertEqual(key_category('rend123'), 'rend')
+        self.assertEqual(key_category('plain'), 'plain')
+        self.assertEqual(len(key_category('a' * 100 + '_1')), 40)
+
+    def test_track_sizes(self):
+        s = Serializer(compress_len=100, track_sizes=True)
+        s.dumps('x' * 10, key='Link_1')
+        s.dumps('x' * 1000, key='Link_2')
+        s.dumps('y', key='Account_1')
+        s.dumps('z')
+        sizes = s.sizes()
+        self.assertEqual(sorted(sizes.keys()), ['Account_', 'Link_'])
+        count, size, stored, largest = sizes['Link_']
+        self.assertEqual((count, size), (2, 1010))
+        self.assertTrue(stored < 100)
+        self.assertEqual(largest, stored - 10)
+        self.assertEqual(sizes['Account_'], (1, 1, 1, 1))
+
+        s.reset_sizes()
+        self.assertEqual(s.sizes(), {})
+
+        #off by default
+        s = Serializer()
+        s.dumps('x', key='Link_1')
+        self.assertEqual(s.sizes(), {})
+
+    def test_too_big(self):
+        self.assertEqual(Serializer().dumps('x' * (1024 * 1024)), 0)
+
+def bin_response(op, status=0, extras='', key='', value='', opaque=0):
+    return (_BIN_HEADER.pack(0x81, op, len(key), len(extras), 0, status,
+                             len(extras) + len(key) + len(value), opaque, 0)
+            + extras + key + value)
+
+class TestBinaryCodec(TestCase):
+    def test_request(self):
+        r = _bin_request('get', 'foo', opaque=7)
+        self.assertEqual(len(r), 24 + 3)
+        self.assertEqual(_BIN_HEADER.unpack(r[:24]),
+                         (0x80, 0x00, 3, 0, 0, 0, 3, 7, 0))
+        self.assertEqual(r[24:], 'foo')
+
+    def test_request_with_extras(self):
+        extras = struct.pack('!LL', 1, 60)
+        r = _bin_request('set', 'foo', extras, 'value')
+        self.assertEqual(_BIN_HEADER.unpack(r[:24]),
+                         (0x80, 0x01, 3, 8, 0, 0, 16, 0, 0))
+        self.assertEqual(r[24:], extras + 'foo' + 'value')
+
+    def test_parse(self):
+        buf = bin_response(0x0d, extras='\0\0\0\1', key='k', value='v',
+                           opaque=3)
+        self.assertEqual(_bin_parse(buf),
+                         (len(buf), 0x0d, 0, 3, '\0\0\0\1', 'k', 'v'))
+
+    def test_parse_partial(self):
+        buf = bin_response(0x00, value='x' * 100)
+        #neither a partial header nor a partial body parse
+        self.assertEqual(_bin_parse(buf[:10]), None)
+        self.assertEqual(_bin_parse(buf[:-1]), None)
+
+    def test_parse_several(self):
+        buf = (bin_response(0x0d, key='a', value='1')
+               + bin_response(0x0a) + 'extra')
+        end, op, status, opaque, extras, key, value = _bin_parse(buf)
+        self.assertEqual((op, key, value), (0x0d, 'a', '1'))
+        end, op = _bin_parse(buf, end)[:2]
+        self.assertEqual(op, 0x0a)
+        self.assertEqual(buf[end:], 'extra')
+
+    def test_bad_magic(self):
+        self.assertRaises(_Error, _bin_parse, 'x' * 24)
+
+class FakeSocket(object):
+    """a socket to a memcached that answers binary gets, sets and
+    deletes from the module's store"""
+    def __init__(self, module):
+        self.module = module
+        self.closed = False
+        self.out = ''
+
+    def connect(self, address):
+        if self.module.refuse:
+            raise socket.error(111, 'Connection refused')
+        self.address = address
+
+    def close(self):
+        self.closed = True
+
+    def sendall(self, data):
+        store = self.module.store
+        while data:
+            (magic, op, keylen, extlen, datatype, status, bodylen, opaque,
+             cas) = _BIN_HEADER.unpack(data[:24])
+            body, data = data[24:24 + bodylen], data[24 + bodylen:]
+            extras, key = body[:extlen], body[extlen:extlen + keylen]
+            value = body[extlen + keylen:]
+            if op == 0x00:
+                if key in store:
+                    flags, val = store[key]
+                    self.out += bin_response(op, extras = flags,
+                                             value = val)
+                else:
+                    self.out += bin_response(op, status = 1)
+            elif op == 0x01:
+                store[key] = (extras[:4], value)
+                self.out += bin_response(op)
+            elif op == 0x04:
+                self.out += bin_response(op, status = 0 if
+                                         store.pop(key, None) else 1)
+        self.out += self.module.trailing
+
+    def recv(self, n):
+        if self.module.recv_error:
+            raise self.module.recv_error
+        data, self.out = self.out[:n], self.out[n:]
+        return data
+
+    def setblocking(self, flag):
+        pass
+
+class FakeSocketModule(object):
+    """stands in for the socket module in memcache"""
+    AF_INET = socket.AF_INET
+    SOCK_STREAM = socket.SOCK_STREAM
+    error = socket.error
+
+    def __init__(self):
+        self.sockets = []
+        self.store = {}
+        self.refuse = False
+        self.recv_error = None
+        #sent after every reply
+        self.trailing = ''
+
+    def socket(self, family, type):
+        s = FakeSocket(self)
+        self.sockets.append(s)
+        return s
+
+class SocketTest(TestCase):
+    def setUp(self):
+        self.socket = memcache.socket
+        self.pools = dict(memcache._pools)
+        memcache.socket = self.fake = FakeSocketModule()
+        memcache._pools.clear()
+
+    def tearDown(self):
+        memcache.socket = self.socket
+        memcache._pools.clear()
+        memcache._pools.update(self.pools)
+
+class TestConnectionPool(SocketTest):
+    def test_checkout_and_release(self):
+        pool = _ConnectionPool(('10.0.0.1', 11211), 2, 5)
+        s1, s2 = pool.get(), pool.get()
+        self.assertNotEqual(s1, s2)
+        self.assertEqual(s1.address, ('10.0.0.1', 11211))
+        pool.put(s1)
+        #reused rather than opening another
+        self.assertEqual(pool.get(), s1)
+        self.assertEqual(len(self.fake.sockets), 2)
+        pool.put(s1)
+        pool.put(s2)
+        self.assertEqual(pool.stats(), dict(open = 2, free = 2, waits = 0,
+                                            timeouts = 0))
+
+    def test_waits_for_release(self):
+        pool = _ConnectionPool(('10.0.0.1', 11211), 1, 5)
+        s = pool.get()
+        def release():
+            time.sleep(.1)
+            pool.put(s)
+        threading.Thread(target = release).start()
+        start = time.time()
+        self.assertEqual(pool.get(), s)
+        self.assertTrue(time.time() - start < 1)
+        self.assertEqual(pool.stats()['waits'], 1)
+        self.assertEqual(pool.stats()['timeouts'], 0)
+
+    def test_past_limit(self):
+        pool = _ConnectionPool(('10.0.0.1', 11211), 1, .05)
+        s1 = pool.get()
+        #opened anyway once the wait times out
+        s2 = pool.get()
+        self.assertNotEqual(s1, s2)
+        self.assertEqual(pool.stats()['open'], 2)
+        self.assertEqual(pool.stats()['timeouts'], 1)
+        #and closed when it's given back
+        pool.put(s2)
+        self.assertTrue(s2.closed)
+        pool.put(s1)
+        self.assertFalse(s1.closed)
+        self.assertEqual(pool.stats()['open'], 1)
+        self.assertEqual(pool.stats()['free'], 1)
+
+    def test_connect_error(self):
+        pool = _ConnectionPool(('10.0.0.1', 11211), 1, 5)
+        self.fake.refuse = True
+        self.assertRaises(socket.error, pool.get)
+        self.assertEqual(pool.stats()['open'], 0)
+        self.fake.refuse = False
+        pool.get()
+
+class TestPooledClient(SocketTest):
+    def setUp(self):
+        SocketTest.setUp(self)
+        self.client = Client(['10.0.0.1:11211'], binary = True,
+                             pool_size = 1)
+        self.host = self.client.servers[0]
+        self.pool = self.host.pool
+
+    def test_round_trip(self):
+        self.assertTrue(self.client.set('a', [1, 2]))
+        self.assertEqual(self.client.get('a'), [1, 2])
+        self.assertEqual(self.client.get('b'), None)
+        self.client.delete('a')
+        self.assertEqual(self.client.get('a'), None)
+        #one socket, given back after each call
+        self.assertEqual(len(self.fake.sockets), 1)
+        self.assertEqual(self.host.socket, None)
+        self.assertEqual(self.pool.stats()['free'], 1)
+
+    def test_error_closes_socket(self):
+        self.client.set('a', 1)
+        self.fake.recv_error = RuntimeError('boom')
+        self.assertRaises(RuntimeError, self.client.get, 'a')
+        #it may have part of a reply left in it
+        self.assertTrue(self.fake.sockets[0].closed)
+        self.assertEqual(self.host.socket, None)
+        self.assertEqual(self.pool.stats(), dict(open = 0, free = 0,
+                                                 waits = 0, timeouts = 0))
+        self.fake.recv_error = None
+        self.assertEqual(self.client.get('a'), 1)
+        self.assertEqual(len(self.fake.sockets), 2)
+
+    def test_unread_reply_closes_socket(self):
+        self.client.set('a', 1)
+        self.fake.trailing = 'x'
+        self.client.get('a')
+        self.assertTrue(self.fake.sockets[0].closed)
+        self.assertEqual(self.pool.stats()['open'], 0)
+
+    def test_key_error_keeps_socket(self):
+        self.client.set('a', 1)
+        self.assertRaises(Client.MemcachedStringEncodingError,
+                          self.client.get, u'a')
+        self.assertFalse(self.fake.sockets[0].closed)
+        self.assertEqual(self.pool.stats()['free'], 1)
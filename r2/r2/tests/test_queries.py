@@ -0,0 +1,161 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+# 
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+# 
+# The Original Code is Reddit.
+# 
+# The Original Developer is the Initial Developer.  The Initial Developer of the
+# Original Code is CondeNet, Inc.
+# 
+# All portions of the code written by CondeNet are Copyright (c) 2006-2008
+# CondeNet, Inc. All Rights Reserved.
+################################################################################
+from unittest import TestCase
+import cPickle as pickle
+
+from r2.tests import *
+from r2.lib.db import queries
+from r2.lib.db.queries import CachedResults, PackedResults, filter_identity
+from r2.lib.db.operators import asc, desc
+from r2.lib.utils import to36
+
+class Item(object):
+    def __init__(self, id, hot, date = 0.0):
+        self._fullname = 't3_' + to36(id)
+        self._hot = hot
+        self._date = date
+
+class FakeQuery(object):
+    def __init__(self, sort):
+        self._sort = sort
+        self._rules = []
+
+def make_results(sort, data = None):
+    """a CachedResults that never touches the query cache"""
+    r = CachedResults.__new__(CachedResults)
+    r.query = FakeQuery(sort)
+    r.filter = filter_identity
+    r.sort_cols = [s.col for s in sort]
+    r.data = [] if data is None else data
+    r._fetched = True
+    r.store = lambda: None
+    return r
+
+class TestCachedResultsInsert(TestCase):
+    def setUp(self):
+        self.limit = queries.precompute_limit
+        queries.precompute_limit = 3
+
+    def tearDown(self):
+        queries.precompute_limit = self.limit
+
+    def test_descending(self):
+        r = make_results([desc('_hot'), desc('_date')])
+        for id, hot in ((1, 5.), (2, 10.), (3, 1.)):
+            self.assertTrue(r.insert(Item(id, hot)))
+        self.assertEqual(list(r), ['t3_2', 't3_1', 't3_3'])
+
+    def test_ascending(self):
+        r = make_results([asc('_date')])
+        for id, date in ((1, 5.), (2, 10.), (3, 1.)):
+            self.assertTrue(r.insert(Item(id, 0., date)))
+        self.assertEqual(list(r), ['t3_3', 't3_1', 't3_2'])
+
+    def test_ties_use_later_columns(self):
+        r = make_results([desc('_hot'), desc('_date')])
+        r.insert(Item(1, 5., 1.))
+        r.insert(Item(2, 5., 2.))
+        self.assertEqual(list(r), ['t3_2', 't3_1'])
+
+    def test_moves_changed_item(self):
+        r = make_results([desc('_hot'), desc('_date')])
+        for id, hot in ((1, 5.), (2, 10.), (3, 1.)):
+            r.insert(Item(id, hot))
+        self.assertTrue(r.insert(Item(3, 20.)))
+        self.assertEqual(list(r), ['t3_3', 't3_2', 't3_1'])
+        self.assertEqual(len(r.data), 3)
+
+    def test_full_listing(self):
+        r = make_results([desc('_hot'), desc('_date')])
+        for id, hot in ((1, 5.), (2, 10.), (3, 1.)):
+            r.insert(Item(id, hot))
+        #falls off the end: nothing to do
+        self.assertTrue(r.insert(Item(4, 0.)))
+        self.assertEqual(list(r), ['t3_2', 't3_1', 't3_3'])
+        #pushes the last one out
+        self.assertTrue(r.insert(Item(5, 7.)))
+        self.assertEqual(list(r), ['t3_2', 't3_5', 't3_1'])
+        #moves to the end
+        self.assertTrue(r.insert(Item(2, 0.)))
+        self.assertEqual(list(r), ['t3_5', 't3_1', 't3_2'])
+
+    def test_packed_data(self):
+        data = [('t3_2', 10., 0.), ('t3_1', 5., 0.)]
+        r = make_results([desc('_hot'), desc('_date')],
+                         PackedResults.pack(data))
+        self.assertTrue(r.insert(Item(3, 7.)))
+        self.assertEqual(list(r), ['t3_2', 't3_3', 't3_1'])
+
+    def test_bisects_keys(self):
+        #only the keys bisect looks at are computed
+        queries.precompute_limit = 1000
+        data = [('t3_' + to36(i), float(1000 - i), 0.) for i in range(1, 1000)]
+        r = make_results([desc('_hot'), desc('_date')], data)
+        computed = []
+        make_sort_key = queries.make_sort_key
+        def counting(sort):
+            sort_key = make_sort_key(sort)
+            def key(t):
+                computed.append(t)
+                return sort_key(t)
+            return key
+        queries.make_sort_key = counting
+        try:
+            self.assertTrue(r.insert(Item(5000, 500.5)))
+        finally:
+            queries.make_sort_key = make_sort_key
+        self.assertTrue(len(computed) < 20)
+        self.assertEqual(r.data[499], ('t3_' + to36(5000), 500.5, 0.))
+        self.assertEqual(len(r.data), 1000)
+
+class TestPackedResults(TestCase):
+    data = [('t3_zz', 12.5, 1250000000.0),
+            ('t3_1', 3.0, 1250000001.0),
+            ('t3_a', -2.0, 1250000002.0)]
+
+    def test_round_trip(self):
+        p = PackedResults.pack(self.data)
+        self.assertEqual(list(p), self.data)
+        self.assertEqual(len(p), 3)
+        self.assertEqual(p[1], self.data[1])
+        self.assertEqual(p[1:], self.data[1:])
+        self.assertEqual(list(p.fullnames()), [t[0] for t in self.data])
+
+    def test_pickle(self):
+        p = PackedResults.pack(self.data)
+        for protocol in (0, 2):
+            q = pickle.loads(pickle.dumps(p, protocol))
+            self.assertEqual(list(q), self.data)
+
+    def test_unpackable(self):
+        self.assertEqual(PackedResults.pack([]), None)
+        #mixed prefixes
+        self.assertEqual(PackedResults.pack([('t3_1', 1.), ('t1_2', 1.)]),
+                         None)
+        #ids that wouldn't come back the same
+        self.assertEqual(PackedResults.pack([('t3_01', 1.)]), None)
+        #sort columns that aren't numbers
+        self.assertEqual(PackedResults.pack([('t3_1', 'a')]), None)
+        self.assertEqual(PackedResults.pack([('t3_1', True)]), None)
+        #different lengths
+        self.assertEqual(PackedResults.pack([('t3_1', 1.), ('t3_2',)]),
+                         None)
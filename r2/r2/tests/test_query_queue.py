@@ -0,0 +1,186 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+# 
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+# 
+# The Original Code is Reddit.
+# 
+# The Original Developer is the Initial Developer.  The Initial Developer of the
+# Original Code is CondeNet, Inc.
+# 
+# All portions of the code written by CondeNet are Copyright (c) 2006-2008
+# CondeNet, Inc. All Rights Reserved.
+################################################################################
+from __future__ import with_statement
+from unittest import TestCase
+from threading import Thread
+import os, time
+
+import psycopg2
+
+from r2.tests import *
+from r2.lib.db import query_queue
+from r2.lib.db.query_queue import Listener, LocalNotifier, notify_channel
+
+class PipeConnection(object):
+    """enough of a psycopg2 connection for Listener, notified through
+    a pipe"""
+    def __init__(self):
+        self.r, self.w = os.pipe()
+        self.notifies = []
+        self.broken = False
+
+    def fileno(self):
+        return self.r
+
+    def send_notify(self):
+        os.write(self.w, 'x')
+
+    def poll(self):
+        if self.broken:
+            raise psycopg2.Error('connection lost')
+        os.read(self.r, 1024)
+        self.notifies.append((0, notify_channel))
+
+class PipeListener(Listener):
+    retry_delay = 0
+
+    def __init__(self):
+        Listener.__init__(self)
+        self.connections = []
+
+    def connect(self):
+        self.conn = PipeConnection()
+        self.connections.append(self.conn)
+
+class TestListener(TestCase):
+    def test_wakeup(self):
+        l = PipeListener()
+        self.assertFalse(l.wait(0))
+        l.conn.send_notify()
+        start = time.time()
+        self.assertTrue(l.wait(5))
+        self.assertTrue(time.time() - start < 1)
+        #each notify wakes it once
+        self.assertFalse(l.wait(.05))
+
+    def test_reconnect(self):
+        l = PipeListener()
+        l.wait(0)
+        l.conn.broken = True
+        l.conn.send_notify()
+        self.assertFalse(l.wait(5))
+        self.assertEqual(l.conn, None)
+        #the next wait connects again
+        self.assertFalse(l.wait(0))
+        self.assertEqual(len(l.connections), 2)
+        l.conn.send_notify()
+        self.assertTrue(l.wait(5))
+
+class TestLocalNotifier(TestCase):
+    def test_wait(self):
+        n = LocalNotifier()
+        self.assertFalse(n.wait(.05))
+        #a notify before the wait isn't lost
+        n.notify()
+        self.assertTrue(n.wait(0))
+        self.assertFalse(n.wait(0))
+
+    def test_wakeup(self):
+        n = LocalNotifier()
+        t = Thread(target = lambda: (time.sleep(.05), n.notify()))
+        t.start()
+        start = time.time()
+        self.assertTrue(n.wait(5))
+        self.assertTrue(time.time() - start < 1)
+
+class Done(Exception): pass
+
+class FakeGlobals(object):
+    num_query_queue_workers = 1
+    query_queue_batch_size = 1
+    query_queue_debounce = 0
+    query_queue_lease = 300
+    query_queue_notify = True
+
+class TestRun(TestCase):
+    """run() against a queue held in memory"""
+    def setUp(self):
+        self.saved = dict((name, getattr(query_queue, name))
+                          for name in ('g', 'claim_queries', 'next_claim_in',
+                                       'make_query_job', 'log_stats',
+                                       'local_notifier'))
+        query_queue.g = FakeGlobals()
+        query_queue.log_stats = lambda: None
+        query_queue.claim_queries = self.claim_queries
+        query_queue.next_claim_in = self.next_claim_in
+        query_queue.make_query_job = self.make_query_job
+        self.notifier = query_queue.local_notifier = LocalNotifier()
+        #iden -> when it can be claimed
+        self.queue = {}
+        self.claimed = []
+        self.want = 1
+
+    def tearDown(self):
+        for name, val in self.saved.iteritems():
+            setattr(query_queue, name, val)
+
+    def claim_queries(self, limit, debounce, lease, exclude):
+        if len(self.claimed) >= self.want:
+            raise Done
+        now = time.time()
+        ready = sorted(iden for iden, due in self.queue.iteritems()
+                       if due <= now and iden not in exclude)[:limit]
+        for iden in ready:
+            del self.queue[iden]
+            self.claimed.append((iden, now))
+        return [(iden, 'query', None, None) for iden in ready]
+
+    def next_claim_in(self, debounce):
+        if self.queue:
+            return min(self.queue.values()) - time.time()
+
+    def make_query_job(self, claimed):
+        def job():
+            with query_queue.running_lock:
+                for c in claimed:
+                    query_queue.running.discard(c[0])
+        return job
+
+    def run_queue(self):
+        self.assertRaises(Done, query_queue.run)
+
+    def test_wakeup(self):
+        #nothing queued, so run() would wait a minute without a notify
+        def add():
+            time.sleep(.1)
+            self.queue['a'] = 0
+            self.notifier.notify()
+        Thread(target = add).start()
+        start = time.time()
+        self.run_queue()
+        self.assertEqual([iden for iden, when in self.claimed], ['a'])
+        self.assertTrue(self.claimed[0][1] - start < 1)
+
+    def test_missed_notify(self):
+        #queued without a notify: found when it's due
+        self.queue['a'] = time.time() + .2
+        start = time.time()
+        self.run_queue()
+        self.assertEqual([iden for iden, when in self.claimed], ['a'])
+        self.assertTrue(.15 < self.claimed[0][1] - start < 1)
+
+    def test_drains_queue(self):
+        self.queue.update(a = 0, b = 0, c = 0)
+        self.want = 3
+        self.run_queue()
+        self.assertEqual(sorted(iden for iden, when in self.claimed),
+                         ['a', 'b', 'c'])
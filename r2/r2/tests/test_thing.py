@@ -0,0 +1,143 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+# 
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+# 
+# The Original Code is Reddit.
+# 
+# The Original Developer is the Initial Developer.  The Initial Developer of the
+# Original Code is CondeNet, Inc.
+# 
+# All portions of the code written by CondeNet are Copyright (c) 2006-2008
+# CondeNet, Inc. All Rights Reserved.
+################################################################################
+from unittest import TestCase
+import cPickle as pickle
+
+from r2.tests import *
+from r2.lib.db.thing import Thing, SafeSetAttr
+from r2.models import Account, Link, Comment, Message, Vote, Report, Inbox
+
+class Pickled(Thing):
+    _nodb = True
+    _defaults = dict(score = 0)
+
+def round_trip(thing, protocol = 2):
+    return pickle.loads(pickle.dumps(thing, protocol))
+
+class TestThingPickling(TestCase):
+    def make(self):
+        t = Pickled(ups = 3, downs = 1, id = 5, title = 'a title')
+        with t.safe_set_attr:
+            t._loaded = True
+        return t
+
+    def test_round_trip(self):
+        for protocol in (1, 2):
+            t = self.make()
+            t2 = round_trip(t, protocol)
+            self.assertEqual(t2.__class__, Pickled)
+            for attr in ('_id', '_ups', '_downs', '_date', '_deleted',
+                         '_spam', '_loaded', '_created', '_t'):
+                self.assertEqual(getattr(t2, attr), getattr(t, attr))
+            self.assertEqual(t2.title, 'a title')
+            self.assertEqual(t2.score, 0)
+            self.assertEqual(t2._dirties, {})
+
+    def test_slots(self):
+        t = self.make()
+        #the base props and state aren't in the __dict__
+        for attr in ('_id', '_ups', '_t', '_dirties', 'safe_set_attr'):
+            self.assertFalse(attr in t.__dict__, attr)
+
+    def test_state(self):
+        state = self.make().__getstate__()
+        #rebuilt or defaulted on load
+        for attr in ('safe_set_attr', '__safe__', '_dirties', '_created'):
+            self.assertFalse(attr in state, attr)
+        self.assertEqual(state['_t'], dict(title = 'a title'))
+        self.assertEqual(state['_ups'], 3)
+
+    def test_safe_set_attr_rebuilt(self):
+        t2 = round_trip(self.make())
+        self.assertTrue(isinstance(t2.safe_set_attr, SafeSetAttr))
+        self.assertTrue(t2.safe_set_attr.cls is t2)
+        with t2.safe_set_attr:
+            t2._ups = 10
+        self.assertEqual(t2._dirties, {})
+        t2.title = 'new title'
+        self.assertEqual(t2._dirties, dict(title = 'new title'))
+
+    def test_dirty_and_new(self):
+        t = Pickled(ups = 1, title = 'new')
+        t2 = round_trip(t)
+        self.assertFalse(t2._created)
+        self.assertEqual(t2._dirties, t._dirties)
+        self.assertEqual(t2.title, 'new')
+
+    def test_dict_attrs(self):
+        t = Pickled()
+        t._set_id(10)
+        t2 = round_trip(t)
+        self.assertEqual(t2._thing_id, 10)
+        self.assertTrue('_thing_id' in t2._base_props)
+
+    def test_old_pickles(self):
+        #things cached before slots had their whole __dict__
+        t = self.make()
+        state = dict(t.__getstate__(), _dirties = {}, _created = True,
+                     __safe__ = False, safe_set_attr = SafeSetAttr(None))
+        t2 = Pickled.__new__(Pickled)
+        t2.__setstate__(state)
+        self.assertEqual(t2._ups, 3)
+        self.assertEqual(t2.title, 'a title')
+        self.assertTrue(t2.safe_set_attr.cls is t2)
+        self.assertFalse(t2.__safe__)
+
+    def test_missing_attrs(self):
+        t = self.make()
+        self.assertRaises(AttributeError, getattr, t, 'nope')
+        #a thing being unpickled has no _t yet
+        t2 = Pickled.__new__(Pickled)
+        self.assertRaises(AttributeError, getattr, t2, '_t')
+        self.assertRaises(AttributeError, getattr, t2, 'title')
+
+class TestMultiRelation(TestCase):
+    def test_construct(self):
+        account, link = Account(id = 1), Link(id = 2)
+        v = Vote(account, link, '1', ip = '127.0.0.1')
+        self.assertTrue(v.__class__ is Vote.rel(Account, Link))
+        self.assertEqual((v._thing1_id, v._thing2_id, v._name),
+                         (1, 2, '1'))
+        self.assertEqual(v.ip, '127.0.0.1')
+        self.assertFalse(v._created)
+        self.assertEqual(v._dirties['ip'], '127.0.0.1')
+
+    def test_each_pair(self):
+        account = Account(id = 1)
+        for cls, thing in ((Vote, Comment(id = 3)),
+                           (Report, Message(id = 4)),
+                           (Inbox, Comment(id = 3)),
+                           (Inbox, Message(id = 4))):
+            r = cls(account, thing, 'name', amount = 0)
+            self.assertTrue(r.__class__ is cls.rel(Account, thing.__class__))
+            self.assertEqual(r._thing2_id, thing._id)
+            self.assertEqual(r.amount, 0)
+
+    def test_pickle(self):
+        v = Vote(Account(id = 1), Link(id = 2), '-1', id = 7)
+        v2 = round_trip(v)
+        self.assertTrue(v2.__class__ is v.__class__)
+        self.assertEqual((v2._id, v2._thing1_id, v2._name), (7, 1, '-1'))
+
+    def test_unknown_pair(self):
+        self.assertRaises(KeyError, Vote, Account(id = 1), Account(id = 2),
+                          '1')
@@ -0,0 +1,136 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+# 
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+# 
+# The Original Code is Reddit.
+# 
+# The Original Developer is the Initial Developer.  The Initial Developer of the
+# Original Code is CondeNet, Inc.
+# 
+# All portions of the code written by CondeNet are Copyright (c) 2006-2008
+# CondeNet, Inc. All Rights Reserved.
+################################################################################
+from unittest import TestCase
+from threading import Thread, Event, Lock
+import sys, time, traceback
+
+from r2.tests import *
+from r2.lib.workqueue import WorkQueue, JobTimeout
+
+class Stop(BaseException):
+    """not an Exception, like SystemExit"""
+
+def run_for(fn, seconds = 5):
+    """runs fn in a thread, True if it finished within seconds"""
+    t = Thread(target = fn)
+    t.setDaemon(True)
+    t.start()
+    t.join(seconds)
+    return not t.isAlive()
+
+class TestWorkQueue(TestCase):
+    def test_results(self):
+        wq = WorkQueue(num_workers = 3)
+        wq.start()
+        jobs = [wq.add(lambda n = n: n * 2) for n in range(10)]
+        self.assertEqual([j.get(5) for j in jobs], range(0, 20, 2))
+        self.assertTrue(run_for(wq.wait))
+        self.assertEqual(wq.stats()['done'], 10)
+
+    def test_initial_jobs(self):
+        done = []
+        wq = WorkQueue([lambda n = n: done.append(n) for n in range(5)])
+        wq.start()
+        self.assertTrue(run_for(wq.wait))
+        self.assertEqual(sorted(done), range(5))
+
+    def test_fixed_pool(self):
+        lock = Lock()
+        running = [0, 0]
+        def job():
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+            time.sleep(.05)
+            with lock:
+                running[0] -= 1
+        wq = WorkQueue(num_workers = 2)
+        wq.start()
+        for i in range(8):
+            wq.add(job)
+        self.assertTrue(run_for(wq.wait))
+        #never more at once than there are threads
+        self.assertEqual(running[1], 2)
+
+    def test_exception_traceback(self):
+        def failing_job():
+            raise ValueError('failed')
+        wq = WorkQueue(num_workers = 1)
+        wq.start()
+        job = wq.add(failing_job)
+        try:
+            job.get(5)
+            self.fail()
+        except ValueError, e:
+            self.assertEqual(str(e), 'failed')
+            #raised where the job raised it
+            tb = traceback.extract_tb(sys.exc_info()[2])
+            self.assertEqual(tb[-1][2], 'failing_job')
+        self.assertEqual(wq.stats()['failed'], 1)
+
+    def test_base_exception(self):
+        def stop():
+            raise Stop
+        wq = WorkQueue(num_workers = 1)
+        wq.start()
+        job = wq.add(stop)
+        #the job is finished and the only thread is still working
+        self.assertTrue(run_for(wq.wait))
+        self.assertRaises(Stop, job.get, 5)
+        self.assertEqual(wq.add(lambda: 'ok').get(5), 'ok')
+
+    def test_get_timeout(self):
+        release = Event()
+        wq = WorkQueue(num_workers = 1)
+        wq.start()
+        job = wq.add(release.wait)
+        self.assertRaises(JobTimeout, job.get, .05)
+        self.assertFalse(job.done())
+        release.set()
+        job.get(5)
+
+    def test_job_timeout(self):
+        release = Event()
+        wq = WorkQueue(num_workers = 1, timeout = .1)
+        wq.start()
+        slow = wq.add(lambda: release.wait(5))
+        self.assertRaises(JobTimeout, slow.get, 5)
+        #the stuck thread was replaced
+        self.assertEqual(wq.add(lambda: 'ok').get(5), 'ok')
+        self.assertTrue(run_for(wq.wait))
+        self.assertEqual(wq.stats()['timed_out'], 1)
+        release.set()
+
+    def test_max_queued(self):
+        release = Event()
+        wq = WorkQueue(num_workers = 1, max_queued = 1)
+        wq.start()
+        wq.add(release.wait)
+        #wait for the thread to take the first job
+        while not wq.stats()['running']:
+            time.sleep(.01)
+        wq.add(lambda: None)
+        #the queue is full, so the third add blocks
+        self.assertFalse(run_for(lambda: wq.add(lambda: None), .1))
+        release.set()
+        self.assertTrue(run_for(wq.wait))
+        self.assertEqual(wq.stats()['done'], 3)